@@ -0,0 +1,68 @@
+"""
+Load time and peak memory of dataloader.load_csv_price_and_volume_histories
+against the previous per-ticker outer join implementation.
+
+    python -m benchmarks.bench_dataloader --sizes 100 1000 5000 --years 10
+
+The join loop is quadratic, at 5000 tickers it takes close to an hour, use --loaders bulk to skip it.
+"""
+import argparse
+import os
+import tempfile
+import time
+import tracemalloc
+
+import pandas as pd
+
+from benchmarks.synthetic import synthetic_price_volume_history, write_price_volume_csvs
+from pypoanal import dataloader
+
+
+def _join_loop_load(tickers: list[str], data_dir: str) -> tuple[pd.DataFrame, pd.DataFrame]:
+    """previous implementation: one outer join per ticker"""
+    prices_history = pd.DataFrame()
+    volume_history = pd.DataFrame()
+    for ticker in tickers:
+        ticker_prices_vols = dataloader._load_price_volume_history(ticker, data_dir)
+        prices_history = prices_history.join(ticker_prices_vols['Adj Close'].rename(ticker), how='outer')
+        volume_history = volume_history.join(ticker_prices_vols['Volume'].rename(ticker), how='outer')
+    return prices_history, volume_history
+
+
+def _measure(load, tickers: list[str], data_dir: str) -> tuple[float, float]:
+    """:return: seconds, peak traced memory in MB"""
+    tracemalloc.start()
+    start = time.perf_counter()
+    load(tickers, data_dir)
+    elapsed = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return elapsed, peak / 2 ** 20
+
+
+LOADERS = {'join_loop': _join_loop_load,
+           'bulk': dataloader.load_csv_price_and_volume_histories}
+
+
+def run(sizes: list[int], years: float, loaders: list[str]) -> pd.DataFrame:
+    rows = []
+    for n_tickers in sizes:
+        with tempfile.TemporaryDirectory() as data_dir:
+            prices, volumes = synthetic_price_volume_history(n_tickers, years)
+            write_price_volume_csvs(prices, volumes, data_dir)
+            tickers = sorted(prices.columns)
+            for name in loaders:
+                seconds, peak_mb = _measure(LOADERS[name], tickers, data_dir)
+                rows.append({'tickers': n_tickers, 'loader': name, 'seconds': seconds, 'peak_mb': peak_mb})
+                print(rows[-1])
+    return pd.DataFrame(rows)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', type=int, nargs='+', default=[100, 1000, 5000])
+    parser.add_argument('--years', type=float, default=10.0)
+    parser.add_argument('--loaders', nargs='+', choices=list(LOADERS), default=list(LOADERS))
+    args = parser.parse_args()
+    os.environ.setdefault('TQDM_DISABLE', '1')
+    print(run(args.sizes, args.years, args.loaders).to_string(index=False))
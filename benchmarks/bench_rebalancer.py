@@ -0,0 +1,90 @@
+"""
+Time of one portfolio rebalance: portfolio_rebalancer.reallocate_portfolio (numpy kernel)
+against the previous pandas implementation, on portfolios which need selling shares to pay fees.
+
+    python -m benchmarks.bench_rebalancer --sizes 50 500 5000 --repeats 20
+"""
+import argparse
+import time
+
+import numpy as np
+import pandas as pd
+
+from pypoanal import portfolio_rebalancer
+from pypoanal.assets import Portfolio, SharesNumber, SharesWeights
+
+
+def reallocate_portfolio_pandas(old_portfolio: Portfolio,
+                                new_portfolio_weights: SharesWeights,
+                                latest_prices: pd.Series,
+                                fees_percent=0.04) -> tuple[Portfolio, np.float64]:
+    """
+    previous implementation of portfolio_rebalancer.reallocate_portfolio on index-aligned pandas Series,
+    kept as its reference
+    :param old_portfolio: portfolio before re-allocation
+    :param new_portfolio_weights: {'GOOG': 0.5, 'AMZN': 0.2, 'MSFT': 0.3}
+    :param latest_prices: shares prices
+    :return (allocated equity, fees)
+    """
+    portfolio_value = old_portfolio.value(latest_prices)
+    # portfolio_estimate: PortfolioShares = np.ceil(new_portfolio_weights * total_value / latest_prices)
+    portfolio_estimate: SharesNumber = np.round(new_portfolio_weights * portfolio_value / latest_prices)
+    portfolio_estimate = portfolio_rebalancer._clean_weights(portfolio_estimate)
+    leftover_fn = lambda portfolio: portfolio_rebalancer._compute_leftover_after_rebalance(old_portfolio,
+                                                                                           portfolio,
+                                                                                           latest_prices,
+                                                                                           fees_percent)
+    reduced_portfolio = portfolio_rebalancer._reduce_portfolio_until_leftover_positive(portfolio_estimate,
+                                                                                       latest_prices,
+                                                                                       leftover_fn,
+                                                                                       fees_percent)
+    leftover = leftover_fn(reduced_portfolio)
+    fees = portfolio_rebalancer._compute_fees_for_rebalance(old_portfolio.shares,
+                                                            reduced_portfolio,
+                                                            latest_prices,
+                                                            fees_percent)
+    if fees < 0 or leftover < 0:
+        from loguru import logger
+        logger.error('fees are negative')
+        logger.debug(f'fees: {fees} leftover: {leftover}')
+        logger.debug(f'Old portolio: {old_portfolio.shares.to_list()}')
+        logger.debug(f'New portolio: {new_portfolio_weights.to_list()}')
+        logger.debug(f'Prices: {latest_prices.to_list()}')
+        raise portfolio_rebalancer.AllocationException('Smth gone wrong')
+    return Portfolio(cash=leftover, shares=portfolio_rebalancer._clean_weights(reduced_portfolio)), fees
+
+
+REBALANCERS = {'pandas': reallocate_portfolio_pandas,
+               'kernel': portfolio_rebalancer.reallocate_portfolio}
+
+
+def rebalance_inputs(n_tickers: int, seed: int = 0) -> tuple[Portfolio, pd.Series, pd.Series]:
+    """old portfolio with almost no cash, new weights on half of the tickers, prices of all tickers"""
+    rng = np.random.default_rng(seed)
+    tickers = [f'T{n}' for n in range(n_tickers)]
+    prices = pd.Series(rng.lognormal(3.0, 1.0, n_tickers), index=tickers)
+    old_shares = pd.Series(rng.integers(1, 100, n_tickers).astype(np.float64), index=tickers)
+    weights = pd.Series(rng.random(n_tickers), index=tickers).sample(frac=0.5, random_state=seed)
+    return Portfolio(1.0, old_shares), weights / weights.sum(), prices
+
+
+def run(sizes: list[int], repeats: int) -> pd.DataFrame:
+    rows = []
+    for n_tickers in sizes:
+        old_portfolio, weights, prices = rebalance_inputs(n_tickers)
+        for name, reallocate in REBALANCERS.items():
+            start = time.perf_counter()
+            for _ in range(repeats):
+                reallocate(old_portfolio, weights, prices, 1.0)
+            rows.append({'tickers': n_tickers, 'rebalancer': name,
+                         'ms_per_rebalance': (time.perf_counter() - start) / repeats * 1000})
+            print(rows[-1])
+    return pd.DataFrame(rows)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', type=int, nargs='+', default=[50, 500, 5000])
+    parser.add_argument('--repeats', type=int, default=20)
+    args = parser.parse_args()
+    print(run(args.sizes, args.repeats).to_string(index=False))
@@ -0,0 +1,215 @@
+"""
+Offline benchmark suite of the data, liquidity, optimizer and rebalance hot paths on synthetic histories.
+Results are saved as json, a later run can be compared with them to find regressions.
+Timings depend on the machine and the environment, so a baseline is measured locally first,
+results are not committed:
+
+    python -m benchmarks.suite --tickers 500 --years 10 --output benchmarks/results/baseline.json
+    python -m benchmarks.suite --compare benchmarks/results/baseline.json
+
+Calculators and the end-to-end backtest use --calculator-tickers of the liquid tickers,
+pypfopt calculators are too slow for the whole universe.
+"""
+import argparse
+import datetime
+import json
+import os
+import platform
+import statistics
+import subprocess
+import tempfile
+import time
+import warnings
+from dataclasses import asdict, dataclass
+from typing import Callable, Optional
+
+import numpy as np
+import pandas as pd
+
+from benchmarks.bench_rebalancer import rebalance_inputs
+from benchmarks.synthetic import synthetic_price_volume_history, write_price_volume_csvs
+from pypoanal import backtester, dataloader, portfolio_calculators, portfolio_rebalancer
+from pypoanal.assets import SharesHistory
+
+RESULTS_DIR = os.path.join(os.path.dirname(__file__), 'results')
+
+
+@dataclass
+class BenchmarkConfig:
+    tickers: int = 200
+    years: float = 6.0
+    missing_ratio: float = 0.01
+    seed: int = 0
+    repeats: int = 3
+    # tickers of the calculators and of the end-to-end backtest
+    calculator_tickers: int = 40
+
+
+class _BenchmarkData:
+    """synthetic histories, csv files and the columnar store, shared by all benchmarks of a run"""
+
+    def __init__(self, config: BenchmarkConfig, data_dir: str):
+        self.config = config
+        self.prices, self.volumes = synthetic_price_volume_history(config.tickers, config.years,
+                                                                   config.missing_ratio, config.seed)
+        rng = np.random.default_rng(config.seed)
+        self.shares_outstanding = pd.Series(rng.integers(10 ** 6, 10 ** 8, config.tickers).astype(np.float64),
+                                            index=self.prices.columns)
+        self.csv_dir = os.path.join(data_dir, 'csv')
+        self.store_dir = os.path.join(data_dir, 'store')
+        write_price_volume_csvs(self.prices, self.volumes, self.csv_dir)
+        # the store records its csv files, the store benchmark checks they did not change as in real use
+        dataloader.convert_csv_dir_to_store(self.csv_dir, self.store_dir)
+        # last year of the history, all tickers are listed by then
+        self.window_end = self.prices.index[-1].date()
+        self.window_start = self.window_end - datetime.timedelta(days=365)
+        liquid_tickers = backtester.choose_liquid_tickers(self.volumes, self.window_start, self.window_end)
+        self.calculator_tickers = liquid_tickers[:config.calculator_tickers]
+        self.prices_sample = self.prices.loc[self.window_start:self.window_end, self.calculator_tickers]
+        self.shares_history = SharesHistory(self.prices[self.calculator_tickers],
+                                            self.volumes[self.calculator_tickers],
+                                            self.shares_outstanding[self.calculator_tickers])
+        self.rebalance_dates = backtester.compute_rebalance_dates(self.prices.index[0].date(), self.window_end,
+                                                                  datetime.timedelta(days=182))
+
+
+def _benchmarks(data: _BenchmarkData) -> dict[str, Callable[[], object]]:
+    """name -> function to time"""
+    tickers = list(data.prices.columns)
+    old_portfolio, weights, prices = rebalance_inputs(data.config.tickers, data.config.seed)
+    benchmarks = {
+        'load_csv_price_and_volume_histories':
+            lambda: dataloader.load_csv_price_and_volume_histories(tickers, data.csv_dir),
+        'load_price_and_volume_histories (store)':
+            lambda: dataloader.load_price_and_volume_histories(set(tickers), data.store_dir),
+        'choose_liquid_tickers':
+            lambda: backtester.choose_liquid_tickers(data.volumes, data.window_start, data.window_end),
+        'reallocate_portfolio':
+            lambda: portfolio_rebalancer.reallocate_portfolio(old_portfolio, weights, prices, 1.0)}
+    for calc_name, compute_weights in portfolio_calculators.CALCULATORS.items():
+        benchmarks[f'calculator {calc_name}'] = (
+            lambda compute_weights=compute_weights: compute_weights(data.shares_outstanding, data.prices_sample))
+    benchmarks['compare_calculators_for_periodic_rebalance'] = (
+        lambda: backtester.compare_calculators_for_periodic_rebalance(portfolio_calculators.CALCULATORS,
+                                                                      data.calculator_tickers, 10 ** 6,
+                                                                      data.rebalance_dates,
+                                                                      shares_history=data.shares_history,
+                                                                      progress_bar=False))
+    return benchmarks
+
+
+def _time(function: Callable[[], object], repeats: int, min_measurement_seconds: float = 0.2) -> list[float]:
+    """
+    :return: seconds per call of every measurement, after a warm-up call.
+    Fast functions are called several times per measurement, as in timeit
+    """
+    start = time.perf_counter()
+    function()
+    number = max(1, int(min_measurement_seconds / max(time.perf_counter() - start, 1e-9)))
+    seconds = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        for _ in range(number):
+            function()
+        seconds.append((time.perf_counter() - start) / number)
+    return seconds
+
+
+def run(config: BenchmarkConfig, only: Optional[list[str]] = None) -> pd.DataFrame:
+    """
+    :param only: names of the benchmarks to run, all if None
+    :return: one row per benchmark: benchmark, min_seconds, median_seconds, repeats, seconds are per call
+    """
+    rows = []
+    with tempfile.TemporaryDirectory() as data_dir, warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        data = _BenchmarkData(config, data_dir)
+        for name, function in _benchmarks(data).items():
+            if only is not None and name not in only:
+                continue
+            seconds = _time(function, config.repeats)
+            rows.append({'benchmark': name, 'min_seconds': min(seconds),
+                         'median_seconds': statistics.median(seconds), 'repeats': config.repeats})
+            print(rows[-1])
+    return pd.DataFrame(rows)
+
+
+def _git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(__file__), check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def _environment() -> dict[str, Optional[str]]:
+    return {'commit': _git_commit(), 'python': platform.python_version(),
+            'numpy': np.__version__, 'pandas': pd.__version__, 'machine': platform.machine()}
+
+
+def save_results(results: pd.DataFrame, config: BenchmarkConfig, path: str) -> None:
+    """saves timings with the configuration and the environment they were measured in"""
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    report = {'config': asdict(config),
+              'environment': _environment(),
+              'date': datetime.datetime.now().isoformat(timespec='seconds'),
+              'results': results.to_dict(orient='records')}
+    with open(path, 'w') as results_file:
+        json.dump(report, results_file, indent=2)
+
+
+def load_results(path: str) -> tuple[pd.DataFrame, BenchmarkConfig]:
+    """warns if the results were measured in another environment, their timings are then not comparable"""
+    with open(path) as results_file:
+        report = json.load(results_file)
+    environment = _environment()
+    differences = {key: (value, environment[key]) for key, value in report.get('environment', {}).items()
+                   if key != 'commit' and value != environment.get(key)}
+    if differences:
+        warnings.warn(f'{path} was measured in another environment, (saved, current): {differences}')
+    return pd.DataFrame(report['results']), BenchmarkConfig(**report['config'])
+
+
+def compare(results: pd.DataFrame, baseline: pd.DataFrame, tolerance: float = 0.25) -> pd.DataFrame:
+    """
+    Compares minimal times, they are the least noisy
+    :param tolerance: a benchmark regressed if it is slower than the baseline by more than this fraction
+    :return: benchmark, baseline and current min_seconds, ratio current / baseline, regression flag
+    """
+    table = baseline.set_index('benchmark')[['min_seconds']].join(results.set_index('benchmark')[['min_seconds']],
+                                                                   how='inner', lsuffix='_baseline')
+    table['ratio'] = table['min_seconds'] / table['min_seconds_baseline']
+    table['regression'] = table['ratio'] > 1.0 + tolerance
+    return table.reset_index()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    defaults = BenchmarkConfig()
+    parser.add_argument('--tickers', type=int, default=defaults.tickers)
+    parser.add_argument('--years', type=float, default=defaults.years)
+    parser.add_argument('--missing-ratio', type=float, default=defaults.missing_ratio)
+    parser.add_argument('--seed', type=int, default=defaults.seed)
+    parser.add_argument('--repeats', type=int, default=defaults.repeats)
+    parser.add_argument('--calculator-tickers', type=int, default=defaults.calculator_tickers)
+    parser.add_argument('--only', nargs='+', help='names of the benchmarks to run')
+    parser.add_argument('--output', help='json file for the results, results/<commit>.json by default')
+    parser.add_argument('--compare', help='json results of a previous run, its configuration is used')
+    parser.add_argument('--tolerance', type=float, default=0.25)
+    args = parser.parse_args()
+    os.environ.setdefault('TQDM_DISABLE', '1')
+    baseline_results = None
+    if args.compare:
+        baseline_results, config = load_results(args.compare)
+    else:
+        config = BenchmarkConfig(args.tickers, args.years, args.missing_ratio, args.seed, args.repeats,
+                                 args.calculator_tickers)
+    results = run(config, args.only)
+    output = args.output or os.path.join(RESULTS_DIR, f'{_git_commit() or "results"}.json')
+    save_results(results, config, output)
+    print(results.to_string(index=False))
+    if baseline_results is not None:
+        comparison = compare(results, baseline_results, args.tolerance)
+        print(comparison.to_string(index=False))
+        if comparison['regression'].any():
+            raise SystemExit(f'regressions: {comparison.loc[comparison["regression"], "benchmark"].tolist()}')
@@ -0,0 +1,38 @@
+"""Synthetic price and volume histories, so that benchmarks run without downloading anything"""
+import os
+
+import numpy as np
+import pandas as pd
+
+
+def synthetic_price_volume_history(n_tickers: int,
+                                   years: float = 5.0,
+                                   missing_ratio: float = 0.01,
+                                   seed: int = 0) -> tuple[pd.DataFrame, pd.DataFrame]:
+    """
+    Geometric brownian motion prices and lognormal volumes on business days.
+    Each ticker starts trading at a random date, and missing_ratio of its remaining days are NaN
+    :return prices table indexed with dates, column = tickers, i.e. 'T0000', 'T0001',...
+    :return volumes table indexed with dates, column = tickers, i.e. 'T0000', 'T0001',...
+    """
+    rng = np.random.default_rng(seed)
+    dates = pd.bdate_range('2000-01-03', periods=int(years * 252), name='Date')
+    tickers = [f'T{n:04d}' for n in range(n_tickers)]
+    daily_returns = rng.normal(0.0003, 0.02, size=(len(dates), n_tickers))
+    prices = 10.0 * np.exp(np.cumsum(daily_returns, axis=0))
+    volumes = np.round(rng.lognormal(8.0, 1.5, size=(len(dates), n_tickers)))
+    # tickers are listed at different dates
+    first_trading_day = rng.integers(0, len(dates) // 2, size=n_tickers)
+    not_listed = np.arange(len(dates))[:, None] < first_trading_day[None, :]
+    missing = rng.random((len(dates), n_tickers)) < missing_ratio
+    prices[not_listed | missing] = np.nan
+    volumes[not_listed | missing] = np.nan
+    return pd.DataFrame(prices, index=dates, columns=tickers), pd.DataFrame(volumes, index=dates, columns=tickers)
+
+
+def write_price_volume_csvs(prices_history: pd.DataFrame, volume_history: pd.DataFrame, data_dir: str) -> None:
+    """Saves each ticker as data_dir/<TICKER>.csv in the format of dataloader.download_and_save_price_history"""
+    os.makedirs(data_dir, exist_ok=True)
+    for ticker in prices_history.columns:
+        ticker_df = pd.DataFrame({'Adj Close': prices_history[ticker], 'Volume': volume_history[ticker]})
+        ticker_df.dropna(how='all').to_csv(os.path.join(data_dir, ticker + '.csv'))
@@ -1,7 +1,9 @@
 from dataclasses import dataclass
+from typing import Iterator, Optional, Union
 
 import numpy as np
 import pandas as pd
+import scipy.sparse as sp
 
 #  must be positive, short selling is not supported
 SharesWeights = pd.Series  # pd.Series([0.2,0.3,0.5], index=['AMZN','GOOG','AAPL'])
@@ -19,11 +21,21 @@ def shares_value(shares: SharesNumber, shares_prices: pd.Series) -> np.float64:
     return (shares_prices * shares).sum()
 
 
-# slots are new in vertion 3.10
-@dataclass
 class Portfolio:
-    cash: np.float64 = np.float64(0.0)
-    shares: SharesNumber = pd.Series(dtype=np.float64)
+    # dataclass slots are new in version 3.10
+    __slots__ = ('cash', 'shares')
+
+    def __init__(self, cash: np.float64 = np.float64(0.0), shares: Optional[SharesNumber] = None):
+        self.cash = cash
+        self.shares: SharesNumber = shares if shares is not None else pd.Series(dtype=np.float64)
+
+    def __repr__(self) -> str:
+        return f'Portfolio(cash={self.cash!r}, shares={self.shares.to_dict()!r})'
+
+    def __eq__(self, other) -> bool:
+        if not isinstance(other, Portfolio):
+            return NotImplemented
+        return self.cash == other.cash and self.shares.equals(other.shares)
 
     def value(self, shares_prices: pd.Series) -> np.float64:
         """
@@ -33,6 +45,139 @@ class Portfolio:
         return self.cash + shares_value(self.shares, shares_prices)
 
 
+class PortfolioHistory:
+    """
+    Portfolios of a backtest stored by columns: cash vector and holdings matrix rebalances x tickers,
+    dense numpy array or scipy.sparse.csr_matrix. Indexing and iteration give Portfolio views of the rows
+    """
+    __slots__ = ('tickers', 'cash', 'holdings')
+
+    def __init__(self,
+                 tickers: pd.Index,
+                 cash: np.ndarray,
+                 holdings: Union[np.ndarray, sp.csr_matrix]):
+        """
+        :param tickers: columns of holdings
+        :param cash: cash of every portfolio
+        :param holdings: number of shares of every ticker in every portfolio
+        """
+        self.tickers = pd.Index(tickers)
+        self.cash = np.asarray(cash, dtype=np.float64)
+        self.holdings = holdings
+
+    @classmethod
+    def from_portfolios(cls,
+                        portfolios: list[Portfolio],
+                        tickers: Optional[pd.Index] = None,
+                        sparse: bool = True) -> 'PortfolioHistory':
+        """
+        :param tickers: columns of the holdings matrix, union of portfolio tickers if not provided,
+        shares of other tickers are dropped
+        """
+        if tickers is None:
+            tickers = pd.Index(list(dict.fromkeys(ticker for portfolio in portfolios
+                                                  for ticker in portfolio.shares.index)))
+        holdings = np.zeros((len(portfolios), len(tickers)))
+        for row, portfolio in enumerate(portfolios):
+            columns = tickers.get_indexer(portfolio.shares.index)
+            holdings[row, columns[columns >= 0]] = portfolio.shares.to_numpy(dtype=np.float64)[columns >= 0]
+        return cls(tickers,
+                   np.array([portfolio.cash for portfolio in portfolios], dtype=np.float64),
+                   sp.csr_matrix(holdings) if sparse else holdings)
+
+    def __len__(self) -> int:
+        return len(self.cash)
+
+    def positions(self, row: int) -> tuple[np.ndarray, np.ndarray]:
+        """:return: columns of held tickers in ascending order, their number of shares"""
+        if sp.issparse(self.holdings):
+            holdings_row = self.holdings.getrow(row)
+            columns, shares = holdings_row.indices, holdings_row.data
+            order = np.argsort(columns)
+            return columns[order], shares[order]
+        columns = np.flatnonzero(self.holdings[row])
+        return columns, self.holdings[row, columns]
+
+    def __getitem__(self, row: Union[int, slice]) -> Union[Portfolio, 'PortfolioHistory']:
+        """:return: portfolio of the row, PortfolioHistory of the portfolios of a slice, as slices of a list"""
+        if isinstance(row, slice):
+            return PortfolioHistory(self.tickers, self.cash[row], self.holdings[row])
+        if not -len(self) <= row < len(self):
+            raise IndexError(f'portfolio {row} is out of range of {len(self)} portfolios')
+        if row < 0:
+            row += len(self)
+        columns, shares = self.positions(row)
+        return Portfolio(self.cash[row], pd.Series(shares, index=self.tickers[columns], dtype=np.float64))
+
+    def __iter__(self) -> Iterator[Portfolio]:
+        return (self[row] for row in range(len(self)))
+
+    def dense_holdings(self) -> np.ndarray:
+        return self.holdings.toarray() if sp.issparse(self.holdings) else self.holdings
+
+    def values(self, prices: np.ndarray) -> np.ndarray:
+        """
+        :param prices: rebalances x tickers prices aligned with holdings, NaN prices add no value
+        :return: cash + shares value of every portfolio
+        """
+        with np.errstate(invalid='ignore'):
+            return self.cash + np.nansum(self.dense_holdings() * prices, axis=1)
+
+
+class SharesOutstandingHistory:
+    """
+    Point-in-time shares outstanding: dates x tickers sparse table with a value on the dates the count changed.
+    As-of lookups of all tickers are one searchsorted over the stored values, O(tickers) per date
+    """
+
+    def __init__(self, table: pd.DataFrame):
+        """:param table: dates x tickers shares outstanding, NaN where the count is not reported"""
+        table = table.sort_index()
+        self.dates = pd.DatetimeIndex(table.index)
+        self.tickers = table.columns
+        values = table.to_numpy(dtype=np.float64)
+        rows, columns = np.nonzero(~np.isnan(values))
+        self.table = sp.csc_matrix((values[rows, columns], (rows, columns)), shape=values.shape)
+        self.table.sort_indices()
+        # values are stored column by column in date order, key = column * dates + row is increasing
+        self._keys = (np.repeat(np.arange(len(self.tickers), dtype=np.int64), np.diff(self.table.indptr))
+                      * len(self.dates) + self.table.indices)
+
+    @classmethod
+    def from_records(cls, records: pd.DataFrame) -> 'SharesOutstandingHistory':
+        """:param records: columns 'date', 'ticker', 'sharesOutstanding', one row per reported count"""
+        return cls(records.pivot_table(index=pd.to_datetime(records['date']), columns='ticker',
+                                       values='sharesOutstanding', aggfunc='last'))
+
+    def as_of_rows(self, dates: pd.DatetimeIndex, columns: np.ndarray) -> np.ndarray:
+        """:return: dates x columns last reported counts not after each date, NaN if there is none"""
+        rows = self.dates.searchsorted(dates, side='right') - 1
+        queries = columns[None, :] * len(self.dates) + rows[:, None]
+        positions = np.searchsorted(self._keys, queries, side='right') - 1
+        known = (rows[:, None] >= 0) & (columns[None, :] >= 0) & (positions >= self.table.indptr[columns][None, :])
+        return np.where(known, self.table.data[np.maximum(positions, 0)], np.nan)
+
+    def as_of(self, date, default: Optional[pd.Series] = None) -> pd.Series:
+        """
+        :param default: counts of tickers without a report before date, i.e. static SharesHistory.shares_outstanding
+        :return: last reported counts not after date, indexed as default if provided, as tickers otherwise
+        """
+        tickers = self.tickers if default is None else default.index
+        counts = self.as_of_rows(pd.DatetimeIndex([date]), self.tickers.get_indexer(tickers))[0]
+        if default is not None:
+            counts = np.where(np.isnan(counts), default.to_numpy(dtype=np.float64), counts)
+        return pd.Series(counts, index=tickers)
+
+
+def window_shares_outstanding(shares_outstanding: pd.Series,
+                              shares_outstanding_history: Optional[SharesOutstandingHistory],
+                              window_dates: pd.Index) -> pd.Series:
+    """:return: shares outstanding as of the last date of a price window, static ones without history"""
+    if shares_outstanding_history is None or len(window_dates) == 0:
+        return shares_outstanding
+    return shares_outstanding_history.as_of(window_dates[-1], shares_outstanding)
+
+
 @dataclass
 class SharesHistory:
     # DataFrame with Date as index, ticker as column name and ticker price as value
@@ -41,3 +186,11 @@ class SharesHistory:
     volume_history: pd.DataFrame
     # DataSeries with ticker as index, adjusted shares outstanding as value
     shares_outstanding: pd.Series
+    # counts reported over time, shares_outstanding is used before the first report of a ticker
+    shares_outstanding_history: Optional[SharesOutstandingHistory] = None
+
+    def shares_outstanding_at(self, date) -> pd.Series:
+        """:return: shares outstanding known at date, static shares_outstanding without history"""
+        if self.shares_outstanding_history is None:
+            return self.shares_outstanding
+        return self.shares_outstanding_history.as_of(date, self.shares_outstanding)
@@ -0,0 +1,295 @@
+import datetime
+import functools
+from dataclasses import dataclass, field
+from functools import cached_property
+from typing import Callable, Iterator, Optional
+
+import numpy as np
+import pandas as pd
+
+from pypoanal import profiling
+from pypoanal.assets import SharesHistory, SharesOutstandingHistory, window_shares_outstanding
+from pypoanal.liquidity import LiquidityIndex
+from pypoanal.pricestore import PriceVolumeStore
+
+
+@dataclass
+class BacktestPeriod:
+    start_date: datetime.date
+    end_date: datetime.date
+    # positions of prices_sample rows in the price history
+    rows: slice
+    # tickers traded often enough during the period, see LiquidityIndex.liquid_tickers
+    liquid_tickers: list[str]
+    # forward filled prices of all tickers at end_date, portfolio is rebalanced at these prices
+    prices_at_end: pd.Series
+    # shares outstanding as of the last day of prices_sample, input of portfolio weights calculators
+    shares_outstanding: pd.Series
+    # returns a new copy of prices_sample on every call
+    read_prices_sample: Callable[[], pd.DataFrame] = field(repr=False, compare=False)
+
+    @cached_property
+    def prices_sample(self) -> pd.DataFrame:
+        """
+        price history of liquid tickers from start_date to end_date, input of portfolio weights calculators.
+        Read on first use, so that plans of many backtests do not hold copies of all their windows
+        """
+        return self.read_prices_sample()
+
+    @cached_property
+    def returns(self) -> pd.DataFrame:
+        """daily returns of liquid tickers, as pypfopt.expected_returns.returns_from_prices"""
+        return self.prices_sample.pct_change().dropna(how='all')
+
+
+def _slice_window(price_history: pd.DataFrame, rows: slice, liquid_tickers: list[str]) -> pd.DataFrame:
+    return price_history.iloc[rows].loc[:, liquid_tickers]
+
+
+class BacktestPlan:
+    """
+    Inputs of every rebalance period, which do not depend on the weights calculator:
+    liquid tickers, price window and prices at the end of the period.
+    Computed once and shared by all calculators of a backtest, price windows are sliced on first use
+    """
+
+    def __init__(self,
+                 shares_history: SharesHistory,
+                 rebalance_dates: list[datetime.date],
+                 liquidity_index: Optional[LiquidityIndex] = None,
+                 forward_filled_price_history: Optional[pd.DataFrame] = None,
+                 profiler: Optional[profiling.NullProfiler] = None):
+        """
+        :param rebalance_dates: [2010-10-10,2011-10-10], first date --- start of the backtest
+        :param liquidity_index: LiquidityIndex of shares_history.volume_history, built if not provided
+        :param forward_filled_price_history: shares_history.price_history.fillna(method='ffill'),
+        computed if not provided, pass it to share between plans of the same history
+        :param profiler: records liquidity and slicing stages of every period
+        """
+        if profiler is None:
+            profiler = profiling.NULL_PROFILER
+        self.shares_history = shares_history
+        self.rebalance_dates = rebalance_dates
+        if liquidity_index is None:
+            liquidity_index = LiquidityIndex(shares_history.volume_history)
+        price_history = shares_history.price_history
+        if forward_filled_price_history is None:
+            # price history without NANs
+            forward_filled_price_history = price_history.fillna(method='ffill')
+        self.periods: list[BacktestPeriod] = []
+        first_row = forward_filled_price_history.index.get_slice_bound(rebalance_dates[0], 'right')
+        # forward filled prices at the first rebalance date, NaN if there are no prices before it
+        self._prices_at_start = (forward_filled_price_history.iloc[first_row - 1].to_numpy(dtype=np.float64)
+                                 if first_row > 0 else np.full(len(price_history.columns), np.nan))
+        for period_number, (sample_start_date, sample_end_date) in enumerate(zip(rebalance_dates[:-1],
+                                                                                 rebalance_dates[1:])):
+            with profiler.stage(profiling.LIQUIDITY, period_number):
+                liquid_tickers = liquidity_index.liquid_tickers(sample_start_date, sample_end_date)
+            with profiler.stage(profiling.SLICING, period_number):
+                rows = price_history.index.slice_indexer(sample_start_date, sample_end_date)
+                end_row = forward_filled_price_history.index.get_slice_bound(sample_end_date, 'right')
+                if end_row == 0:
+                    raise IndexError(f'no prices before {sample_end_date}')
+                self.periods.append(BacktestPeriod(
+                    start_date=sample_start_date,
+                    end_date=sample_end_date,
+                    rows=rows,
+                    liquid_tickers=liquid_tickers,
+                    prices_at_end=forward_filled_price_history.iloc[end_row - 1],
+                    shares_outstanding=window_shares_outstanding(shares_history.shares_outstanding,
+                                                                 shares_history.shares_outstanding_history,
+                                                                 price_history.index[rows]),
+                    read_prices_sample=functools.partial(_slice_window, price_history, rows, liquid_tickers)))
+
+    @property
+    def tickers(self) -> list[str]:
+        """liquid tickers of all periods, in order of first appearance"""
+        return list(dict.fromkeys(ticker for period in self.periods for ticker in period.liquid_tickers))
+
+    @property
+    def price_columns(self) -> pd.Index:
+        """all tickers of the price history, backtest portfolios are kept over these columns"""
+        return self.shares_history.price_history.columns
+
+    @property
+    def shares_outstanding(self) -> pd.Series:
+        """static shares outstanding, see BacktestPeriod.shares_outstanding for the counts of every period"""
+        return self.shares_history.shares_outstanding
+
+    @property
+    def prices_at_rebalance_dates(self) -> np.ndarray:
+        """rebalance dates x tickers forward filled prices, columns as in shares_history.price_history"""
+        return np.vstack([self._prices_at_start] +
+                         [period.prices_at_end.to_numpy(dtype=np.float64) for period in self.periods])
+
+    def batched_inputs(self) -> tuple[np.ndarray, np.ndarray, list[slice], np.ndarray]:
+        """
+        :return: inputs of portfolio_calculators.batched_calculator over price_columns:
+        shares outstanding (periods x tickers with a shares outstanding history), dates x tickers prices,
+        price window rows and liquid tickers mask of every period
+        """
+        price_history = self.shares_history.price_history
+        windows = [slice(*period.rows.indices(len(price_history))[:2]) for period in self.periods]
+        universes = np.zeros((len(self.periods), len(price_history.columns)), dtype=bool)
+        for period_number, period in enumerate(self.periods):
+            universes[period_number, price_history.columns.get_indexer(period.liquid_tickers)] = True
+        shares_outstanding = self.shares_outstanding.reindex(price_history.columns).to_numpy(dtype=np.float64)
+        shares_outstanding_history = self.shares_history.shares_outstanding_history
+        if shares_outstanding_history is not None:
+            # periods x tickers counts as of the last day of every window
+            window_ends = np.array([max(window.stop - 1, 0) for window in windows], dtype=np.int64)
+            counts = shares_outstanding_history.as_of_rows(
+                price_history.index[window_ends], shares_outstanding_history.tickers.get_indexer(price_history.columns))
+            known = ~np.isnan(counts) & np.array([window.stop > window.start for window in windows])[:, None]
+            shares_outstanding = np.where(known, counts, shares_outstanding)
+        return shares_outstanding, price_history.to_numpy(dtype=np.float64), windows, universes
+
+    def __len__(self) -> int:
+        return len(self.periods)
+
+    def __iter__(self) -> Iterator[BacktestPeriod]:
+        return iter(self.periods)
+
+
+class StreamingBacktestPlan:
+    """
+    Same periods as BacktestPlan(store.price_and_volume_histories(tickers), rebalance_dates),
+    read from the memory-mapped store instead of in-memory price and volume tables.
+    Periods are built one at a time while iterating: only the rows of the window and the liquid tickers are read,
+    so peak memory is bounded by window size x liquid universe, not by the whole history.
+    Liquid tickers and forward filled prices are computed by passes over the store in chunks of rows and columns
+    """
+
+    def __init__(self,
+                 store: PriceVolumeStore,
+                 shares_outstanding: pd.Series,
+                 rebalance_dates: list[datetime.date],
+                 tickers: Optional[list[str]] = None,
+                 chunk_size: int = 512,
+                 min_volume=50,
+                 liquid_days_percent=90,
+                 profiler: Optional[profiling.NullProfiler] = None,
+                 shares_outstanding_history: Optional[SharesOutstandingHistory] = None):
+        """
+        :param tickers: tickers of the backtest, all tickers of the store if None
+        :param chunk_size: passes over the whole store read blocks of chunk_size rows x chunk_size columns
+        :param min_volume: see LiquidityIndex.liquid_tickers
+        :param liquid_days_percent: see LiquidityIndex.liquid_tickers
+        :param profiler: records liquidity stages while the plan is built and slicing stages while iterating
+        :param shares_outstanding_history: point-in-time counts, shares_outstanding is used before the first report
+        """
+        self.profiler = profiler if profiler is not None else profiling.NULL_PROFILER
+        self.store = store
+        self.rebalance_dates = rebalance_dates
+        self._shares_outstanding = shares_outstanding
+        self._shares_outstanding_history = shares_outstanding_history
+        self._columns, self._tickers = store._columns(tickers)
+        self.chunk_size = chunk_size
+        # dates where some of the tickers have data, as in PriceVolumeStore.price_and_volume_histories
+        self._store_rows = np.flatnonzero(self._rows_with_data())
+        self.dates = store.dates[self._store_rows]
+        self._rows = [self.dates.slice_indexer(start_date, end_date)
+                      for start_date, end_date in zip(rebalance_dates[:-1], rebalance_dates[1:])]
+        self._liquid_tickers = []
+        for period_number, rows in enumerate(self._rows):
+            with self.profiler.stage(profiling.LIQUIDITY, period_number):
+                self._liquid_tickers.append(self._liquid_tickers_of_rows(rows, min_volume, liquid_days_percent))
+        # positions in self.dates of the last trading day not after each rebalance date, -1 if there is none
+        self._end_rows = self.dates.searchsorted(pd.to_datetime(rebalance_dates), side='right') - 1
+        if (self._end_rows[1:] < 0).any():
+            raise IndexError(f'no prices before {rebalance_dates[1 + np.argmax(self._end_rows[1:] < 0)]}')
+
+    def _column_chunks(self) -> Iterator[slice]:
+        for start in range(0, len(self._columns), self.chunk_size):
+            yield slice(start, start + self.chunk_size)
+
+    @staticmethod
+    def _read(matrix: np.ndarray, store_rows: np.ndarray, columns: np.ndarray) -> np.ndarray:
+        """rows x columns block, only the requested columns of the rows range are copied from the memory map"""
+        if len(store_rows) == 0:
+            return np.empty((0, len(columns)))
+        rows_range = matrix[store_rows[0]:store_rows[-1] + 1]
+        return np.asarray(rows_range[:, columns], dtype=np.float64)[store_rows - store_rows[0]]
+
+    def _rows_with_data(self) -> np.ndarray:
+        has_data = np.zeros(len(self.store.dates), dtype=bool)
+        for start in range(0, len(has_data), self.chunk_size):
+            store_rows = np.arange(start, min(start + self.chunk_size, len(has_data)))
+            for chunk in self._column_chunks():
+                for matrix in (self.store.prices, self.store.volumes):
+                    has_data[store_rows] |= ~np.isnan(self._read(matrix, store_rows, self._columns[chunk])).all(axis=1)
+        return has_data
+
+    def _liquid_tickers_of_rows(self, rows: slice, min_volume: float, liquid_days_percent: float) -> list[str]:
+        """LiquidityIndex.liquid_tickers of the window rows, volumes are read in chunks of columns"""
+        store_rows = self._store_rows[rows]
+        required_liquid_trading_days = len(store_rows) * liquid_days_percent / 100.0
+        liquid = np.zeros(len(self._columns), dtype=bool)
+        for chunk in self._column_chunks():
+            volumes = self._read(self.store.volumes, store_rows, self._columns[chunk])
+            liquid[chunk] = (volumes > min_volume).sum(axis=0) > required_liquid_trading_days
+        return self._tickers[liquid].tolist()
+
+    def _forward_filled_prices(self) -> Iterator[np.ndarray]:
+        """forward filled prices of all tickers at every rebalance date, NaN if there are no prices before it"""
+        last_prices = np.full(len(self._columns), np.nan)
+        next_row = 0
+        for end_row in self._end_rows:
+            # forward filling is done on store rows, rows without data do not change it
+            stop = self._store_rows[end_row] + 1 if end_row >= 0 else 0
+            for start in range(next_row, stop, self.chunk_size):
+                store_rows = np.arange(start, min(start + self.chunk_size, stop))
+                for chunk in self._column_chunks():
+                    prices = self._read(self.store.prices, store_rows, self._columns[chunk])
+                    last_rows = np.where(~np.isnan(prices), np.arange(len(store_rows))[:, None], -1).max(axis=0)
+                    updated = np.flatnonzero(last_rows >= 0)
+                    last_prices[chunk][updated] = prices[last_rows[updated], updated]
+            next_row = max(next_row, stop)
+            yield last_prices.copy()
+
+    @property
+    def tickers(self) -> list[str]:
+        """liquid tickers of all periods, in order of first appearance"""
+        return list(dict.fromkeys(ticker for liquid_tickers in self._liquid_tickers for ticker in liquid_tickers))
+
+    @property
+    def price_columns(self) -> pd.Index:
+        """all tickers of the backtest, portfolios are kept over these columns"""
+        return self._tickers
+
+    @property
+    def shares_outstanding(self) -> pd.Series:
+        """static shares outstanding, see BacktestPeriod.shares_outstanding for the counts of every period"""
+        return self._shares_outstanding
+
+    @property
+    def prices_at_rebalance_dates(self) -> np.ndarray:
+        """rebalance dates x tickers forward filled prices, columns as in price_columns"""
+        return np.vstack(list(self._forward_filled_prices()))
+
+    def __len__(self) -> int:
+        return len(self._rows)
+
+    def __iter__(self) -> Iterator[BacktestPeriod]:
+        forward_filled_prices = self._forward_filled_prices()
+        # prices at the first rebalance date
+        next(forward_filled_prices)
+        for period_number, (sample_start_date, sample_end_date, rows, liquid_tickers, end_row) in enumerate(zip(
+                self.rebalance_dates[:-1], self.rebalance_dates[1:], self._rows, self._liquid_tickers,
+                self._end_rows[1:])):
+            with self.profiler.stage(profiling.SLICING, period_number):
+                liquid_columns = self._columns[self._tickers.get_indexer(liquid_tickers)]
+                prices_sample = pd.DataFrame(self._read(self.store.prices, self._store_rows[rows], liquid_columns),
+                                             index=self.dates[rows],
+                                             columns=pd.Index(liquid_tickers, dtype=object))
+                prices_at_end = pd.Series(next(forward_filled_prices), index=self._tickers, name=self.dates[end_row])
+            yield BacktestPeriod(start_date=sample_start_date,
+                                 end_date=sample_end_date,
+                                 rows=rows,
+                                 liquid_tickers=liquid_tickers,
+                                 prices_at_end=prices_at_end,
+                                 shares_outstanding=window_shares_outstanding(self._shares_outstanding,
+                                                                              self._shares_outstanding_history,
+                                                                              prices_sample.index),
+                                 # the window is already read, streaming periods are used one at a time
+                                 read_prices_sample=prices_sample.copy)
@@ -1,16 +1,17 @@
 import datetime
 import math
 import warnings
+from typing import Optional, Union
 
-from cvxpy import SolverError
-from pypfopt.exceptions import OptimizationError
-from scipy.sparse.linalg import ArpackNoConvergence
 import numpy as np
 import pandas as pd
-import tqdm
+import scipy.sparse as sp
 
-from pypoanal import portfolio_rebalancer, dataloader
-from pypoanal.assets import Portfolio, SharesHistory
+from pypoanal import portfolio_rebalancer, dataloader, parallel, profiling
+from pypoanal.assets import Portfolio, PortfolioHistory, SharesHistory, SharesWeights
+from pypoanal.backtest_plan import BacktestPeriod, BacktestPlan, StreamingBacktestPlan
+from pypoanal.covariance import CovarianceEngine
+from pypoanal.liquidity import LiquidityIndex
 import pypoanal.portfolio_calculators as pcalc
 
 
@@ -18,46 +19,118 @@ def reallocate_portfolio_periodically(compute_weights: pcalc.PortfolioWeightsCal
                                       rebalance_dates: list[datetime.date],
                                       initial_money: np.float64,
                                       fees_percent: np.float64,
-                                      shares_history: SharesHistory,
-                                      progress_bar=True) -> tuple[list[Portfolio], list[np.float64]]:
-    initial_portfolio = Portfolio(cash=initial_money)
-    portfolio_history = [initial_portfolio]
+                                      shares_history: Optional[SharesHistory],
+                                      progress_bar=True,
+                                      liquidity_index: Optional[LiquidityIndex] = None,
+                                      plan: Optional[Union[BacktestPlan, StreamingBacktestPlan]] = None,
+                                      precomputed_weights: Optional[list[Optional[SharesWeights]]] = None,
+                                      covariance_engine: Optional[CovarianceEngine] = None,
+                                      profiler: Optional[profiling.NullProfiler] = None,
+                                      calculator_name: Optional[str] = None
+                                      ) -> tuple[PortfolioHistory, list[np.float64]]:
+    """
+    :return: portfolio after every rebalance date, first one is the initial cash, and rebalance fees
+    :param plan: per-period inputs shared between calculators, built from shares_history if not provided.
+    With a StreamingBacktestPlan price windows are read from the store one period at a time,
+    shares_history is not used and may be None
+    :param precomputed_weights: weights for each period of the plan, None for periods where the calculator failed,
+    compute_weights is not called if provided, see parallel.compute_weights_in_processes.
+    Otherwise calculators with a batched version compute weights of all periods in one call,
+    see portfolio_calculators.batched_calculator
+    :param covariance_engine: rolling covariance of the plan windows,
+    passed as cov_matrix to calculators listed in covariance.COVARIANCE_KINDS
+    :param profiler: profiling.BacktestProfiler recording covariance, weights and rebalance stages of every period,
+    solver iterations and calculation errors, under calculator_name
+    """
+    if profiler is None:
+        profiler = profiling.NULL_PROFILER
+    if plan is None:
+        plan = BacktestPlan(shares_history, rebalance_dates, liquidity_index, profiler=profiler)
+    # portfolios are kept as cash and shares of every ticker of the price history
+    tickers = plan.price_columns
+    cash_history = np.empty(len(plan) + 1)
+    cash_history[0] = initial_money
+    holdings = np.zeros((len(plan) + 1, len(tickers)))
     fees_history = [np.float64(0.0)]
-    # parse price, volume, outstanding
-    price_history, volume_history, shares_outstanding = \
-        shares_history.price_history, shares_history.volume_history, shares_history.shares_outstanding
-    # price history without NANs
-    forward_filled_price_history = price_history.fillna(method='ffill')
     unallocated_dates = []
+    weights_matrix = None
+    if precomputed_weights is None:
+        weights_matrix = _batched_weights(compute_weights, plan, profiler, calculator_name)
+    import tqdm
     # backtest
-    for sample_start_date, sample_end_date in zip(
-            tqdm.tqdm(rebalance_dates[:-1], disable=not progress_bar),
-            rebalance_dates[1:]):  # tqdm(zip(,)) does not draw progress bar
-        # load previous values
-        old_portfolio = portfolio_history[-1]
-        # slice and prepare data
-        liquid_tickers: list[str] = choose_liquid_tickers(volume_history, sample_start_date,
-                                                          sample_end_date)
-        prices_sample_df = price_history.loc[sample_start_date:sample_end_date, liquid_tickers]
-        prices_at_sample_end = forward_filled_price_history[:sample_end_date].iloc[-1]
+    for period_number, period in enumerate(tqdm.tqdm(plan, disable=not progress_bar)):
         #     rebalance
-        try:
-            allocated_shares_weights = compute_weights(shares_outstanding, prices_sample_df)
-        except (SolverError, OptimizationError, ArpackNoConvergence, ValueError):
-            unallocated_dates.append(sample_start_date)
-            allocated_portfolio = old_portfolio
+        if weights_matrix is not None:
+            weights = weights_matrix[period_number]
+        else:
+            if precomputed_weights is not None:
+                allocated_shares_weights = precomputed_weights[period_number]
+            else:
+                try:
+                    cov_matrix = None
+                    if covariance_engine is not None:
+                        with profiler.stage(profiling.COVARIANCE, period_number, calculator_name):
+                            cov_matrix = covariance_engine.cov_matrix_for(compute_weights, period)
+                    with profiler.stage(profiling.WEIGHTS, period_number, calculator_name):
+                        allocated_shares_weights = _compute_period_weights(compute_weights, period, cov_matrix)
+                    if profiler.enabled:
+                        profiler.record_iterations(period_number, calculator_name,
+                                                   profiling.solver_iterations(compute_weights))
+                except pcalc.CALCULATION_ERRORS as error:
+                    profiler.record_failure(period_number, calculator_name, error)
+                    allocated_shares_weights = None
+            weights = (None if allocated_shares_weights is None
+                       else allocated_shares_weights.reindex(tickers).to_numpy(dtype=np.float64))
+        if weights is None:
+            unallocated_dates.append(period.start_date)
+            # keep the previous portfolio
+            holdings[period_number + 1] = holdings[period_number]
+            cash_history[period_number + 1] = cash_history[period_number]
             fees = 0
         else:
-            allocated_portfolio, fees = portfolio_rebalancer.reallocate_portfolio(old_portfolio,
-                                                                                  allocated_shares_weights,
-                                                                                  prices_at_sample_end,
-                                                                                  fees_percent=fees_percent)
-        # save
-        portfolio_history.append(allocated_portfolio)
+            with profiler.stage(profiling.REBALANCE, period_number, calculator_name):
+                shares, cash, fees = portfolio_rebalancer.rebalance_arrays(
+                    cash_history[period_number],
+                    holdings[period_number],
+                    weights,
+                    period.prices_at_end.to_numpy(dtype=np.float64),
+                    fees_percent=fees_percent)
+            holdings[period_number + 1] = shares
+            cash_history[period_number + 1] = cash
         fees_history.append(fees)
     if unallocated_dates:
         warnings.warn(f'could not allocate portfolio for the dates {unallocated_dates}')
-    return portfolio_history, fees_history
+    return PortfolioHistory(tickers, cash_history, sp.csr_matrix(holdings)), fees_history
+
+
+def _batched_weights(compute_weights: pcalc.PortfolioWeightsCalculator,
+                     plan: Union[BacktestPlan, StreamingBacktestPlan],
+                     profiler: profiling.NullProfiler,
+                     calculator_name: Optional[str]) -> Optional[np.ndarray]:
+    """
+    :return: periods x plan.price_columns weights computed in one call if compute_weights has a batched version,
+    see portfolio_calculators.batched_calculator. None otherwise, for streaming plans,
+    which do not keep the whole price history in memory, and if the batched call fails:
+    its error is recorded with period None and weights are computed period by period
+    """
+    compute_weights_batched = pcalc.batched_calculator(compute_weights)
+    if compute_weights_batched is None or not isinstance(plan, BacktestPlan):
+        return None
+    try:
+        # one weights stage for all periods
+        with profiler.stage(profiling.WEIGHTS, None, calculator_name):
+            return compute_weights_batched(*plan.batched_inputs())
+    except pcalc.CALCULATION_ERRORS as error:
+        profiler.record_failure(None, calculator_name, error)
+        return None
+
+
+def _compute_period_weights(compute_weights: pcalc.PortfolioWeightsCalculator,
+                            period: BacktestPeriod,
+                            cov_matrix: Optional[pd.DataFrame]) -> SharesWeights:
+    if cov_matrix is None:
+        return compute_weights(period.shares_outstanding, period.prices_sample)
+    return compute_weights(period.shares_outstanding, period.prices_sample, cov_matrix=cov_matrix)
 
 
 def compute_rebalance_dates(start_date: datetime.date,
@@ -69,11 +142,80 @@ def compute_rebalance_dates(start_date: datetime.date,
     return rebalance_dates
 
 
+def _prices_at_dates(forward_filled_price_history: pd.DataFrame, dates: list[datetime.date]) -> np.ndarray:
+    """dates x tickers prices at the last trading day not after each date, NaN if there is no such day"""
+    rows = forward_filled_price_history.index.searchsorted(pd.to_datetime(dates), side='right') - 1
+    prices = forward_filled_price_history.to_numpy(dtype=np.float64)[np.maximum(rows, 0)]
+    prices[rows < 0] = np.nan
+    return prices
+
+
 def portfolios_values_history(portfolio_history: list[tuple[datetime.date, Portfolio]],
-                              price_history: pd.DataFrame) -> list[np.float64]:
-    forward_filled_prices = price_history.fillna(method='ffill')
-    get_current_prices = lambda date: forward_filled_prices[:date].iloc[-1]
-    return [portfolio.value(get_current_prices(date)) for date, portfolio in portfolio_history]
+                              price_history: pd.DataFrame,
+                              forward_filled_price_history: Optional[pd.DataFrame] = None) -> list[np.float64]:
+    """
+    :param portfolio_history: [(date, portfolio at the date), ...]
+    :param forward_filled_price_history: price_history.fillna(method='ffill'), computed if not provided
+    :return: value of every portfolio at forward filled prices of its date
+    """
+    if forward_filled_price_history is None:
+        forward_filled_price_history = price_history.fillna(method='ffill')
+    history = PortfolioHistory.from_portfolios([portfolio for _, portfolio in portfolio_history],
+                                               forward_filled_price_history.columns,
+                                               sparse=False)
+    prices = _prices_at_dates(forward_filled_price_history, [date for date, _ in portfolio_history])
+    return list(history.values(prices))
+
+
+def daily_values_history(portfolio_history: PortfolioHistory,
+                         rebalance_dates: list[datetime.date],
+                         price_history: pd.DataFrame,
+                         end_date: Optional[datetime.date] = None,
+                         forward_filled_price_history: Optional[pd.DataFrame] = None) -> pd.Series:
+    """
+    Daily mark-to-market of a backtest: portfolio_history[k] is held from rebalance_dates[k]
+    until the next rebalance date. Each portfolio multiplies only the price columns of its tickers,
+    so the whole curve costs about one pass over the price matrix
+    :param end_date: last day of the curve, last rebalance date by default
+    :param forward_filled_price_history: price_history.fillna(method='ffill'), computed if not provided
+    :return: portfolio values in USD indexed with trading dates from the first rebalance date to end_date
+    """
+    if forward_filled_price_history is None:
+        forward_filled_price_history = price_history.fillna(method='ffill')
+    dates_index = forward_filled_price_history.index
+    first_row = dates_index.searchsorted(pd.Timestamp(rebalance_dates[0]))
+    stop_row = dates_index.searchsorted(pd.Timestamp(end_date or rebalance_dates[-1]), side='right')
+    # first trading day of every portfolio, a portfolio is replaced on the same day by the next one
+    start_rows = np.clip(dates_index.searchsorted(pd.to_datetime(rebalance_dates)), first_row, stop_row)
+    stop_rows = np.r_[start_rows[1:], stop_row]
+    prices = forward_filled_price_history.to_numpy(dtype=np.float64)
+    price_columns = forward_filled_price_history.columns.get_indexer(portfolio_history.tickers)
+    values = np.empty(max(stop_row - first_row, 0))
+    for row, (start, stop) in enumerate(zip(start_rows, stop_rows)):
+        if start >= stop:
+            continue
+        columns, shares = portfolio_history.positions(row)
+        columns = price_columns[columns]
+        # tickers without prices add no value
+        shares = shares[columns >= 0]
+        columns = columns[columns >= 0]
+        values[start - first_row:stop - first_row] = (portfolio_history.cash[row] +
+                                                      np.nansum(prices[start:stop, columns] * shares, axis=1))
+    return pd.Series(values, index=dates_index[first_row:stop_row])
+
+
+def daily_values_table(portfolio_history_per_calc: dict[str, PortfolioHistory],
+                       rebalance_dates: list[datetime.date],
+                       price_history: pd.DataFrame,
+                       end_date: Optional[datetime.date] = None) -> pd.DataFrame:
+    """
+    :param portfolio_history_per_calc: portfolios returned by compare_calculators_for_periodic_rebalance
+    :return: daily portfolio values in USD, indexed with trading dates, columns = calculators
+    """
+    forward_filled_price_history = price_history.fillna(method='ffill')
+    return pd.DataFrame({calc_name: daily_values_history(portfolio_history, rebalance_dates, price_history, end_date,
+                                                         forward_filled_price_history)
+                         for calc_name, portfolio_history in portfolio_history_per_calc.items()})
 
 
 def compare_calculators_for_periodic_rebalance(shares_weights_calculators: dict[str, pcalc.PortfolioWeightsCalculator],
@@ -82,13 +224,22 @@ def compare_calculators_for_periodic_rebalance(shares_weights_calculators: dict[
                                                rebalance_dates: list[datetime.date],
                                                fees_percent=np.float64(0.04),
                                                shares_history: SharesHistory = None,
-                                               progress_bar: bool = True) -> tuple[pd.DataFrame,
-                                                                                   pd.DataFrame,
-                                                                                   dict[str, list[Portfolio]]]:
+                                               progress_bar: bool = True,
+                                               max_workers: Optional[int] = None,
+                                               rolling_covariance: bool = False,
+                                               profiler: Optional[profiling.NullProfiler] = None
+                                               ) -> tuple[pd.DataFrame, pd.DataFrame, dict[str, PortfolioHistory]]:
     """
     :param tickers: list of used tickers
     :param shares_weights_calculators:
     :param rebalance_dates: [2010-10-10,2011-10-10], first date --- start of the backtest
+    :param max_workers: if set, weights of all calculators and periods are computed in a pool of max_workers
+    processes before the rebalance pass, results are the same as in serial mode
+    :param rolling_covariance: covariance based calculators get covariance matrices
+    from a rolling covariance.CovarianceEngine instead of estimating them on every window,
+    serial mode only: ValueError is raised if max_workers is also set
+    :param profiler: profiling.BacktestProfiler recording timings of the plan and of every period and calculator,
+    weights computed in processes are not profiled
     :return: table of portfolio values in USD (shares + cash),
     indexed with Dates, columns = calculators = 'MCAP', 'equal', 'exp_cov'
     :return: table of rebalance fees in USD,
@@ -96,6 +247,8 @@ def compare_calculators_for_periodic_rebalance(shares_weights_calculators: dict[
     :return: portfolios_history over time
     example {'MCAP': [(100.0,{'GOOG':1.0, 'AMZN': 1.0}), (10.12,{'GOOG':2.0, 'AMZN': 2.0})], 'equal':[]}
     """
+    if rolling_covariance and max_workers is not None:
+        raise ValueError('rolling_covariance is computed in this process, it can not be used with max_workers')
     # load data
     if not shares_history:
         shares_history = dataloader.load_shares_history(set(tickers))
@@ -103,20 +256,31 @@ def compare_calculators_for_periodic_rebalance(shares_weights_calculators: dict[
     values_history_per_calc = pd.DataFrame(index=rebalance_dates)
     fees_history_per_calc = pd.DataFrame(index=rebalance_dates)
     portfolio_history_per_calc = dict()
+    # liquid tickers, price windows and prices at rebalance dates are the same for all calculators
+    plan = BacktestPlan(shares_history, rebalance_dates, profiler=profiler)
+    weights_per_calc = dict()
+    covariance_engine = CovarianceEngine(plan) if rolling_covariance else None
+    if max_workers is not None:
+        weights_per_calc = parallel.compute_weights_in_processes(shares_weights_calculators, plan, max_workers)
     for calc_name, compute_weight in shares_weights_calculators.items():
         # init history
         print(calc_name)
+        precomputed_weights = weights_per_calc.get(calc_name)
         portfolios, fees_history = reallocate_portfolio_periodically(compute_weight,
                                                                      rebalance_dates,
                                                                      initial_cash,
                                                                      fees_percent,
                                                                      shares_history,
-                                                                     progress_bar)
+                                                                     progress_bar,
+                                                                     plan=plan,
+                                                                     precomputed_weights=precomputed_weights,
+                                                                     covariance_engine=covariance_engine,
+                                                                     profiler=profiler,
+                                                                     calculator_name=calc_name)
         # save to dataframes
         portfolio_history_per_calc[calc_name] = portfolios
         fees_history_per_calc[calc_name] = fees_history
-        values_history_per_calc[calc_name] = portfolios_values_history(list(zip(rebalance_dates, portfolios)),
-                                                                       shares_history.price_history)
+        values_history_per_calc[calc_name] = portfolios.values(plan.prices_at_rebalance_dates)
     return values_history_per_calc, fees_history_per_calc, portfolio_history_per_calc
 
 
@@ -131,12 +295,6 @@ def choose_liquid_tickers(volumes_history: pd.DataFrame,
      :param liquid_days_percent: minimal percent of days when ticker was trading
      :param min_volume: USD volume
      :param volumes_history: trading volumes. DataFrame indexed with trading dates. Each column corresponds to a ticker
+     To choose tickers for many periods, build LiquidityIndex once and query it
      """
-    trading_days_in_period = len(volumes_history[start_date:end_date])
-    required_liquid_trading_days = trading_days_in_period * liquid_days_percent / 100.0
-    volumes_sample = volumes_history.loc[start_date:end_date, :]
-    # for each ticker compute number of days for which volume was higher that MIN_VOLUME
-    liquid_trading_days = volumes_sample.apply(lambda x: len(x.loc[x > min_volume]), axis=0)
-    # choose tickers for which number of liquid days is more than required
-    liquid_tickers = liquid_trading_days[liquid_trading_days > required_liquid_trading_days].index.tolist()
-    return liquid_tickers
+    return LiquidityIndex(volumes_history).liquid_tickers(start_date, end_date, min_volume, liquid_days_percent)
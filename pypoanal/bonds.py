@@ -0,0 +1,232 @@
+import datetime
+import json
+from dataclasses import dataclass
+from typing import Optional, Union
+
+import numpy as np
+import pandas as pd
+
+TAX_RATE = 13 / 100.0
+BROKER_COMMISSION = 0.04 / 100
+FACE_PERCENT = 100.0
+# coupons of bonds without maturity (consols) are counted for this many years
+CONSOL_YEARS = 100
+DAYS_IN_YEAR = 365.0
+# MOEX ISS names of the board columns -> names used here, as in moex_analyze_bonds.ipynb
+_ISS_COLUMNS = {'NEXTCOUPON': 'COUPONDATE', 'PREVPRICE': 'PRICEP'}
+
+
+def per_period_rate_percent(effective_interest_rate: Union[float, np.ndarray],
+                            times_a_year: Union[float, np.ndarray]) -> Union[float, np.ndarray]:
+    """
+    :param effective_interest_rate: annual effective interest rate, %
+    :param times_a_year: number of compounding periods
+    :return: per-period rate ppr, %, (1+ppr)^times_a_year = 1+eir
+    """
+    return (np.power(1 + np.asarray(effective_interest_rate) / 100, 1 / np.asarray(times_a_year)) - 1) * 100
+
+
+def eir_to_apr(eir: Union[float, np.ndarray], n: Union[float, np.ndarray]) -> Union[float, np.ndarray]:
+    """
+    :param eir: effective interest rate (annual), %
+    :param n: number of compounding periods
+    :return: nominal annual percentage rate apr without compounding, (1+apr/n)^n = 1+eir
+    """
+    return per_period_rate_percent(eir, n) * n
+
+
+def load_board(path: str) -> pd.DataFrame:
+    """
+    Bonds of a board saved from MOEX ISS, i.e.
+    https://iss.moex.com/iss/engines/stock/markets/bonds/boards/TQOB/securities.json, or a csv with the same columns.
+    ISS columns are renamed: NEXTCOUPON -> COUPONDATE, PREVPRICE -> PRICEP, coupon period in days ->
+    COUPONFREQUENCY. Missing dates ('0000-00-00') become NaT
+    :return: one row per bond indexed by SECID, columns PRICEP (% of face value), COUPONPERCENT, COUPONFREQUENCY,
+    COUPONDATE (next coupon), MATDATE (NaT for consols)
+    """
+    if path.endswith('.json'):
+        with open(path) as board_file:
+            securities = json.load(board_file)['securities']
+        board = pd.DataFrame(securities['data'], columns=securities['columns'])
+    else:
+        board = pd.read_csv(path)
+    board = board.rename(columns=_ISS_COLUMNS).set_index('SECID')
+    if 'COUPONFREQUENCY' not in board.columns:
+        # zero coupon bonds have no coupon period
+        board['COUPONFREQUENCY'] = np.round(DAYS_IN_YEAR / board['COUPONPERIOD'].where(board['COUPONPERIOD'] > 0))
+    for column in ('COUPONDATE', 'MATDATE'):
+        board[column] = pd.to_datetime(board[column], errors='coerce')
+    return board
+
+
+@dataclass
+class BondCashflows:
+    """
+    Cashflows of many bonds as padded bonds x flows arrays, flows of a bond are (date, amount, tax),
+    amounts and taxes are in % of face value. Padding has mask False
+    """
+    secids: pd.Index
+    # midnight of the valuation day, days are counted from it
+    valuation_date: datetime.datetime
+    # days from valuation_date to each flow
+    days: np.ndarray
+    amounts: np.ndarray
+    taxes: np.ndarray
+    mask: np.ndarray
+
+    def to_frame(self) -> pd.DataFrame:
+        """:return: one row per flow, columns secid, date, amount, tax"""
+        bonds, flows = np.nonzero(self.mask)
+        return pd.DataFrame({'secid': self.secids[bonds],
+                             'date': pd.Timestamp(self.valuation_date) + pd.to_timedelta(self.days[bonds, flows],
+                                                                                         unit='D'),
+                             'amount': self.amounts[bonds, flows],
+                             'tax': self.taxes[bonds, flows]})
+
+
+def _days_since(dates: pd.Series, date: datetime.datetime) -> np.ndarray:
+    """:return: days from date to dates, NaN for NaT"""
+    return ((pd.to_datetime(dates) - pd.Timestamp(date)) / pd.Timedelta(days=1)).to_numpy(dtype=np.float64)
+
+
+def accrued_coupon(coupon: np.ndarray, times_a_year: np.ndarray, days_to_coupon: np.ndarray) -> np.ndarray:
+    """
+    :param coupon: coupon of one period, % of face value
+    :param days_to_coupon: whole days to the next coupon
+    :return: accrued coupon interest
+    """
+    return coupon * (1 - days_to_coupon / (DAYS_IN_YEAR / times_a_year))
+
+
+def simple_bond_cashflows(board: pd.DataFrame, now: Optional[datetime.datetime] = None) -> BondCashflows:
+    """
+    Cashflows of buying every bond of the board now, with taxes and broker commissions:
+    the bond and its accrued coupon are paid tomorrow (T+1 settlement), coupons are received
+    every 365 / COUPONFREQUENCY days from COUPONDATE until maturity, then the face value is repaid.
+    Coupons are taxed, the discount to face value is taxed if the bond matures within 3 years.
+    Bonds without maturity get CONSOL_YEARS of coupons, bonds without price have no flows
+    :param board: see load_board
+    :param now: time of purchase, datetime.datetime.now() if None
+    """
+    if now is None:
+        now = datetime.datetime.now()
+    valuation_date = datetime.datetime.combine(now.date(), datetime.time())
+    price = board['PRICEP'].to_numpy(dtype=np.float64)
+    times_a_year = board['COUPONFREQUENCY'].to_numpy(dtype=np.float64)
+    coupon = board['COUPONPERCENT'].to_numpy(dtype=np.float64) / times_a_year
+    coupon_days = _days_since(board['COUPONDATE'], valuation_date)
+    maturity_days = _days_since(board['MATDATE'], valuation_date)
+    priced = ~np.isnan(price)
+    has_coupons = priced & ~np.isnan(coupon_days)
+    has_maturity = priced & ~np.isnan(maturity_days)
+    tomorrow_days = (now - valuation_date) / datetime.timedelta(days=1) + 1
+    with np.errstate(invalid='ignore'):
+        coupon_period = DAYS_IN_YEAR / times_a_year
+        # coupons are paid while at least a whole day is left to maturity
+        n_coupons = np.where(has_maturity, np.floor((maturity_days - coupon_days - 1) / coupon_period) + 1,
+                             CONSOL_YEARS * np.floor(times_a_year))
+        n_coupons = np.where(has_coupons, np.clip(np.nan_to_num(n_coupons), 0, CONSOL_YEARS * np.floor(times_a_year)),
+                             0).astype(np.int64)
+    n_flows = 3 + n_coupons.max(initial=0)
+    shape = (len(board), n_flows)
+    days, amounts, taxes = np.zeros(shape), np.zeros(shape), np.zeros(shape)
+    mask = np.zeros(shape, dtype=bool)
+    # purchase
+    days[:, 0] = tomorrow_days
+    amounts[:, 0] = -price * (1 + BROKER_COMMISSION)
+    mask[:, 0] = priced
+    # accrued coupon paid to the seller
+    days[:, 1] = tomorrow_days
+    amounts[:, 1] = -accrued_coupon(coupon, times_a_year, np.floor(coupon_days - tomorrow_days + 1)) * (
+            1 + BROKER_COMMISSION)
+    mask[:, 1] = has_coupons
+    # coupons
+    coupon_numbers = np.arange(n_flows - 3)
+    days[:, 2:-1] = coupon_days[:, None] + coupon_numbers[None, :] * coupon_period[:, None]
+    amounts[:, 2:-1] = (coupon * (1 - BROKER_COMMISSION))[:, None]
+    taxes[:, 2:-1] = (coupon * TAX_RATE)[:, None]
+    mask[:, 2:-1] = coupon_numbers[None, :] < n_coupons[:, None]
+    # face value
+    days[:, -1] = maturity_days
+    amounts[:, -1] = FACE_PERCENT * (1 - BROKER_COMMISSION)
+    taxed_discount = (FACE_PERCENT > price) & (np.floor(maturity_days - tomorrow_days) < 3 * DAYS_IN_YEAR)
+    taxes[:, -1] = np.where(taxed_discount, (FACE_PERCENT - price) * TAX_RATE, 0.0)
+    mask[:, -1] = has_maturity
+    for values in (days, amounts, taxes):
+        values[~mask] = 0.0
+    return BondCashflows(board.index, valuation_date, days, amounts, taxes, mask)
+
+
+def _discounted_flows(cashflows: BondCashflows, count_tax: bool) -> tuple[np.ndarray, np.ndarray]:
+    """:return: net amounts of the flows not before the valuation date, 0 for others, their time in years"""
+    cash = cashflows.amounts - cashflows.taxes if count_tax else cashflows.amounts
+    # flows are discounted over whole days, flows before the valuation date are ignored
+    whole_days = np.floor(cashflows.days)
+    cash = np.where(cashflows.mask & (whole_days >= 0), cash, 0.0)
+    return cash, np.maximum(whole_days, 0) / DAYS_IN_YEAR
+
+
+def npv(cashflows: BondCashflows,
+        eirp: Union[float, np.ndarray],
+        count_tax: bool = True) -> np.ndarray:
+    """
+    :param eirp: effective annual percent rate, e.g. 5.0 = 5% a year, one for all bonds or one per bond
+    :return: net present value of every bond, % of face value, NaN for bonds without flows
+    """
+    cash, years = _discounted_flows(cashflows, count_tax)
+    discount = 1 + np.broadcast_to(np.asarray(eirp, dtype=np.float64), (len(cash),)) / 100
+    values = (cash * np.power(discount[:, None], -years)).sum(axis=1)
+    return np.where(cashflows.mask.any(axis=1), values, np.nan)
+
+
+def effective_yield(cashflows: BondCashflows,
+                    count_tax: bool = True,
+                    low: float = -99.0,
+                    high: float = 1000.0,
+                    initial: float = 10.0,
+                    tolerance: float = 1e-10,
+                    max_iterations: int = 100) -> np.ndarray:
+    """
+    Effective annual rate making the npv of every bond zero, found for all bonds at once by Newton steps.
+    Bisection steps are taken when a Newton step leaves the bracket of the root or does not halve it
+    :param low: lowest rate, %
+    :param high: highest rate, %
+    :param initial: rate of the first Newton step, %
+    :return: rate of every bond in %, NaN if npv does not change sign between low and high
+    """
+    cash, years = _discounted_flows(cashflows, count_tax)
+
+    def npv_and_derivative(rows: np.ndarray, rates: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+        discounted = cash[rows] * np.exp(-years[rows] * np.log1p(rates / 100)[:, None])
+        return discounted.sum(axis=1), (-years[rows] * discounted).sum(axis=1) / (100 + rates)
+
+    all_bonds = np.arange(len(cash))
+    # npv of long bonds overflows near -100%, the sign is still right
+    with np.errstate(over='ignore', invalid='ignore'):
+        npv_low, _ = npv_and_derivative(all_bonds, np.full(len(cash), low))
+        npv_high, _ = npv_and_derivative(all_bonds, np.full(len(cash), high))
+    solvable = cashflows.mask.any(axis=1) & (np.sign(npv_low) * np.sign(npv_high) <= 0)
+    result = np.full(len(cash), np.nan)
+    # only bonds which have not converged yet are iterated
+    active = np.flatnonzero(solvable)
+    lows, highs = np.full(len(active), low), np.full(len(active), high)
+    sign_low = np.sign(npv_low[active])
+    rates = np.full(len(active), np.clip(initial, low, high))
+    for _ in range(max_iterations):
+        with np.errstate(over='ignore', divide='ignore', invalid='ignore'):
+            values, derivatives = npv_and_derivative(active, rates)
+            newton_rates = rates - values / derivatives
+        # keep the root between lows and highs
+        below_root = np.sign(values) == sign_low
+        previous_width = highs - lows
+        lows = np.where(below_root, rates, lows)
+        highs = np.where(below_root, highs, rates)
+        fast = (newton_rates > lows) & (newton_rates < highs) & (np.abs(newton_rates - rates) < previous_width / 2)
+        new_rates = np.where(fast, newton_rates, (lows + highs) / 2)
+        converged = np.abs(new_rates - rates) < tolerance
+        result[active] = new_rates
+        left = ~converged
+        active, lows, highs, sign_low, rates = active[left], lows[left], highs[left], sign_low[left], new_rates[left]
+        if len(active) == 0:
+            break
+    return result
@@ -0,0 +1,361 @@
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Iterator, Optional, Union
+
+import numpy as np
+import pandas as pd
+
+import pypoanal.portfolio_calculators as pcalc
+from pypoanal.backtest_plan import BacktestPeriod, BacktestPlan
+
+
+class _RollingSums(ABC):
+    """
+    Sums over the rows of a window of a returns matrix and over the columns of its tickers,
+    kept up to date when the window slides: rows entering the window are added, rows leaving it are subtracted,
+    so moving the window costs O(changed rows * tickers^2) instead of O(window rows * tickers^2).
+    Sums are recomputed when the tickers change or when more rows leave the window than stay in it,
+    as for consecutive rebalance windows, which share almost no rows
+    """
+
+    def __init__(self, returns: np.ndarray):
+        """:param returns: dates x tickers daily returns, NaN where unknown"""
+        self.valid = (~np.isnan(returns)).astype(np.float64)
+        self.returns = np.nan_to_num(returns)
+        # columns of returns the sums are kept for
+        self.columns = np.arange(0)
+        self.start = 0
+        self.stop = 0
+        self._reset()
+
+    @abstractmethod
+    def _reset(self) -> None:
+        """sets the sums of an empty window of self.columns"""
+
+    def _decay(self, n_rows: int) -> None:
+        """called before n_rows rows are appended to the window"""
+
+    @abstractmethod
+    def _add_values(self, rows: np.ndarray, x: np.ndarray, v: np.ndarray, sign: Union[float, np.ndarray]) -> None:
+        """
+        adds (sign=1) or subtracts (sign=-1) zero-filled returns x and known flags v of the given window rows,
+        x and v are rows x self.columns, sign is one for all rows or one per row
+        """
+
+    def _window_values(self, rows: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+        """:return: zero-filled returns and known flags of rows x self.columns"""
+        return self.returns[np.ix_(rows, self.columns)], self.valid[np.ix_(rows, self.columns)]
+
+    def move_to(self, start: int, stop: int, columns: np.ndarray) -> None:
+        """makes the sums cover rows [start, stop) of the given columns of returns"""
+        if (start < self.start or stop < self.stop or start - self.start >= self.stop - start
+                or not np.array_equal(columns, self.columns)):
+            # moving backwards, to other tickers, or most rows of the window leave it: recompute from scratch
+            self.columns = np.asarray(columns)
+            self._reset()
+            self.start = self.stop = start
+        if stop > self.stop:
+            self._decay(stop - self.stop)
+            self.stop, old_stop = stop, self.stop
+            rows = np.arange(old_stop, stop)
+            self._add_values(rows, *self._window_values(rows), 1.0)
+        if start > self.start:
+            rows = np.arange(self.start, start)
+            self._add_values(rows, *self._window_values(rows), -1.0)
+            self.start = start
+
+    @contextmanager
+    def replaced_rows(self, rows: np.ndarray, x: np.ndarray, v: np.ndarray) -> Iterator[None]:
+        """temporarily replaces zero-filled returns and known flags of rows x self.columns inside the window"""
+        x_old, v_old = self._window_values(rows)
+        # old values are subtracted and new ones added in one update
+        stacked_rows = np.concatenate([rows, rows])
+        stacked_x = np.vstack([x_old, x])
+        stacked_v = np.vstack([v_old, v])
+        sign = np.repeat([-1.0, 1.0], len(rows))
+        self._add_values(stacked_rows, stacked_x, stacked_v, sign)
+        try:
+            yield
+        finally:
+            self._add_values(stacked_rows, stacked_x, stacked_v, -sign)
+
+
+class RollingLedoitWolf(_RollingSums):
+    """
+    Ledoit-Wolf shrinkage to constant variance, as pypfopt.risk_models.CovarianceShrinkage(...).ledoit_wolf(),
+    computed from sums of x, x x^T, x^2 x^T and x^2 x^2^T of zero-filled returns
+    """
+
+    def _reset(self) -> None:
+        n_tickers = len(self.columns)
+        self.n_rows = 0
+        self.sum_x = np.zeros(n_tickers)
+        self.sum_xx = np.zeros((n_tickers, n_tickers))
+        self.sum_x2x = np.zeros((n_tickers, n_tickers))
+        self.sum_x2x2 = np.zeros((n_tickers, n_tickers))
+
+    def _add_values(self, rows: np.ndarray, x: np.ndarray, v: np.ndarray, sign: Union[float, np.ndarray]) -> None:
+        # rows where all returns are unknown are dropped, as in CovarianceShrinkage
+        known_rows = v.any(axis=1)
+        x = x[known_rows]
+        sign = np.broadcast_to(sign, known_rows.shape)[known_rows]
+        signed_x = sign[:, None] * x
+        x2 = x ** 2
+        signed_x2 = sign[:, None] * x2
+        self.n_rows += int(sign.sum())
+        self.sum_x += signed_x.sum(axis=0)
+        self.sum_xx += signed_x.T @ x
+        self.sum_x2x += signed_x2.T @ x
+        self.sum_x2x2 += signed_x2.T @ x2
+
+    def covariance(self, frequency: int = 252) -> np.ndarray:
+        """:return: annualised shrunk covariance of the returns of self.columns"""
+        n = self.n_rows
+        n_features = len(self.columns)
+        if n == 0 or n_features == 0:
+            raise ValueError('no returns in the window')
+        mean = self.sum_x / n
+        sum_x2 = np.diag(self.sum_xx)
+        # X^T X of centered returns
+        centered_xx = self.sum_xx - n * np.outer(mean, mean)
+        emp_cov = centered_xx / n
+        emp_cov_trace = np.diag(emp_cov)
+        mu = np.sum(emp_cov_trace) / n_features
+        # sum over t of (x_ti - m_i)^2 (x_tj - m_j)^2, expanded in raw sums
+        sum_x2x = self.sum_x2x
+        sum_x = self.sum_x
+        centered_x2x2 = (self.sum_x2x2
+                         - 2 * sum_x2x * mean[None, :]
+                         - 2 * sum_x2x.T * mean[:, None]
+                         + sum_x2[:, None] * mean[None, :] ** 2
+                         + sum_x2[None, :] * mean[:, None] ** 2
+                         + 4 * self.sum_xx * np.outer(mean, mean)
+                         - 2 * sum_x[:, None] * np.outer(mean, mean ** 2)
+                         - 2 * sum_x[None, :] * np.outer(mean ** 2, mean)
+                         + n * np.outer(mean ** 2, mean ** 2))
+        beta_ = np.sum(centered_x2x2)
+        delta_ = np.sum(centered_xx ** 2) / n ** 2
+        beta = 1.0 / (n_features * n) * (beta_ / n - delta_)
+        delta = (delta_ - 2.0 * mu * emp_cov_trace.sum() + n_features * mu ** 2) / n_features
+        beta = min(beta, delta)
+        shrinkage = 0 if beta == 0 else beta / delta
+        shrunk_cov = (1.0 - shrinkage) * emp_cov
+        shrunk_cov.flat[::n_features + 1] += shrinkage * mu
+        return shrunk_cov * frequency
+
+
+class RollingExpCovariance(_RollingSums):
+    """
+    Exponentially weighted covariance, as pypfopt.risk_models.exp_cov:
+    pairwise over dates where both returns are known, deviations from the unweighted mean of each ticker.
+    Weighted sums are kept relative to the last row of the window.
+    Rows are not dropped when all their returns are unknown, as exp_cov does, weights count every row of the window.
+    It gives the same weights: returns are computed from forward filled prices, so such rows can only precede
+    the first known return of the window, and market holidays inside it have zero returns in both
+    """
+
+    def __init__(self, returns: np.ndarray, span: float):
+        self.decay = 1.0 - 2.0 / (span + 1.0)
+        super().__init__(returns)
+
+    def _reset(self) -> None:
+        n_tickers = len(self.columns)
+        self.sum_x = np.zeros(n_tickers)
+        self.count = np.zeros(n_tickers)
+        # weighted sums of x_i x_j, x_i [j known] and [i known][j known]
+        self.weighted_xx = np.zeros((n_tickers, n_tickers))
+        self.weighted_xv = np.zeros((n_tickers, n_tickers))
+        self.weighted_vv = np.zeros((n_tickers, n_tickers))
+
+    def _decay(self, n_rows: int) -> None:
+        # weights of the rows already in the window decay
+        decay_old = self.decay ** n_rows
+        self.weighted_xx *= decay_old
+        self.weighted_xv *= decay_old
+        self.weighted_vv *= decay_old
+
+    def _add_values(self, rows: np.ndarray, x: np.ndarray, v: np.ndarray, sign: Union[float, np.ndarray]) -> None:
+        sign = np.broadcast_to(sign, rows.shape)
+        self.sum_x += sign @ x
+        self.count += sign @ v
+        weights = sign * self.decay ** (self.stop - 1 - rows).astype(np.float64)
+        weighted_x = weights[:, None] * x
+        weighted_v = weights[:, None] * v
+        self.weighted_xx += weighted_x.T @ x
+        self.weighted_xv += weighted_x.T @ v
+        self.weighted_vv += weighted_v.T @ v
+
+    def covariance(self, frequency: int = 252) -> np.ndarray:
+        """:return: annualised exponential covariance of the returns of self.columns"""
+        mean = self.sum_x / self.count
+        weighted_xv = self.weighted_xv
+        weighted_vv = self.weighted_vv
+        numerator = (self.weighted_xx
+                     - weighted_xv * mean[None, :]
+                     - weighted_xv.T * mean[:, None]
+                     + weighted_vv * np.outer(mean, mean))
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return numerator / weighted_vv * frequency
+
+
+class RollingSampleCovariance(_RollingSums):
+    """
+    Sample covariance, as DataFrame.cov() of the window returns:
+    pairwise over dates where both returns are known, deviations from the mean of these dates
+    """
+
+    def _reset(self) -> None:
+        n_tickers = len(self.columns)
+        # sums of x_i x_j, x_i [j known] and [i known][j known]
+        self.sum_xx = np.zeros((n_tickers, n_tickers))
+        self.sum_xv = np.zeros((n_tickers, n_tickers))
+        self.n_pairs = np.zeros((n_tickers, n_tickers))
+
+    def _add_values(self, rows: np.ndarray, x: np.ndarray, v: np.ndarray, sign: Union[float, np.ndarray]) -> None:
+        signed_x = np.reshape(sign, (-1, 1)) * x
+        self.sum_xx += signed_x.T @ x
+        self.sum_xv += signed_x.T @ v
+        self.n_pairs += (np.reshape(sign, (-1, 1)) * v).T @ v
+
+    def covariance(self, frequency: int = 252) -> np.ndarray:
+        """:return: annualised sample covariance of the returns of self.columns, NaN for pairs with < 2 dates"""
+        sum_xv = self.sum_xv
+        n_pairs = self.n_pairs
+        with np.errstate(invalid='ignore', divide='ignore'):
+            cov = (self.sum_xx - sum_xv * sum_xv.T / n_pairs) / (n_pairs - 1)
+        cov[n_pairs < 2] = np.nan
+        return cov * frequency
+
+
+class CovarianceEngine:
+    """
+    Covariance matrices of the price windows of a backtest plan, for calculators accepting a cov_matrix argument.
+    Daily returns are computed once for the union of liquid tickers,
+    rolling estimators are moved from window to window of the same tickers when the windows overlap by more than half,
+    i.e. windows of start dates sweeps, and recomputed otherwise, i.e. for consecutive rebalance windows.
+    Results match the pypfopt estimators applied to the price window
+    """
+
+    def __init__(self,
+                 plan: BacktestPlan,
+                 span: float = 179,
+                 frequency: int = 252,
+                 tickers: Optional[list[str]] = None,
+                 max_cached_bytes: int = 256 * 2 ** 20):
+        """
+        :param span: default span of the exponential covariance
+        :param frequency: default number of trading days per year
+        :param tickers: tickers of the price history with covariances, liquid tickers of the plan by default
+        :param max_cached_bytes: computed covariances are kept for calculators sharing them,
+        least recently used ones are evicted above this size
+        """
+        universe = plan.tickers if tickers is None else tickers
+        self.tickers = pd.Index(universe)
+        price_history = plan.shares_history.price_history[universe]
+        self._missing_prices = price_history.isna().to_numpy()
+        self._returns = price_history.pct_change().to_numpy(dtype=np.float64)
+        self.span = span
+        self.frequency = frequency
+        self.estimators = {'ledoit_wolf': RollingLedoitWolf(self._returns),
+                           'exp_cov': RollingExpCovariance(self._returns, span),
+                           'sample': RollingSampleCovariance(self._returns)}
+        # exponential covariances of other spans, created on first use
+        self._exp_cov_estimators: dict[float, RollingExpCovariance] = {span: self.estimators['exp_cov']}
+        self.max_cached_bytes = max_cached_bytes
+        self._cache: OrderedDict[tuple, pd.DataFrame] = OrderedDict()
+        self._cached_bytes = 0
+
+    def _estimator(self, kind: str, span: float) -> _RollingSums:
+        if kind != 'exp_cov':
+            return self.estimators[kind]
+        if span not in self._exp_cov_estimators:
+            self._exp_cov_estimators[span] = RollingExpCovariance(self._returns, span)
+        return self._exp_cov_estimators[span]
+
+    def covariance(self,
+                   kind: str,
+                   period: BacktestPeriod,
+                   span: Optional[float] = None,
+                   frequency: Optional[int] = None) -> pd.DataFrame:
+        """
+        :param kind: 'ledoit_wolf', 'exp_cov' or 'sample'
+        :param span: of 'exp_cov', self.span if None. Estimators of every span are kept and rolled separately
+        :param frequency: self.frequency if None, estimators are shared by all frequencies
+        :return: annualised covariance of the liquid tickers of the period,
+        made positive semidefinite as in pypfopt.risk_models except for the sample covariance
+        """
+        span = self.span if span is None else span
+        frequency = self.frequency if frequency is None else frequency
+        # returns of the window rows, the first row has no previous price inside the window
+        start, stop, _ = period.rows.indices(len(self._returns))
+        key = (kind, span if kind == 'exp_cov' else None, frequency, start, stop, tuple(period.liquid_tickers))
+        if key in self._cache:
+            self._cache.move_to_end(key)
+        else:
+            estimator = self._estimator(kind, span)
+            columns = self.tickers.get_indexer(period.liquid_tickers)
+            estimator.move_to(min(start + 1, stop), stop, columns)
+            with estimator.replaced_rows(*self._window_start_returns(start, stop, columns)):
+                cov_matrix = pd.DataFrame(estimator.covariance(frequency),
+                                          index=period.liquid_tickers,
+                                          columns=period.liquid_tickers)
+            if kind != 'sample':
+                from pypfopt import risk_models
+                cov_matrix = risk_models.fix_nonpositive_semidefinite(cov_matrix, fix_method='spectral')
+            self._put_in_cache(key, cov_matrix)
+        return self._cache[key]
+
+    def _put_in_cache(self, key: tuple, cov_matrix: pd.DataFrame) -> None:
+        """caches cov_matrix, evicting least recently used ones above max_cached_bytes, the last one is kept"""
+        self._cache[key] = cov_matrix
+        self._cached_bytes += cov_matrix.values.nbytes
+        while self._cached_bytes > self.max_cached_bytes and len(self._cache) > 1:
+            _, evicted = self._cache.popitem(last=False)
+            self._cached_bytes -= evicted.values.nbytes
+
+    def _window_start_returns(self,
+                              start: int,
+                              stop: int,
+                              columns: np.ndarray) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """
+        Returns are computed over the whole history, so a price missing at the start of the window
+        is forward filled from before the window. Inside the window alone there is no previous price:
+        returns of liquid tickers are unknown until the row after their first price in the window.
+        :return: rows to replace, their returns and known flags of the columns
+        """
+        leading_missing = np.logical_and.accumulate(self._missing_prices[start:stop - 1, columns], axis=0)
+        with_leading_missing = np.flatnonzero(leading_missing.any(axis=1))
+        rows = start + 1 + with_leading_missing
+        returns = self._returns[np.ix_(rows, columns)]
+        unknown = leading_missing[with_leading_missing] | np.isnan(returns)
+        return rows, np.where(unknown, 0.0, returns), (~unknown).astype(np.float64)
+
+    def cov_matrix_for(self,
+                       compute_weights: pcalc.PortfolioWeightsCalculator,
+                       period: BacktestPeriod,
+                       span: Optional[float] = None,
+                       frequency: Optional[int] = None) -> Optional[pd.DataFrame]:
+        """
+        :param span: see covariance, pass the hyperparameters the calculator is called with
+        :return: covariance used by compute_weights, None if it does not accept a precomputed one
+        """
+        kind = covariance_kind(compute_weights)
+        if kind is None:
+            return None
+        return self.covariance(kind, period, span, frequency)
+
+
+def covariance_kind(compute_weights: pcalc.PortfolioWeightsCalculator) -> Optional[str]:
+    """:return: covariance estimator of a calculator accepting a cov_matrix argument, None for other calculators"""
+    # calculator objects, i.e. optimizer_session.WarmStartedMinVolatility, declare their estimator
+    return COVARIANCE_KINDS.get(compute_weights, getattr(compute_weights, 'covariance_kind', None))
+
+
+# covariance estimator of calculators accepting a cov_matrix argument
+COVARIANCE_KINDS: dict[pcalc.PortfolioWeightsCalculator, str] = {
+    pcalc.compute_sharpie_weights: 'ledoit_wolf',
+    pcalc.compute_ledoitw_weights: 'ledoit_wolf',
+    pcalc.compute_expcov_weights: 'exp_cov',
+    pcalc.compute_native_hrp_weights: 'sample'
+}
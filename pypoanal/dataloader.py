@@ -1,21 +1,21 @@
+import datetime
 import warnings
-from typing import Optional
+from concurrent.futures import ThreadPoolExecutor
+from typing import Iterable, Optional
 
 import pandas as pd
-import yfinance as yf
 import os
-from yahoo_fin import stock_info as yfsi
-import tqdm
 import numpy as np
 
+from pypoanal import downloader, metadata, pricestore
 from pypoanal.assets import SharesHistory
 
-SHARES_INFO_FILEPATH = 'info/tickers_info.csv'
+SHARES_INFO_FILEPATH = metadata.TICKERS_INFO_FILEPATH
 DATA_DIR = 'priceVolData'
 
 
-def _price_vol_path(ticker: str) -> str:
-    return os.path.join(DATA_DIR, ticker + '.csv')
+def _price_vol_path(ticker: str, data_dir: Optional[str] = None) -> str:
+    return os.path.join(DATA_DIR if data_dir is None else data_dir, ticker + '.csv')
 
 
 def get_quote_type(ticker: str) -> Optional[str]:
@@ -27,6 +27,7 @@ def get_quote_type(ticker: str) -> Optional[str]:
     :return: None if there is no data or 'ETF' or 'EQUITY' or 'MUTUAL FUND',
     etc.
     """
+    from yahoo_fin import stock_info as yfsi
     try:
         quote_type = yfsi.get_quote_data(ticker).get('quoteType', None)
         return quote_type
@@ -34,43 +35,89 @@ def get_quote_type(ticker: str) -> Optional[str]:
         return None
 
 
-def _download_price_volume_history(ticker: str, show_errors=True) -> pd.DataFrame:
+def _download_price_volume_history(ticker: str,
+                                   show_errors=True,
+                                   start_date: Optional[datetime.date] = None) -> pd.DataFrame:
     """ Downloads ticker Adj Price and Volume history from Yahoo Finance
     Returns the corresponding pandas DataFrame object
+    Uses yf.Ticker instead of yf.download, which keeps shared state and is not safe to call from several threads
     :param ticker: 'MSFT' or 'GOOG', etc...
+    :param start_date: first date to download, the whole history by default
     :return: dataframe with Date as index and two columns:
     adjusted price, volume
     """
-    price_volume_history = yf.download([ticker], period="max", progress=False, show_errors=show_errors, threads=False)
-    return price_volume_history.drop(["Close", "Open", "Low", "High"], axis=1).dropna(how="all")
+    import yfinance as yf
+    if start_date is None:
+        period_kwargs = {'period': 'max'}
+    else:
+        period_kwargs = {'start': start_date}
+    price_volume_history = yf.Ticker(ticker).history(**period_kwargs, auto_adjust=False, actions=False,
+                                                     debug=show_errors)
+    return price_volume_history[['Adj Close', 'Volume']].dropna(how="all")
 
 
-def download_and_save_price_history(tickers_to_download: list[str]) -> list[str]:
+def download_and_save_price_history(tickers_to_download: list[str],
+                                    fetch: Optional[downloader.PriceFetcher] = None,
+                                    max_workers: int = 8,
+                                    checkpoint_path: Optional[str] = None,
+                                    manifest_path: Optional[str] = None,
+                                    **concurrency_kwargs) -> list[str]:
     """ downloads prices for list of tickers to
     corresponing csv file in priceVolData directory
+    :param fetch: download backend, Yahoo Finance by default,
+    downloader.directory_price_fetcher or downloader.http_price_fetcher for offline runs
+    :param checkpoint_path: file with already downloaded tickers, an interrupted download resumes from it
+    :param manifest_path: json report of downloaded, skipped and failed tickers
+    :param concurrency_kwargs: rate limit and retries, see downloader.run_concurrently
     :returns list of tickers for which download failed
     """
-    tickers_failed_to_download = []
-    for ticker in tqdm.tqdm(tickers_to_download):
-        try:
-            price_and_volume_df = _download_price_volume_history(ticker, show_errors=False)
-            if len(price_and_volume_df) > 0:
-                price_and_volume_df.to_csv(_price_vol_path(ticker))
-            else:
-                tickers_failed_to_download.append(ticker)
-        except Exception as e:
-            tickers_failed_to_download.append(ticker)
-            print(e)
-    return tickers_failed_to_download
+    if fetch is None:
+        fetch = lambda ticker: _download_price_volume_history(ticker, show_errors=False)
+    return downloader.download_price_histories(tickers_to_download, fetch, DATA_DIR,
+                                               max_workers=max_workers,
+                                               checkpoint_path=checkpoint_path,
+                                               manifest_path=manifest_path,
+                                               **concurrency_kwargs)
+
+
+def refresh_price_history(tickers_to_refresh: list[str],
+                          fetch_since: Optional[downloader.TailFetcher] = None,
+                          max_workers: int = 8,
+                          store_dir: str = pricestore.STORE_DIR,
+                          **refresh_kwargs) -> dict[str, str]:
+    """ incremental update of csv files in priceVolData directory:
+    downloads only the dates after the last stored one,
+    re-downloads the whole history of tickers whose adjusted prices changed due to splits or dividends.
+    If the columnar store was converted from priceVolData and contains a changed ticker,
+    the store is rebuilt from the csv files of its tickers
+    :param fetch_since: download backend, Yahoo Finance by default
+    :param refresh_kwargs: overlap and tolerance, see downloader.refresh_price_history,
+    rate limit, retries, checkpoint and manifest, see downloader.run_concurrently
+    :returns {'AAPL': 'appended', 'GOOG': 'refetched', 'NOTATICKER': 'failed'}
+    """
+    if fetch_since is None:
+        fetch_since = lambda ticker, start_date: _download_price_volume_history(ticker, show_errors=False,
+                                                                                start_date=start_date)
+    statuses = downloader.refresh_price_histories(tickers_to_refresh, fetch_since, DATA_DIR,
+                                                  max_workers=max_workers,
+                                                  **refresh_kwargs)
+    if pricestore.store_exists(store_dir):
+        store = pricestore.PriceVolumeStore(store_dir)
+        store_tickers = store.tickers.tolist()
+        # stores of other csv directories do not depend on the refreshed files
+        if (store.source_dir is not None and os.path.abspath(store.source_dir) == os.path.abspath(DATA_DIR)
+                and any(statuses.get(ticker) in ('appended', 'refetched') for ticker in store_tickers)):
+            convert_csv_dir_to_store(DATA_DIR, store_dir, store_tickers)
+    return statuses
 
 
-def _load_price_volume_history(ticker: str) -> pd.DataFrame:
+def _load_price_volume_history(ticker: str, data_dir: Optional[str] = None) -> pd.DataFrame:
     """
     Has side effect of downloading the ticker if it can not be read locally
     :param ticker:
     :return: table indexed with date, two columns: 'Adj Close', 'Volume'
     """
-    filepath = _price_vol_path(ticker)
+    filepath = _price_vol_path(ticker, data_dir)
     if os.path.exists(filepath):
         price_volume_history = pd.read_csv(filepath,
                                            parse_dates=['Date'],
@@ -88,37 +135,111 @@ def _load_price_volume_history(ticker: str) -> pd.DataFrame:
         return price_volume_history
 
 
-def load_price_and_volume_histories(tickers: set[str]) -> tuple[pd.DataFrame, pd.DataFrame]:
+def _csv_mtime(ticker: str, data_dir: Optional[str] = None) -> Optional[int]:
+    try:
+        return os.stat(_price_vol_path(ticker, data_dir)).st_mtime_ns
+    except FileNotFoundError:
+        return None
+
+
+def stale_store_tickers(store: pricestore.PriceVolumeStore,
+                        tickers: Iterable[str],
+                        data_dir: Optional[str] = None) -> list[str]:
+    """
+    :param data_dir: directory of the csv files, the one the store was converted from by default
+    :return: tickers whose csv file was modified after it was converted into the store, i.e. by a refresh.
+    none for a store which was not converted from csv files
+    """
+    if data_dir is None:
+        data_dir = store.source_dir
+    if data_dir is None:
+        return []
+    return [ticker for ticker in tickers
+            if _csv_mtime(ticker, data_dir) not in (None, store.source_mtimes.get(ticker))]
+
+
+def load_price_and_volume_histories(tickers: set[str],
+                                    store_dir: str = pricestore.STORE_DIR) -> tuple[pd.DataFrame, pd.DataFrame]:
     """ load all prices to a single table for analysis
+    Reads the columnar store (see convert_csv_dir_to_store) if it contains all tickers
+    and their csv files did not change since the conversion, falls back to per-ticker csv files otherwise,
+    in the directory the store was converted from
+    :return prices table indexed with dates, column = tickers, i.e. 'GOOG', 'AMZN',...
+    :return volumes table indexed with dates, column = tickers, i.e. 'GOOG', 'AMZN',...
+    """
+    data_dir = None
+    if pricestore.store_exists(store_dir):
+        store = pricestore.PriceVolumeStore(store_dir)
+        data_dir = store.source_dir
+        if all(ticker in store for ticker in tickers):
+            stale_tickers = stale_store_tickers(store, tickers, data_dir)
+            if not stale_tickers:
+                return store.price_and_volume_histories(list(tickers))
+            warnings.warn(f'{store_dir} is older than the csv files of {sorted(stale_tickers)}, reading csv files, '
+                          f'run convert_csv_dir_to_store to update it')
+    return load_csv_price_and_volume_histories(tickers, data_dir)
+
+
+def load_csv_price_and_volume_histories(tickers: Iterable[str],
+                                        data_dir: Optional[str] = None,
+                                        max_workers: int = 8) -> tuple[pd.DataFrame, pd.DataFrame]:
+    """ load all prices from priceVolData/<TICKER>.csv files to a single table
+    Files are read in parallel, then the union of dates is computed once
+    and prices and volumes are written into preallocated dates x tickers arrays
     :return prices table indexed with dates, column = tickers, i.e. 'GOOG', 'AMZN',...
     :return volumes table indexed with dates, column = tickers, i.e. 'GOOG', 'AMZN',...
     """
-    prices_history = pd.DataFrame()
-    volume_history = pd.DataFrame()
-    for ticker in tqdm.tqdm(tickers, desc='Loading price and volume'):
-        ticker_prices_vols = _load_price_volume_history(ticker)
-        ticker_prices_df = ticker_prices_vols['Adj Close'].rename(ticker)
-        ticker_vols_df = ticker_prices_vols['Volume'].rename(ticker)
-        prices_history = prices_history.join(ticker_prices_df, how='outer')
-        volume_history = volume_history.join(ticker_vols_df, how='outer')
-    return prices_history, volume_history
+    tickers = list(tickers)
+    if not tickers:
+        return pd.DataFrame(), pd.DataFrame()
+    import tqdm
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        ticker_prices_vols_list = list(tqdm.tqdm(executor.map(lambda ticker: _load_price_volume_history(ticker,
+                                                                                                        data_dir),
+                                                              tickers),
+                                                 total=len(tickers),
+                                                 desc='Loading price and volume'))
+    # union of all dates, sorted as in outer join
+    dates = pd.DatetimeIndex(np.unique(np.concatenate([ticker_prices_vols.index.values
+                                                       for ticker_prices_vols in ticker_prices_vols_list])),
+                             name=ticker_prices_vols_list[0].index.name)
+    prices = np.full((len(dates), len(tickers)), np.nan, dtype=np.float64)
+    volumes = np.full((len(dates), len(tickers)), np.nan, dtype=np.float64)
+    for column, ticker_prices_vols in enumerate(ticker_prices_vols_list):
+        rows = dates.get_indexer(ticker_prices_vols.index)
+        prices[rows, column] = ticker_prices_vols['Adj Close'].to_numpy(dtype=np.float64)
+        volumes[rows, column] = ticker_prices_vols['Volume'].to_numpy(dtype=np.float64)
+    return pd.DataFrame(prices, index=dates, columns=tickers), pd.DataFrame(volumes, index=dates, columns=tickers)
+
+
+def convert_csv_dir_to_store(data_dir: str = DATA_DIR,
+                             store_dir: str = pricestore.STORE_DIR,
+                             tickers: Optional[Iterable[str]] = None) -> list[str]:
+    """
+    One-shot conversion of priceVolData/<TICKER>.csv files into the columnar store
+    :param data_dir: directory with per-ticker csv files
+    :param tickers: tickers to convert, all csv files in data_dir by default
+    :return: list of converted tickers
+    """
+    if tickers is None:
+        tickers = [filename[:-len('.csv')] for filename in os.listdir(data_dir) if filename.endswith('.csv')]
+    tickers = list(tickers)
+    # modification times are taken before reading, a file changed meanwhile makes the store stale
+    source_mtimes = {ticker: _csv_mtime(ticker, data_dir) for ticker in tickers}
+    prices_history, volume_history = load_csv_price_and_volume_histories(sorted(tickers), data_dir)
+    pricestore.write_store(prices_history, volume_history, store_dir, source_mtimes, data_dir)
+    return prices_history.columns.tolist()
 
 
 def load_random_saved_tickers(sample_size: int = 300) -> list[str]:
-    """Loads list of tickers from SharesOutstanding csv file"""
+    """Loads list of tickers from SharesOutstanding csv file, see metadata.TickerMetadataStore.sample
+    for stratified samples"""
     return load_all_saved_tickers_info().sample(n=sample_size).index.to_list()
 
 
 def load_all_saved_tickers_info() -> pd.DataFrame:
-    """Load from file"""
-    tickers_info_df = pd.read_csv(SHARES_INFO_FILEPATH). \
-        dropna(subset=['sharesOutstanding']).\
-        drop_duplicates(subset=['ticker'], keep='first').\
-        set_index('ticker')
-    # tickers_info_df = pd.read_csv(SHARES_OUTSTANDING_FILEPATH, index_col='ticker').\
-    #     dropna(subset=['sharesOutstanding'])
-    # remove_duplicate_indexes_inplace(tickers_info_df)
-    return tickers_info_df
+    """Load from file, the file is read again only if it was modified, see metadata.metadata_store"""
+    return metadata.metadata_store(SHARES_INFO_FILEPATH).tickers_info
 
 
 def load_shares_outstanding(tickers: set[str]) -> pd.Series:
@@ -127,7 +248,7 @@ def load_shares_outstanding(tickers: set[str]) -> pd.Series:
     :param tickers: list of tickers to load
     :return: pd.Series({'AMZN':10000.0, 'AAPL':12323000.0})
     """
-    tickers_df = load_all_saved_tickers_info()
+    tickers_df = metadata.metadata_store(SHARES_INFO_FILEPATH).table
     selected_tickers = tickers_df.loc[tickers_df.index.isin(tickers), 'sharesOutstanding']
     # warn that some ticker are not loaded
     not_laoded_tickers = [ticker for ticker in tickers if not (ticker in tickers_df.index)]
@@ -146,9 +267,11 @@ def load_shares_history(tickers: set[str]) -> SharesHistory:
     return SharesHistory(prices_history_df, volumes_history_df, shares_outstanding)
 
 
-def _download_info(tickers: list[str]) -> pd.DataFrame:
+def _download_info(tickers: list[str], **concurrency_kwargs) -> pd.DataFrame:
     """ downloads info for each ticker
     :param tickers:
+    :param concurrency_kwargs: workers, rate limit, retries and checkpoint, see downloader.run_concurrently
+    and downloader.download_infos
     :return: DataFrame with columns 'ticker', 'sharesOutstanding', etc...
     """
     info_list = ['quoteType',
@@ -160,19 +283,5 @@ def _download_info(tickers: list[str]) -> pd.DataFrame:
                  'shortName',
                  'trailingPE',
                  'trailingAnnualDividendYield']
-    tickers_info = dict()
-    tickers_info['ticker'] = []
-    for info_label in info_list:
-        tickers_info[info_label] = []
-    for ticker in tqdm.tqdm(tickers):
-        try:
-            ticker_info = yfsi.get_quote_data(ticker)
-        except (IndexError, AssertionError):
-            print(f'{ticker} data is not downloaded')
-        else:
-            tickers_info['ticker'].append(ticker)
-            for info_label in info_list:
-                tickers_info[info_label].append(ticker_info.get(info_label, None))
-    resulting_df = pd.DataFrame(tickers_info)
-    resulting_df.index.names = ['index']
-    return resulting_df
+    from yahoo_fin import stock_info as yfsi
+    return downloader.download_infos(tickers, yfsi.get_quote_data, info_list, **concurrency_kwargs)
@@ -0,0 +1,307 @@
+import datetime
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Any, Callable, Optional
+
+import numpy as np
+import pandas as pd
+
+# function ticker -> table indexed with date, columns 'Adj Close', 'Volume'
+PriceFetcher = Callable[[str], pd.DataFrame]
+# function ticker, first date or None for the whole history -> table indexed with date, columns 'Adj Close', 'Volume'
+TailFetcher = Callable[[str, Optional[datetime.date]], pd.DataFrame]
+# function ticker -> dict of ticker info, i.e. {'quoteType': 'EQUITY', 'sharesOutstanding': 1000.0}
+InfoFetcher = Callable[[str], dict[str, Any]]
+
+
+# network errors of requests, urllib and http.client are OSError, only they are retried.
+# yahoo_fin raises IndexError or AssertionError for unknown tickers, retrying them would not help
+TRANSIENT_ERRORS: tuple[type[Exception], ...] = (OSError,)
+# info of tickers processed before an interruption is saved to <checkpoint_path> + INFOS_SUFFIX, one json per line
+INFOS_SUFFIX = '.infos.jsonl'
+
+
+class EmptyHistoryError(Exception):
+    pass
+
+
+class RateLimiter:
+    """Allows at most calls_per_second calls per second, shared between threads"""
+
+    def __init__(self, calls_per_second: Optional[float]):
+        self.min_interval = 1.0 / calls_per_second if calls_per_second else 0.0
+        self._next_call_time = time.monotonic()
+        self._lock = threading.Lock()
+
+    def wait(self) -> None:
+        if self.min_interval == 0.0:
+            return
+        with self._lock:
+            now = time.monotonic()
+            call_time = max(now, self._next_call_time)
+            self._next_call_time = call_time + self.min_interval
+        time.sleep(max(0.0, call_time - now))
+
+
+def directory_price_fetcher(fixture_dir: str) -> PriceFetcher:
+    """Reads <fixture_dir>/<TICKER>.csv, stand-in for Yahoo Finance in tests and offline runs"""
+    return _csv_price_fetcher(lambda ticker: os.path.join(fixture_dir, ticker + '.csv'))
+
+
+def http_price_fetcher(base_url: str) -> PriceFetcher:
+    """Reads <base_url>/<TICKER>.csv, i.e. from a local fake server"""
+    return _csv_price_fetcher(lambda ticker: base_url.rstrip('/') + '/' + ticker + '.csv')
+
+
+def tail_fetcher_from(fetch: PriceFetcher) -> TailFetcher:
+    """TailFetcher for a backend which can only return the whole history, i.e. directory_price_fetcher"""
+    def fetch_since(ticker: str, start_date: Optional[datetime.date]) -> pd.DataFrame:
+        price_volume_history = fetch(ticker)
+        if start_date is None:
+            return price_volume_history
+        return price_volume_history.loc[start_date:]
+
+    return fetch_since
+
+
+def _csv_price_fetcher(ticker_location: Callable[[str], str]) -> PriceFetcher:
+    def fetch(ticker: str) -> pd.DataFrame:
+        return pd.read_csv(ticker_location(ticker), parse_dates=['Date'], index_col='Date')
+
+    return fetch
+
+
+def _call_with_retries(fn: Callable[[], Any],
+                       rate_limiter: RateLimiter,
+                       retries: int,
+                       backoff_seconds: float,
+                       retry_on: tuple[type[Exception], ...] = TRANSIENT_ERRORS) -> Any:
+    """calls fn, on a retry_on exception waits backoff_seconds * 2 ** attempt and retries, others are raised"""
+    for attempt in range(retries + 1):
+        rate_limiter.wait()
+        try:
+            return fn()
+        except retry_on:
+            if attempt == retries:
+                raise
+            time.sleep(backoff_seconds * 2 ** attempt)
+
+
+def _load_checkpoint(checkpoint_path: Optional[str]) -> set[str]:
+    if checkpoint_path is None or not os.path.exists(checkpoint_path):
+        return set()
+    with open(checkpoint_path) as checkpoint_file:
+        return {line.strip() for line in checkpoint_file if line.strip()}
+
+
+def _write_manifest(manifest_path: Optional[str], manifest: dict[str, Any]) -> None:
+    if manifest_path is None:
+        return
+    with open(manifest_path, 'w') as manifest_file:
+        json.dump(manifest, manifest_file, indent=2)
+
+
+def run_concurrently(tickers: list[str],
+                     process_ticker: Callable[[str], Any],
+                     max_workers: int = 8,
+                     calls_per_second: Optional[float] = 5.0,
+                     retries: int = 3,
+                     backoff_seconds: float = 1.0,
+                     retry_on: tuple[type[Exception], ...] = TRANSIENT_ERRORS,
+                     checkpoint_path: Optional[str] = None,
+                     manifest_path: Optional[str] = None,
+                     progress_bar: bool = True) -> tuple[dict[str, Any], dict[str, str]]:
+    """
+    Calls process_ticker for each ticker in a thread pool.
+    Tickers listed in checkpoint_path are skipped, successfully processed tickers are appended to it,
+    so that an interrupted run resumes where it stopped
+    :param calls_per_second: rate limit shared by all workers, None for no limit
+    :param retries: number of retries after the first failed attempt, waiting backoff_seconds * 2 ** attempt
+    :param retry_on: exceptions which are retried, others fail the ticker at once
+    :param manifest_path: json file with processed, skipped and failed tickers, with error messages
+    :return: results for processed tickers, error messages for failed tickers
+    """
+    already_done = _load_checkpoint(checkpoint_path)
+    tickers_to_process = [ticker for ticker in dict.fromkeys(tickers) if ticker not in already_done]
+    rate_limiter = RateLimiter(calls_per_second)
+    results: dict[str, Any] = dict()
+    failures: dict[str, str] = dict()
+    checkpoint_lock = threading.Lock()
+    checkpoint_file = open(checkpoint_path, 'a') if checkpoint_path is not None else None
+    import tqdm
+    try:
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = {executor.submit(_call_with_retries,
+                                       lambda ticker=ticker: process_ticker(ticker),
+                                       rate_limiter,
+                                       retries,
+                                       backoff_seconds,
+                                       retry_on): ticker
+                       for ticker in tickers_to_process}
+            for future in tqdm.tqdm(as_completed(futures), total=len(futures), disable=not progress_bar):
+                ticker = futures[future]
+                try:
+                    results[ticker] = future.result()
+                except Exception as e:
+                    failures[ticker] = f'{type(e).__name__}: {e}'
+                else:
+                    if checkpoint_file is not None:
+                        with checkpoint_lock:
+                            checkpoint_file.write(ticker + '\n')
+                            checkpoint_file.flush()
+    finally:
+        if checkpoint_file is not None:
+            checkpoint_file.close()
+    _write_manifest(manifest_path, {'processed': sorted(results),
+                                    'skipped': sorted(already_done.intersection(tickers)),
+                                    'failed': dict(sorted(failures.items()))})
+    return results, failures
+
+
+def download_price_histories(tickers: list[str],
+                             fetch: PriceFetcher,
+                             data_dir: str,
+                             **concurrency_kwargs) -> list[str]:
+    """
+    Downloads price and volume histories concurrently and saves each to <data_dir>/<TICKER>.csv
+    :param fetch: backend, i.e. Yahoo Finance or directory_price_fetcher for offline runs
+    :param concurrency_kwargs: see run_concurrently
+    :return: list of tickers for which download failed
+    """
+    os.makedirs(data_dir, exist_ok=True)
+
+    def download_and_save(ticker: str) -> int:
+        price_and_volume_df = fetch(ticker)
+        if len(price_and_volume_df) == 0:
+            raise EmptyHistoryError(f'no price history for {ticker}')
+        price_and_volume_df.to_csv(os.path.join(data_dir, ticker + '.csv'))
+        return len(price_and_volume_df)
+
+    _, failures = run_concurrently(tickers, download_and_save, **concurrency_kwargs)
+    return sorted(failures)
+
+
+def _load_saved_infos(infos_path: str) -> dict[str, dict[str, Any]]:
+    if not os.path.exists(infos_path):
+        return dict()
+    with open(infos_path) as infos_file:
+        records = [json.loads(line) for line in infos_file if line.strip()]
+    return {record['ticker']: record['info'] for record in records}
+
+
+def download_infos(tickers: list[str],
+                   fetch_info: InfoFetcher,
+                   info_list: list[str],
+                   **concurrency_kwargs) -> pd.DataFrame:
+    """
+    Downloads info for each ticker concurrently.
+    With a checkpoint_path, info of every processed ticker is saved to <checkpoint_path> + INFOS_SUFFIX
+    before the ticker is added to the checkpoint, info of tickers skipped on resume is read from there
+    :param fetch_info: backend, i.e. yahoo_fin get_quote_data
+    :param info_list: info labels to keep, i.e. ['quoteType', 'sharesOutstanding']
+    :param concurrency_kwargs: see run_concurrently
+    :return: DataFrame with columns 'ticker' + info_list, in the order of tickers, failed tickers are omitted
+    """
+    checkpoint_path = concurrency_kwargs.get('checkpoint_path')
+    if checkpoint_path is None:
+        infos, _ = run_concurrently(tickers, fetch_info, **concurrency_kwargs)
+    else:
+        infos_path = checkpoint_path + INFOS_SUFFIX
+        saved_infos = _load_saved_infos(infos_path)
+        lost = sorted(_load_checkpoint(checkpoint_path).intersection(tickers).difference(saved_infos))
+        if lost:
+            raise ValueError(f'{checkpoint_path} lists tickers without saved info: {lost}, '
+                             f'remove them from the checkpoint to download them again')
+        infos_lock = threading.Lock()
+
+        def fetch_and_save(ticker: str) -> dict[str, Any]:
+            fetched_info = fetch_info(ticker)
+            info = {info_label: fetched_info.get(info_label, None) for info_label in info_list}
+            with infos_lock, open(infos_path, 'a') as infos_file:
+                infos_file.write(json.dumps({'ticker': ticker, 'info': info}, default=str) + '\n')
+            return info
+
+        infos, _ = run_concurrently(tickers, fetch_and_save, **concurrency_kwargs)
+        infos = {**saved_infos, **infos}
+    tickers_info = {'ticker': [ticker for ticker in tickers if ticker in infos]}
+    for info_label in info_list:
+        tickers_info[info_label] = [infos[ticker].get(info_label, None) for ticker in tickers_info['ticker']]
+    resulting_df = pd.DataFrame(tickers_info)
+    resulting_df.index.names = ['index']
+    return resulting_df
+
+
+def _read_stored_history(filepath: str) -> pd.DataFrame:
+    return pd.read_csv(filepath, parse_dates=['Date'], index_col='Date')
+
+
+def _adjustments_changed(stored: pd.DataFrame, tail: pd.DataFrame, rtol: float) -> bool:
+    """
+    True if adjusted prices or split-adjusted volumes of the dates present in both tables differ,
+    i.e. a dividend or split happened after the history was stored
+    """
+    common_dates = stored.index.intersection(tail.index)
+    if len(common_dates) == 0:
+        return True
+    columns = [column for column in ('Adj Close', 'Volume') if column in stored.columns]
+    return not np.allclose(stored.loc[common_dates, columns].to_numpy(dtype=np.float64),
+                           tail.loc[common_dates, columns].to_numpy(dtype=np.float64),
+                           rtol=rtol, equal_nan=True)
+
+
+def refresh_price_history(ticker: str,
+                          fetch_since: TailFetcher,
+                          data_dir: str,
+                          overlap_days: int = 5,
+                          rtol: float = 1e-4) -> str:
+    """
+    Appends the missing tail of <data_dir>/<TICKER>.csv.
+    The tail is fetched starting overlap_days stored rows before the last stored date,
+    if the overlapping rows changed, the stored adjusted history is invalid and the whole history is re-fetched
+    :return: 'new', 'appended', 'up_to_date' or 'refetched'
+    """
+    filepath = os.path.join(data_dir, ticker + '.csv')
+    if not os.path.exists(filepath):
+        full_history = fetch_since(ticker, None)
+        if len(full_history) == 0:
+            raise EmptyHistoryError(f'no price history for {ticker}')
+        full_history.to_csv(filepath)
+        return 'new'
+    stored = _read_stored_history(filepath)
+    if len(stored) > 0:
+        tail = fetch_since(ticker, stored.index[-min(overlap_days, len(stored))].date())
+    # an empty stored file has nothing to append to
+    if len(stored) == 0 or _adjustments_changed(stored, tail, rtol):
+        full_history = fetch_since(ticker, None)
+        if len(full_history) == 0:
+            raise EmptyHistoryError(f'no price history for {ticker}')
+        full_history.to_csv(filepath)
+        return 'refetched'
+    new_rows = tail.loc[tail.index > stored.index.max(), stored.columns]
+    if len(new_rows) == 0:
+        return 'up_to_date'
+    new_rows.to_csv(filepath, mode='a', header=False)
+    return 'appended'
+
+
+def refresh_price_histories(tickers: list[str],
+                            fetch_since: TailFetcher,
+                            data_dir: str,
+                            overlap_days: int = 5,
+                            rtol: float = 1e-4,
+                            **concurrency_kwargs) -> dict[str, str]:
+    """
+    Incremental update of stored price histories, see refresh_price_history
+    :param concurrency_kwargs: see run_concurrently
+    :return: {'AAPL': 'appended', 'GOOG': 'refetched', 'NOTATICKER': 'failed'}
+    """
+    os.makedirs(data_dir, exist_ok=True)
+    statuses, failures = run_concurrently(tickers,
+                                          lambda ticker: refresh_price_history(ticker, fetch_since, data_dir,
+                                                                               overlap_days, rtol),
+                                          **concurrency_kwargs)
+    statuses.update({ticker: 'failed' for ticker in failures})
+    return statuses
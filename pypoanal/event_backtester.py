@@ -0,0 +1,238 @@
+import datetime
+from abc import ABC, abstractmethod
+from dataclasses import dataclass
+from typing import Optional
+
+import numpy as np
+import pandas as pd
+import scipy.sparse as sp
+
+import pypoanal.portfolio_calculators as pcalc
+from pypoanal import portfolio_rebalancer, profiling
+from pypoanal.assets import PortfolioHistory, SharesHistory
+from pypoanal.liquidity import LiquidityIndex
+
+
+class HoldingSegment:
+    """
+    Portfolio held from a rebalance row until the next event, over a forward filled dates x tickers price matrix.
+    Values of any range of rows are computed at once from the price columns of the held tickers
+    """
+
+    def __init__(self, prices: np.ndarray, rebalance_row: int, cash: np.float64, shares: np.ndarray):
+        """:param shares: shares of every column of prices"""
+        self.prices = prices
+        self.rebalance_row = rebalance_row
+        self.cash = cash
+        self.columns = np.flatnonzero(shares)
+        self.shares = shares[self.columns]
+        # weights right after the rebalance, drift is measured from them
+        self.weights = self.weights_at(np.array([rebalance_row]))[0]
+        self._cached_rows: tuple[int, int] = (0, 0)
+        self._cached_values = np.empty(0)
+
+    def values(self, start: int, stop: int) -> np.ndarray:
+        """:return: value of the portfolio at rows [start, stop), the last range is cached for the next trigger"""
+        if self._cached_rows != (start, stop):
+            self._cached_values = self.compute_values(start, stop)
+            self._cached_rows = (start, stop)
+        return self._cached_values
+
+    def compute_values(self, start: int, stop: int) -> np.ndarray:
+        """:return: value of the portfolio at rows [start, stop), without caching"""
+        return self.cash + np.nansum(self.prices[start:stop, self.columns] * self.shares, axis=1)
+
+    def weights_at(self, rows: np.ndarray) -> np.ndarray:
+        """:return: rows x held tickers weights in the portfolio value, cash included in the value"""
+        values = self.cash + np.nansum(self.prices[np.ix_(rows, self.columns)] * self.shares, axis=1)
+        return np.nan_to_num(self.prices[np.ix_(rows, self.columns)] * self.shares) / values[:, None]
+
+
+class RebalanceTrigger(ABC):
+    """Decides on which day the portfolio is rebalanced"""
+    name = 'trigger'
+
+    @abstractmethod
+    def first_trigger(self, segment: HoldingSegment, dates: pd.DatetimeIndex, start: int, stop: int) -> Optional[int]:
+        """:return: first row in [start, stop) when the segment portfolio has to be rebalanced, None if there is none"""
+
+
+class CalendarTrigger(RebalanceTrigger):
+    """Rebalances on the first trading day at least `every` after the previous rebalance"""
+    name = 'calendar'
+
+    def __init__(self, every: datetime.timedelta):
+        self.every = every
+
+    def first_trigger(self, segment: HoldingSegment, dates: pd.DatetimeIndex, start: int, stop: int) -> Optional[int]:
+        row = max(start, dates.searchsorted(dates[segment.rebalance_row] + self.every))
+        return row if row < stop else None
+
+
+class DriftTrigger(RebalanceTrigger):
+    """Rebalances when the weight of a held ticker moves more than band away from its weight after the rebalance"""
+    name = 'drift'
+
+    def __init__(self, band: float = 0.05):
+        """:param band: absolute weight difference, 0.05 = 5 percentage points"""
+        self.band = band
+
+    def first_trigger(self, segment: HoldingSegment, dates: pd.DatetimeIndex, start: int, stop: int) -> Optional[int]:
+        if len(segment.columns) == 0:
+            return None
+        drift = np.abs(segment.weights_at(np.arange(start, stop)) - segment.weights).max(axis=1)
+        fired = np.flatnonzero(drift > self.band)
+        return start + fired[0] if len(fired) > 0 else None
+
+
+class VolatilityTrigger(RebalanceTrigger):
+    """
+    Rebalances when the volatility regime changes: rolling volatility of the daily returns of the held portfolio
+    is more than ratio times higher or lower than it was at the rebalance
+    """
+    name = 'volatility'
+
+    def __init__(self, window: int = 63, ratio: float = 1.5):
+        """:param window: number of daily returns of the rolling volatility"""
+        self.window = window
+        self.ratio = ratio
+        # segment whose reference volatility was computed last, and the volatility
+        self._reference: tuple[Optional[HoldingSegment], float] = (None, np.nan)
+
+    def _rolling_volatility(self, segment: HoldingSegment, start: int, stop: int, cached: bool = True) -> np.ndarray:
+        """
+        :param cached: values of the rows are taken from the cache of the segment, which keeps the last range only
+        :return: volatility of the returns of the window ending at each row of [start, stop), NaN if it is short
+        """
+        first_row = max(start - self.window, 0)
+        values = segment.values(first_row, stop) if cached else segment.compute_values(first_row, stop)
+        returns = np.r_[np.nan, values[1:] / values[:-1] - 1.0]
+        returns = np.nan_to_num(returns)
+        cumulative = np.r_[0.0, np.cumsum(returns)]
+        cumulative_squares = np.r_[0.0, np.cumsum(returns ** 2)]
+        ends = np.arange(start - first_row, stop - first_row) + 1
+        begins = ends - self.window
+        volatility = np.full(len(ends), np.nan)
+        full = begins >= 1
+        n = self.window
+        mean = (cumulative[ends[full]] - cumulative[begins[full]]) / n
+        volatility[full] = np.sqrt(np.maximum((cumulative_squares[ends[full]] - cumulative_squares[begins[full]]) / n
+                                              - mean ** 2, 0.0) * n / (n - 1))
+        return volatility
+
+    def _reference_volatility(self, segment: HoldingSegment) -> float:
+        """volatility at the rebalance, computed once per segment and not through its values cache of the blocks"""
+        reference_segment, reference = self._reference
+        if reference_segment is not segment:
+            reference = self._rolling_volatility(segment, segment.rebalance_row, segment.rebalance_row + 1,
+                                                 cached=False)[0]
+            self._reference = (segment, reference)
+        return reference
+
+    def first_trigger(self, segment: HoldingSegment, dates: pd.DatetimeIndex, start: int, stop: int) -> Optional[int]:
+        reference = self._reference_volatility(segment)
+        if not reference > 0:
+            return None
+        relative_volatility = self._rolling_volatility(segment, start, stop) / reference
+        fired = np.flatnonzero((relative_volatility > self.ratio) | (relative_volatility < 1.0 / self.ratio))
+        return start + fired[0] if len(fired) > 0 else None
+
+
+@dataclass
+class EventBacktestResult:
+    # portfolio value in USD of every trading day from the first rebalance to the end date
+    values: pd.Series
+    # one row per rebalance: date, trigger, fees, error (None if weights were computed)
+    events: pd.DataFrame
+    # initial cash, then the portfolio after every event
+    portfolios: PortfolioHistory
+
+
+def run_event_backtest(compute_weights: pcalc.PortfolioWeightsCalculator,
+                       shares_history: SharesHistory,
+                       start_date: datetime.date,
+                       end_date: datetime.date,
+                       initial_money: np.float64,
+                       triggers: list[RebalanceTrigger],
+                       fees_percent: np.float64 = np.float64(0.04),
+                       lookback: datetime.timedelta = datetime.timedelta(days=365),
+                       min_holding_days: int = 5,
+                       block_days: int = 21,
+                       liquidity_index: Optional[LiquidityIndex] = None,
+                       profiler: Optional[profiling.NullProfiler] = None) -> EventBacktestResult:
+    """
+    Daily backtest which rebalances when one of the triggers fires, instead of on fixed dates.
+    The portfolio is invested on the first trading day not before start_date.
+    Between events the triggers are checked on blocks of days with numpy, pandas is only used at rebalances:
+    weights are computed from the prices of tickers liquid during the lookback before the event day,
+    and the portfolio is rebalanced at the prices of that day, with the fees of portfolio_rebalancer
+    :param min_holding_days: trading days after a rebalance when triggers are not checked
+    :param block_days: number of trading days checked at once
+    :param profiler: records weights and rebalance stages of every event, period = event number
+    """
+    if profiler is None:
+        profiler = profiling.NULL_PROFILER
+    if liquidity_index is None:
+        liquidity_index = LiquidityIndex(shares_history.volume_history)
+    price_history = shares_history.price_history
+    dates = price_history.index
+    tickers = price_history.columns
+    prices = price_history.fillna(method='ffill').to_numpy(dtype=np.float64)
+    first_row = dates.searchsorted(pd.Timestamp(start_date))
+    stop_row = dates.searchsorted(pd.Timestamp(end_date), side='right')
+    if first_row >= stop_row:
+        raise IndexError(f'no trading days from {start_date} to {end_date}')
+    cash_history = [np.float64(initial_money)]
+    holdings = [np.zeros(len(tickers))]
+    events = []
+    values = np.empty(stop_row - first_row)
+    row, trigger_name = first_row, 'start'
+    while True:
+        date = dates[row].date()
+        liquid_tickers = liquidity_index.liquid_tickers(date - lookback, date)
+        error = None
+        try:
+            with profiler.stage(profiling.WEIGHTS, len(events)):
+                weights = compute_weights(shares_history.shares_outstanding_at(date),
+                                          price_history.loc[date - lookback:date, liquid_tickers])
+        except pcalc.CALCULATION_ERRORS as calculation_error:
+            profiler.record_failure(len(events), None, calculation_error)
+            error = f'{type(calculation_error).__name__}: {calculation_error}'
+        if error is None:
+            with profiler.stage(profiling.REBALANCE, len(events)):
+                shares, cash, fees = portfolio_rebalancer.rebalance_arrays(
+                    cash_history[-1], holdings[-1], weights.reindex(tickers).to_numpy(dtype=np.float64),
+                    prices[row], fees_percent=fees_percent)
+        else:
+            # keep the previous portfolio
+            shares, cash, fees = holdings[-1], cash_history[-1], np.float64(0.0)
+        holdings.append(shares)
+        cash_history.append(cash)
+        events.append({'date': dates[row], 'trigger': trigger_name, 'fees': fees, 'error': error})
+        segment = HoldingSegment(prices, row, cash, shares)
+        next_row, trigger_name = _next_event(segment, triggers, dates, row + max(min_holding_days, 1),
+                                             stop_row, block_days)
+        values[row - first_row:next_row - first_row] = segment.values(row, next_row)
+        if next_row >= stop_row:
+            break
+        row = next_row
+    portfolios = PortfolioHistory(tickers, np.array(cash_history), sp.csr_matrix(np.vstack(holdings)))
+    return EventBacktestResult(values=pd.Series(values, index=dates[first_row:stop_row]),
+                               events=pd.DataFrame(events, columns=['date', 'trigger', 'fees', 'error']),
+                               portfolios=portfolios)
+
+
+def _next_event(segment: HoldingSegment,
+                triggers: list[RebalanceTrigger],
+                dates: pd.DatetimeIndex,
+                start: int,
+                stop_row: int,
+                block_days: int) -> tuple[int, Optional[str]]:
+    """:return: row and trigger name of the next event, stop_row and None if no trigger fires before it"""
+    for block_start in range(start, stop_row, block_days):
+        block_stop = min(block_start + block_days, stop_row)
+        fired = [(row, trigger.name) for trigger in triggers
+                 for row in [trigger.first_trigger(segment, dates, block_start, block_stop)] if row is not None]
+        if fired:
+            return min(fired, key=lambda row_trigger: row_trigger[0])
+    return stop_row, None
@@ -0,0 +1,155 @@
+from typing import Optional
+
+import numpy as np
+import pandas as pd
+
+from pypoanal.assets import SharesWeights
+
+
+def sample_covariance(returns: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Same as DataFrame.cov() and DataFrame.corr() of the returns table:
+    every pair of tickers is estimated over the dates where both returns are known
+    :param returns: dates x tickers daily returns, NaN where unknown
+    :return: covariance, correlation
+    """
+    known = ~np.isnan(returns)
+    if known.all():
+        centered = returns - returns.mean(axis=0)
+        cov = centered.T @ centered / (len(returns) - 1)
+        std = np.sqrt(np.diag(cov))
+        return cov, cov / np.outer(std, std)
+    v = known.astype(np.float64)
+    x = np.where(known, returns, 0.0)
+    n_pairs = v.T @ v
+    # sum_x[i, j] = sum of returns of i over the dates where j is known
+    sum_x = x.T @ v
+    with np.errstate(invalid='ignore', divide='ignore'):
+        cov = (x.T @ x - sum_x * sum_x.T / n_pairs) / (n_pairs - 1)
+        variance = ((x ** 2).T @ v - sum_x ** 2 / n_pairs) / (n_pairs - 1)
+        corr = cov / np.sqrt(variance * variance.T)
+    cov[n_pairs < 2] = np.nan
+    corr[n_pairs < 2] = np.nan
+    return cov, corr
+
+
+def cov_to_corr(cov: np.ndarray) -> np.ndarray:
+    std = np.sqrt(np.diag(cov))
+    return cov / np.outer(std, std)
+
+
+def single_linkage(corr: np.ndarray) -> np.ndarray:
+    """:return: scipy linkage matrix of the correlation distance sqrt((1 - corr) / 2), as in pypfopt.HRPOpt"""
+    import scipy.cluster.hierarchy as sch
+    import scipy.spatial.distance as ssd
+    distance = np.sqrt(np.clip((1.0 - corr) / 2.0, a_min=0.0, a_max=1.0))
+    return sch.linkage(ssd.squareform(distance, checks=False), 'single')
+
+
+def _ranges(starts: np.ndarray, stops: np.ndarray) -> np.ndarray:
+    """concatenated np.arange(start, stop) of every pair"""
+    lengths = stops - starts
+    offsets = np.repeat(starts - np.r_[0, np.cumsum(lengths)[:-1]], lengths)
+    return offsets + np.arange(lengths.sum())
+
+
+def bisection_weights(cov: np.ndarray) -> np.ndarray:
+    """
+    Recursive bisection of pypfopt.HRPOpt on a quasi-diagonalized covariance: every cluster is split in halves,
+    halves get weights inversely proportional to their inverse-variance portfolio variance.
+    Clusters are ranges of rows, so variances of all clusters of a tree level come from
+    2D prefix sums of inv_var_i * cov_ij * inv_var_j at once
+    :param cov: covariance with rows and columns in the quasi-diagonal order
+    :return: weights in the same order
+    """
+    n_tickers = len(cov)
+    inverse_variance = 1.0 / np.diag(cov)
+    prefix = np.zeros((n_tickers + 1, n_tickers + 1))
+    prefix[1:, 1:] = (inverse_variance[:, None] * cov * inverse_variance[None, :]).cumsum(axis=0).cumsum(axis=1)
+    inverse_variance_prefix = np.r_[0.0, np.cumsum(inverse_variance)]
+
+    def clusters_variance(starts: np.ndarray, stops: np.ndarray) -> np.ndarray:
+        quadratic_form = prefix[stops, stops] - prefix[starts, stops] - prefix[stops, starts] + prefix[starts, starts]
+        return quadratic_form / (inverse_variance_prefix[stops] - inverse_variance_prefix[starts]) ** 2
+
+    weights = np.ones(n_tickers)
+    starts, stops = np.array([0]), np.array([n_tickers])
+    while len(starts) > 0:
+        split = stops - starts > 1
+        starts, stops = starts[split], stops[split]
+        middles = starts + (stops - starts) // 2
+        first_variance = clusters_variance(starts, middles)
+        alpha = 1 - first_variance / (first_variance + clusters_variance(middles, stops))
+        weights[_ranges(starts, middles)] *= np.repeat(alpha, middles - starts)
+        weights[_ranges(middles, stops)] *= np.repeat(1 - alpha, stops - middles)
+        starts, stops = np.r_[starts, middles], np.r_[middles, stops]
+    return weights
+
+
+def hrp_weights(cov: np.ndarray,
+                corr: np.ndarray,
+                linkage: Optional[np.ndarray] = None) -> tuple[np.ndarray, np.ndarray]:
+    """
+    :param linkage: clustering of the same tickers to reuse, computed from corr if None
+    :return: raw HRP weights in the order of cov columns, linkage matrix
+    """
+    if not (np.isfinite(cov).all() and np.isfinite(corr).all()):
+        raise ValueError('covariance matrix contains NaNs')
+    import scipy.cluster.hierarchy as sch
+    if linkage is None:
+        linkage = single_linkage(corr)
+    order = sch.leaves_list(linkage)
+    weights = np.empty(len(order))
+    weights[order] = bisection_weights(cov[np.ix_(order, order)])
+    return weights, linkage
+
+
+def clean_weights(weights: np.ndarray, tickers: pd.Index, cutoff=1e-4, rounding=5) -> SharesWeights:
+    """as pypfopt clean_weights"""
+    weights = weights.copy()
+    weights[np.abs(weights) < cutoff] = 0
+    return pd.Series(np.round(weights, rounding), index=tickers)
+
+
+def _cov_and_corr(price_history: pd.DataFrame,
+                  cov_matrix: Optional[pd.DataFrame]) -> tuple[np.ndarray, np.ndarray]:
+    if cov_matrix is not None:
+        cov = cov_matrix.loc[price_history.columns, price_history.columns].to_numpy(dtype=np.float64)
+        return cov, cov_to_corr(cov)
+    if len(price_history.columns) == 0:
+        raise ValueError('no tickers in the price history')
+    returns = price_history.pct_change().dropna(how='all')
+    return sample_covariance(returns.to_numpy(dtype=np.float64))
+
+
+class NativeHRP:
+    """
+    Same weights as portfolio_calculators.compute_hrp_weights up to rounding, computed with numpy.
+    With reuse_linkage the clustering of the previous call is kept while the tickers do not change,
+    weights then follow the new covariance but not the new correlation structure
+    """
+    covariance_kind = 'sample'
+
+    def __init__(self, reuse_linkage: bool = False):
+        self.reuse_linkage = reuse_linkage
+        self.n_linkages = 0
+        self._tickers: Optional[pd.Index] = None
+        self._linkage: Optional[np.ndarray] = None
+
+    def __call__(self,
+                 shares_outstanding: pd.Series,
+                 price_history: pd.DataFrame,
+                 cov_matrix: Optional[pd.DataFrame] = None) -> SharesWeights:
+        """
+        :param cov_matrix: sample covariance of price_history returns, i.e. from covariance.CovarianceEngine,
+        correlation is then derived from it
+        """
+        cov, corr = _cov_and_corr(price_history, cov_matrix)
+        linkage = None
+        if self.reuse_linkage and self._tickers is not None and self._tickers.equals(price_history.columns):
+            linkage = self._linkage
+        weights, self._linkage = hrp_weights(cov, corr, linkage)
+        if linkage is None:
+            self.n_linkages += 1
+        self._tickers = price_history.columns
+        return clean_weights(weights, price_history.columns)
@@ -0,0 +1,61 @@
+import datetime
+
+import numpy as np
+import pandas as pd
+
+
+class LiquidityIndex:
+    """
+    Cumulative number of liquid days per ticker, built once per volume history.
+    Number of days with volume > min_volume in any period is a difference of two rows,
+    so choosing liquid tickers for a period costs O(tickers).
+    Cumulative counts are computed once for each min_volume on first use.
+    """
+
+    def __init__(self, volumes_history: pd.DataFrame):
+        """
+        :param volumes_history: trading volumes. DataFrame indexed with trading dates.
+        Each column corresponds to a ticker
+        """
+        self.dates = volumes_history.index
+        self.tickers = volumes_history.columns
+        self._volumes = volumes_history.to_numpy(dtype=np.float64)
+        self._cumulative_liquid_days: dict[float, np.ndarray] = dict()
+
+    def _liquid_days_before(self, min_volume: float) -> np.ndarray:
+        """row i = number of days before the i-th date with volume > min_volume, (dates + 1) x tickers"""
+        if min_volume not in self._cumulative_liquid_days:
+            cumulative_liquid_days = np.zeros((len(self.dates) + 1, len(self.tickers)), dtype=np.int32)
+            np.cumsum(self._volumes > min_volume, axis=0, out=cumulative_liquid_days[1:])
+            self._cumulative_liquid_days[min_volume] = cumulative_liquid_days
+        return self._cumulative_liquid_days[min_volume]
+
+    def _rows(self, start_date: datetime.date, end_date: datetime.date) -> tuple[int, int]:
+        """positions of the same rows as DataFrame.loc[start_date:end_date]"""
+        start, stop, _ = self.dates.slice_indexer(start_date, end_date).indices(len(self.dates))
+        return start, max(start, stop)
+
+    def liquid_days(self, start_date: datetime.date, end_date: datetime.date, min_volume=50) -> pd.Series:
+        """
+        :return: number of days with volume > min_volume for each ticker, pd.Series({'AMZN': 250, 'GOOG': 12})
+        """
+        start, stop = self._rows(start_date, end_date)
+        cumulative_liquid_days = self._liquid_days_before(min_volume)
+        return pd.Series(cumulative_liquid_days[stop] - cumulative_liquid_days[start], index=self.tickers)
+
+    def liquid_tickers(self,
+                       start_date: datetime.date,
+                       end_date: datetime.date,
+                       min_volume=50,
+                       liquid_days_percent=90) -> list[str]:
+        """
+        | returns list of tickers, for whom:
+         more than min_volume shares were traded for liquid_days_percent % of days in the specified period
+         :param liquid_days_percent: minimal percent of days when ticker was trading
+         :param min_volume: USD volume
+         """
+        start, stop = self._rows(start_date, end_date)
+        required_liquid_trading_days = (stop - start) * liquid_days_percent / 100.0
+        cumulative_liquid_days = self._liquid_days_before(min_volume)
+        liquid_trading_days = cumulative_liquid_days[stop] - cumulative_liquid_days[start]
+        return self.tickers[liquid_trading_days > required_liquid_trading_days].tolist()
@@ -0,0 +1,139 @@
+import os
+from typing import Iterable, Optional
+
+import numpy as np
+import pandas as pd
+
+TICKERS_INFO_FILEPATH = 'info/tickers_info.csv'
+# listing name -> csv file with a 'ticker' column
+LISTINGS_FILEPATHS = {'snp500': 'info/snp500-listed.csv',
+                      'nasdaq': 'info/nasdaq-listed.csv',
+                      'nyse': 'info/nyse-listed.csv'}
+
+
+def _mtime(path: str) -> Optional[int]:
+    try:
+        return os.stat(path).st_mtime_ns
+    except FileNotFoundError:
+        return None
+
+
+class TickerMetadataStore:
+    """
+    Ticker info of tickers_info.csv indexed by ticker, with a boolean column per listing.
+    Files are read once and read again only when their modification time changes
+    """
+
+    def __init__(self,
+                 tickers_info_path: str = TICKERS_INFO_FILEPATH,
+                 listings_paths: Optional[dict[str, str]] = None):
+        """:param listings_paths: listing name -> csv file with a 'ticker' column, LISTINGS_FILEPATHS if None"""
+        self.tickers_info_path = tickers_info_path
+        self.listings_paths = LISTINGS_FILEPATHS if listings_paths is None else listings_paths
+        self._mtimes: Optional[tuple] = None
+        self._table: Optional[pd.DataFrame] = None
+        self.n_loads = 0
+
+    def _files_mtimes(self) -> tuple:
+        return (_mtime(self.tickers_info_path),) + tuple(_mtime(path) for path in self.listings_paths.values())
+
+    def _load(self) -> pd.DataFrame:
+        table = pd.read_csv(self.tickers_info_path). \
+            dropna(subset=['sharesOutstanding']). \
+            drop_duplicates(subset=['ticker'], keep='first'). \
+            set_index('ticker')
+        for listing, path in self.listings_paths.items():
+            listed = pd.read_csv(path, usecols=['ticker'])['ticker'] if os.path.exists(path) else []
+            table[listing] = table.index.isin(listed)
+        self.n_loads += 1
+        return table
+
+    @property
+    def table(self) -> pd.DataFrame:
+        """
+        :return: columns of tickers_info.csv without tickers with unknown shares outstanding, indexed by ticker,
+        and a boolean column per listing. Shared between calls, copy it before modifying
+        """
+        mtimes = self._files_mtimes()
+        if self._table is None or mtimes != self._mtimes:
+            self._table = self._load()
+            self._mtimes = mtimes
+        return self._table
+
+    @property
+    def tickers_info(self) -> pd.DataFrame:
+        """:return: table without the listing columns, as dataloader.load_all_saved_tickers_info"""
+        return self.table.drop(columns=list(self.listings_paths))
+
+    def query(self,
+              quote_types: Optional[Iterable[str]] = None,
+              exchanges: Optional[Iterable[str]] = None,
+              min_market_cap: Optional[float] = None,
+              max_market_cap: Optional[float] = None,
+              listings: Optional[Iterable[str]] = None) -> pd.DataFrame:
+        """
+        :param quote_types: i.e. ['EQUITY', 'ETF'], any if None
+        :param exchanges: exchange codes, i.e. ['NYQ', 'NMS'], any if None
+        :param min_market_cap: USD, tickers with unknown market cap are excluded if a range is given
+        :param listings: names of listings, i.e. ['snp500'], tickers listed in any of them
+        :return: rows of table matching all conditions
+        """
+        table = self.table
+        selected = np.ones(len(table), dtype=bool)
+        if quote_types is not None:
+            selected &= table['quoteType'].isin(list(quote_types)).to_numpy()
+        if exchanges is not None:
+            selected &= table['exchange'].isin(list(exchanges)).to_numpy()
+        market_cap = table['marketCap'].to_numpy(dtype=np.float64)
+        if min_market_cap is not None:
+            selected &= market_cap >= min_market_cap
+        if max_market_cap is not None:
+            selected &= market_cap <= max_market_cap
+        if listings is not None:
+            selected &= table[list(listings)].to_numpy().any(axis=1)
+        return table[selected]
+
+    def sample(self,
+               n: int,
+               by: str = 'exchange',
+               bins: Optional[int] = None,
+               seed: Optional[int] = None,
+               **query_kwargs) -> list[str]:
+        """
+        Stratified random sample of the query results: every group of the `by` column gets a share
+        of the n tickers proportional to its size, tickers are drawn at random inside the groups
+        :param by: column of table defining the groups, i.e. 'exchange', 'quoteType' or 'marketCap'
+        :param bins: numeric columns are split in this many quantile bins, i.e. bins=5 for market cap quintiles
+        :param query_kwargs: see query
+        :return: n tickers, all matching tickers if there are fewer
+        """
+        candidates = self.query(**query_kwargs)
+        if n >= len(candidates):
+            return candidates.index.tolist()
+        groups = candidates[by]
+        if bins is not None:
+            groups = pd.qcut(groups, bins, duplicates='drop')
+        group_sizes = groups.value_counts(dropna=False, sort=False)
+        # largest remainder allocation, so that group sample sizes add up to n
+        quotas = group_sizes.to_numpy() * n / len(candidates)
+        sizes = np.floor(quotas).astype(np.int64)
+        sizes[np.argsort(sizes - quotas, kind='stable')[:n - sizes.sum()]] += 1
+        rng = np.random.default_rng(seed)
+        sampled = []
+        group_codes = groups.astype(object).to_numpy()
+        for group, size in zip(group_sizes.index, sizes):
+            members = np.flatnonzero(pd.isna(group_codes) if pd.isna(group) else group_codes == group)
+            sampled.extend(candidates.index[rng.choice(members, size, replace=False)])
+        return sampled
+
+
+_STORES: dict[str, TickerMetadataStore] = dict()
+
+
+def metadata_store(tickers_info_path: str = TICKERS_INFO_FILEPATH) -> TickerMetadataStore:
+    """:return: store of tickers_info_path shared by the process, with the listings of LISTINGS_FILEPATHS"""
+    key = os.path.abspath(tickers_info_path)
+    if key not in _STORES:
+        _STORES[key] = TickerMetadataStore(key, {listing: os.path.abspath(path)
+                                                 for listing, path in LISTINGS_FILEPATHS.items()})
+    return _STORES[key]
@@ -0,0 +1,226 @@
+from abc import ABC, abstractmethod
+from typing import Optional, Union
+
+import numpy as np
+import pandas as pd
+import scipy.sparse as sp
+
+from pypoanal.assets import SharesWeights
+
+
+# settings cvxpy passes to OSQP when EfficientFrontier solves these problems
+_SOLVER_SETTINGS = {'eps_abs': 1e-5, 'eps_rel': 1e-5, 'max_iter': 10000, 'polish': True, 'verbose': False}
+_SOLVED_STATUSES = {1, 2}  # solved, solved inaccurate
+
+
+class _OptimizerSession(ABC):
+    """
+    Quadratic program over a universe of tickers, solved again for every period.
+    The OSQP workspace is set up once: covariance and expected returns of a period update matrix values in place,
+    tickers outside of the period are masked with zero upper bounds,
+    and every solve is warm-started from the previous solution.
+    The universe grows when a period has new tickers, the workspace is then set up again
+    """
+    # variables besides ticker weights
+    n_extra_variables = 0
+
+    def __init__(self, tickers: Optional[list[str]] = None):
+        self.tickers = pd.Index(tickers if tickers is not None else [])
+        # number of times the workspace was set up, each setup is solved from cold
+        self.n_builds = 0
+        # osqp.OSQP workspace, osqp and pypfopt are imported on first use
+        self._solver = None
+        self._results = None
+
+    def __getstate__(self) -> dict:
+        # solver workspaces are set up again after unpickling, i.e. in worker processes
+        return {'tickers': self.tickers}
+
+    def __setstate__(self, state: dict) -> None:
+        self.__init__(list(state['tickers']))
+
+    @property
+    def iterations(self) -> Optional[int]:
+        """ADMM iterations of the last solve, None before the first one"""
+        return None if self._results is None else self._results.info.iter
+
+    @abstractmethod
+    def _constraints(self, n_tickers: int) -> tuple[sp.csc_matrix, np.ndarray, np.ndarray]:
+        """:return: l <= A x <= u, with weights of all tickers allowed"""
+
+    def _setup(self) -> None:
+        n_tickers = len(self.tickers)
+        n_variables = n_tickers + self.n_extra_variables
+        # dense upper triangle of the covariance block, OSQP minimizes 1/2 x^T P x
+        triu = sp.csc_matrix(np.triu(np.ones((n_tickers, n_tickers))))
+        self._p_rows = triu.indices
+        self._p_columns = np.repeat(np.arange(n_tickers), np.diff(triu.indptr))
+        p_matrix = sp.csc_matrix((np.ones(len(self._p_rows)), (self._p_rows, self._p_columns)),
+                                 shape=(n_variables, n_variables))
+        self._a_matrix, self._lower, self._upper = self._constraints(n_tickers)
+        import osqp
+        self._solver = osqp.OSQP()
+        self._solver.setup(p_matrix, np.zeros(n_variables), self._a_matrix, self._lower, self._upper,
+                           **_SOLVER_SETTINGS)
+        self._results = None
+        self.n_builds += 1
+
+    def _include_tickers(self, tickers: pd.Index) -> None:
+        """grows the universe and sets up the workspace again if some tickers are new"""
+        new_tickers = tickers.difference(self.tickers, sort=False)
+        if self._solver is None or len(new_tickers) > 0:
+            self.tickers = self.tickers.append(new_tickers)
+            self._setup()
+
+    def _solve(self, cov_matrix: pd.DataFrame, a_data: Optional[np.ndarray] = None) -> tuple[np.ndarray, np.ndarray]:
+        """
+        :param a_data: values of the constraints matrix, unchanged if None
+        :return: solution, positions of the tickers of cov_matrix in the universe
+        """
+        cov = cov_matrix.to_numpy(dtype=np.float64)
+        if not np.isfinite(cov).all():
+            raise ValueError('covariance matrix contains NaNs')
+        self._include_tickers(cov_matrix.columns)
+        columns = self.tickers.get_indexer(cov_matrix.columns)
+        universe_cov = np.zeros((len(self.tickers), len(self.tickers)))
+        universe_cov[np.ix_(columns, columns)] = cov
+        upper = self._upper.copy()
+        masked = np.ones(len(self.tickers), dtype=bool)
+        masked[columns] = False
+        upper[self._weight_rows[masked]] = 0.0
+        update = {'Px': 2.0 * universe_cov[self._p_rows, self._p_columns], 'l': self._lower, 'u': upper}
+        if a_data is not None:
+            update['Ax'] = a_data
+        self._solver.update(**update)
+        if self._results is not None and self._results.info.status_val in _SOLVED_STATUSES:
+            self._solver.warm_start(x=self._results.x, y=self._results.y)
+        self._results = self._solver.solve()
+        if self._results.info.status_val not in _SOLVED_STATUSES:
+            from pypfopt.exceptions import OptimizationError
+            raise OptimizationError(f'Solver status: {self._results.info.status}')
+        return self._results.x, columns
+
+    @staticmethod
+    def _clean_weights(weights: np.ndarray, tickers: pd.Index) -> SharesWeights:
+        """as pypfopt clean_weights: weights below 1e-4 are set to zero, the rest are rounded to 5 decimals"""
+        weights = weights.round(16) + 0.0
+        weights[np.abs(weights) < 1e-4] = 0
+        return pd.Series(np.round(weights, 5), index=tickers)
+
+
+class MinVolatilitySession(_OptimizerSession):
+    """EfficientFrontier(None, cov_matrix).min_volatility(): minimal w^T cov w, sum(w) = 1, 0 <= w <= 1"""
+
+    def _constraints(self, n_tickers: int) -> tuple[sp.csc_matrix, np.ndarray, np.ndarray]:
+        a_matrix = sp.csc_matrix(np.vstack([np.ones((1, n_tickers)), np.eye(n_tickers)]))
+        # rows of the weight bounds
+        self._weight_rows = np.arange(1, n_tickers + 1)
+        return a_matrix, np.r_[1.0, np.zeros(n_tickers)], np.r_[1.0, np.ones(n_tickers)]
+
+    def min_volatility(self, cov_matrix: pd.DataFrame) -> SharesWeights:
+        """:return: clean weights of the tickers of cov_matrix"""
+        solution, columns = self._solve(cov_matrix)
+        return self._clean_weights(solution[columns], cov_matrix.columns)
+
+
+class MaxSharpeSession(_OptimizerSession):
+    """
+    EfficientFrontier(mu, cov_matrix).max_sharpe(risk_free_rate) with long-only weights:
+    minimal w^T cov w subject to (mu - risk_free_rate)^T w = 1, sum(w) = k, w >= 0, k >= 0, weights = w / k
+    """
+    n_extra_variables = 1
+
+    def _constraints(self, n_tickers: int) -> tuple[sp.csc_matrix, np.ndarray, np.ndarray]:
+        # variables are weights and k, excess returns row is a placeholder updated for every period
+        a_matrix = sp.csc_matrix(np.block([[np.ones((1, n_tickers)), np.zeros((1, 1))],
+                                           [np.ones((1, n_tickers)), -np.ones((1, 1))],
+                                           [np.eye(n_tickers), np.zeros((n_tickers, 1))],
+                                           [np.zeros((1, n_tickers)), np.ones((1, 1))]]))
+        self._excess_returns_positions = np.flatnonzero(a_matrix.indices == 0)
+        self._weight_rows = np.arange(2, n_tickers + 2)
+        lower = np.r_[1.0, 0.0, np.zeros(n_tickers), 0.0]
+        upper = np.r_[1.0, 0.0, np.full(n_tickers, np.inf), np.inf]
+        return a_matrix, lower, upper
+
+    def max_sharpe(self,
+                   mu: pd.Series,
+                   cov_matrix: pd.DataFrame,
+                   risk_free_rate: float = 0.02) -> SharesWeights:
+        """:return: clean weights of the tickers of cov_matrix"""
+        mu = mu.reindex(cov_matrix.columns)
+        if not np.isfinite(mu.to_numpy(dtype=np.float64)).all():
+            raise ValueError('expected returns contain NaNs')
+        if mu.max() <= risk_free_rate:
+            raise ValueError('at least one of the assets must have an expected return exceeding the risk-free rate')
+        self._include_tickers(cov_matrix.columns)
+        excess_returns = np.zeros(len(self.tickers))
+        excess_returns[self.tickers.get_indexer(cov_matrix.columns)] = mu.to_numpy(dtype=np.float64) - risk_free_rate
+        a_data = self._a_matrix.data.copy()
+        a_data[self._excess_returns_positions] = excess_returns
+        solution, columns = self._solve(cov_matrix, a_data)
+        return self._clean_weights(solution[columns] / solution[-1], cov_matrix.columns)
+
+
+def estimate_covariance(covariance_kind: str, price_history: pd.DataFrame) -> pd.DataFrame:
+    """covariance estimators of portfolio_calculators, see covariance.COVARIANCE_KINDS"""
+    from pypfopt import risk_models
+    if covariance_kind == 'ledoit_wolf':
+        return risk_models.CovarianceShrinkage(price_history, frequency=252).ledoit_wolf()
+    if covariance_kind == 'exp_cov':
+        return risk_models.exp_cov(price_history, span=179)
+    raise KeyError(f'unknown covariance kind {covariance_kind}')
+
+
+class WarmStartedMaxSharpe:
+    """
+    Same weights as portfolio_calculators.compute_sharpie_weights up to solver tolerance,
+    the optimization problem is kept between calls
+    """
+    covariance_kind = 'ledoit_wolf'
+
+    def __init__(self, risk_free_rate: float = 0.02, tickers: Optional[list[str]] = None):
+        """:param tickers: initial universe of the session, i.e. BacktestPlan.tickers"""
+        self.risk_free_rate = risk_free_rate
+        self.session = MaxSharpeSession(tickers)
+
+    def __call__(self,
+                 shares_outstanding: pd.Series,
+                 price_history: pd.DataFrame,
+                 cov_matrix: Optional[pd.DataFrame] = None) -> SharesWeights:
+        if cov_matrix is None:
+            cov_matrix = estimate_covariance(self.covariance_kind, price_history)
+        from pypfopt import expected_returns
+        mu = expected_returns.capm_return(price_history)
+        return self.session.max_sharpe(mu, cov_matrix, self.risk_free_rate)
+
+
+class WarmStartedMinVolatility:
+    """
+    Same weights as portfolio_calculators.compute_ledoitw_weights ('ledoit_wolf')
+    or compute_expcov_weights ('exp_cov') up to solver tolerance, the optimization problem is kept between calls
+    """
+
+    def __init__(self, covariance_kind: str, tickers: Optional[list[str]] = None):
+        """:param tickers: initial universe of the session, i.e. BacktestPlan.tickers"""
+        self.covariance_kind = covariance_kind
+        self.session = MinVolatilitySession(tickers)
+
+    def __call__(self,
+                 shares_outstanding: pd.Series,
+                 price_history: pd.DataFrame,
+                 cov_matrix: Optional[pd.DataFrame] = None) -> SharesWeights:
+        if cov_matrix is None:
+            cov_matrix = estimate_covariance(self.covariance_kind, price_history)
+        return self.session.min_volatility(cov_matrix)
+
+
+def warm_started_calculators(tickers: Optional[list[str]] = None) -> dict[str, Union[WarmStartedMaxSharpe,
+                                                                                     WarmStartedMinVolatility]]:
+    """
+    Replacements of the cvxpy based portfolio_calculators.CALCULATORS.
+    Sessions keep state between calls, backtests running at the same time need their own dict
+    :param tickers: all tickers of the backtest, i.e. BacktestPlan.tickers, so that problems are built once
+    """
+    return {'max_sharpe': WarmStartedMaxSharpe(tickers=tickers),
+            'exp_cov': WarmStartedMinVolatility('exp_cov', tickers),
+            'ledoitw_cov': WarmStartedMinVolatility('ledoit_wolf', tickers)}
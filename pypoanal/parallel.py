@@ -0,0 +1,93 @@
+import os
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+from typing import Optional
+
+import numpy as np
+import pandas as pd
+
+import pypoanal.portfolio_calculators as pcalc
+from pypoanal.assets import SharesHistory, SharesOutstandingHistory, SharesWeights, window_shares_outstanding
+from pypoanal.backtest_plan import BacktestPlan
+
+_PRICES_FILE = 'prices.npy'
+
+# set in every worker process by _init_worker
+_worker_state: dict = dict()
+
+
+def _init_worker(prices_path: str,
+                 dates: pd.Index,
+                 tickers: pd.Index,
+                 shares_outstanding: pd.Series,
+                 shares_outstanding_history: Optional[SharesOutstandingHistory],
+                 calculators: dict[str, pcalc.PortfolioWeightsCalculator]) -> None:
+    """opens the shared price matrix once per worker, tasks only carry row and column positions"""
+    _worker_state['prices'] = np.load(prices_path, mmap_mode='r')
+    _worker_state['dates'] = dates
+    _worker_state['tickers'] = tickers
+    _worker_state['shares_outstanding'] = shares_outstanding
+    _worker_state['shares_outstanding_history'] = shares_outstanding_history
+    _worker_state['calculators'] = calculators
+
+
+def _compute_weights_task(task: tuple[str, slice, np.ndarray]) -> Optional[SharesWeights]:
+    """:return: weights, None if the calculator failed for the period"""
+    calc_name, rows, columns = task
+    prices_sample = pd.DataFrame(np.array(_worker_state['prices'][rows][:, columns]),
+                                 index=_worker_state['dates'][rows],
+                                 columns=_worker_state['tickers'][columns])
+    shares_outstanding = window_shares_outstanding(_worker_state['shares_outstanding'],
+                                                   _worker_state['shares_outstanding_history'],
+                                                   prices_sample.index)
+    try:
+        return _worker_state['calculators'][calc_name](shares_outstanding, prices_sample)
+    except pcalc.CALCULATION_ERRORS:
+        return None
+
+
+def compute_weights_in_processes(calculators: dict[str, pcalc.PortfolioWeightsCalculator],
+                                 plan: BacktestPlan,
+                                 max_workers: Optional[int] = None) -> dict[str, list[Optional[SharesWeights]]]:
+    """
+    Computes weights of every (calculator, period) pair in a process pool.
+    Weights of a period depend only on its price window, so they can be computed before the rebalance pass.
+    :param calculators: module-level functions, they are pickled by reference
+    :return: {'MCAP': [weights of the first period, None if it failed, ...], 'HRP': [...]}
+    """
+    return compute_windows_weights_in_processes(calculators,
+                                                plan.shares_history,
+                                                [(period.rows, period.liquid_tickers) for period in plan],
+                                                max_workers)
+
+
+def compute_windows_weights_in_processes(calculators: dict[str, pcalc.PortfolioWeightsCalculator],
+                                         shares_history: SharesHistory,
+                                         windows: list[tuple[slice, list[str]]],
+                                         max_workers: Optional[int] = None) -> dict[str,
+                                                                                    list[Optional[SharesWeights]]]:
+    """
+    Computes weights of every (calculator, window) pair in a process pool.
+    The price matrix is saved once to a memory-mapped file which workers open,
+    instead of pickling a price window for every task
+    :param windows: [(rows of the price history, tickers), ...]
+    :return: {'MCAP': [weights of the first window, None if it failed, ...], 'HRP': [...]}
+    """
+    price_history = shares_history.price_history
+    tickers = price_history.columns
+    tasks = [(calc_name, rows, tickers.get_indexer(window_tickers))
+             for calc_name in calculators
+             for rows, window_tickers in windows]
+    with tempfile.TemporaryDirectory() as shared_dir:
+        prices_path = os.path.join(shared_dir, _PRICES_FILE)
+        np.save(prices_path, price_history.to_numpy(dtype=np.float64))
+        with ProcessPoolExecutor(max_workers=max_workers,
+                                 initializer=_init_worker,
+                                 initargs=(prices_path,
+                                           price_history.index,
+                                           tickers,
+                                           shares_history.shares_outstanding,
+                                           shares_history.shares_outstanding_history,
+                                           calculators)) as executor:
+            weights = list(executor.map(_compute_weights_task, tasks, chunksize=max(1, len(tasks) // 64)))
+    return {calc_name: weights[n * len(windows):(n + 1) * len(windows)] for n, calc_name in enumerate(calculators)}
@@ -1,25 +1,51 @@
-from typing import Callable
+import sys
+from typing import Callable, Optional
 
 import numpy as np
 import pandas as pd
-from pypfopt import risk_models, EfficientFrontier, expected_returns, HRPOpt
 
+from pypoanal import hrp
 from pypoanal.assets import SharesWeights
 
 SharesOutstanding = pd.Series
 PriceHistory = pd.DataFrame
 # function shares_outstanding, price_history -> SharesWeights
 PortfolioWeightsCalculator = Callable[[SharesOutstanding, PriceHistory], SharesWeights]
+# function shares_outstanding, prices, windows, universes -> periods x tickers weights, see batched_calculator
+BatchedWeightsCalculator = Callable[[np.ndarray, np.ndarray, list[slice], np.ndarray], np.ndarray]
+# pypfopt and cvxpy take a second to import, they are imported by the calculators which use them.
+# Errors of the solvers can only be raised once their modules are loaded, see CALCULATION_ERRORS
+_SOLVER_ERRORS = (('cvxpy.error', 'SolverError'),
+                  ('pypfopt.exceptions', 'OptimizationError'),
+                  ('scipy.sparse.linalg', 'ArpackNoConvergence'))
+
+
+def __getattr__(name: str):
+    if name == 'CALCULATION_ERRORS':
+        # calculators raise these when weights can not be computed for a period, the backtest then keeps the old
+        # portfolio. Only errors of loaded modules are listed, so that catching them does not import the solvers
+        return tuple(getattr(sys.modules[module_name], error_name)
+                     for module_name, error_name in _SOLVER_ERRORS if module_name in sys.modules) + (ValueError,)
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
 
 
 def compute_sharpie_weights(shares_outstanding: pd.Series,
-                            price_history: pd.DataFrame) -> SharesWeights:
-    """maximaize beta=return/volatility using LedoitWolf covariance shrinkage"""
-    cov_matrix = risk_models.CovarianceShrinkage(price_history, frequency=252).ledoit_wolf()
-    mu = expected_returns.capm_return(price_history)
+                            price_history: pd.DataFrame,
+                            cov_matrix: Optional[pd.DataFrame] = None,
+                            risk_free_rate: float = 0.02,
+                            frequency: int = 252) -> SharesWeights:
+    """maximaize beta=return/volatility using LedoitWolf covariance shrinkage
+    :param cov_matrix: precomputed Ledoit-Wolf covariance of price_history, i.e. from covariance.CovarianceEngine
+    :param risk_free_rate: annual, of the CAPM returns and of the Sharpe ratio
+    :param frequency: trading days per year
+    """
+    from pypfopt import risk_models, EfficientFrontier, expected_returns
+    if cov_matrix is None:
+        cov_matrix = risk_models.CovarianceShrinkage(price_history, frequency=frequency).ledoit_wolf()
+    mu = expected_returns.capm_return(price_history, risk_free_rate=risk_free_rate, frequency=frequency)
     optimizer = EfficientFrontier(mu, cov_matrix)
     # compute efficient frontier
-    optimizer.max_sharpe(risk_free_rate=0.02)
+    optimizer.max_sharpe(risk_free_rate=risk_free_rate)
     portfolio_weights = pd.Series(dict(optimizer.clean_weights()))
     return portfolio_weights
 
@@ -43,9 +69,16 @@ def compute_mcap_weights(shares_outstanding: pd.Series,
 
 
 def compute_ledoitw_weights(shares_outstanding: pd.Series,
-                            price_history: pd.DataFrame) -> SharesWeights:
-    """Minimal volatility using Ledoit-Wolf covariance matrix shrinkage"""
-    cov_matrix = risk_models.CovarianceShrinkage(price_history, frequency=252).ledoit_wolf()
+                            price_history: pd.DataFrame,
+                            cov_matrix: Optional[pd.DataFrame] = None,
+                            frequency: int = 252) -> SharesWeights:
+    """Minimal volatility using Ledoit-Wolf covariance matrix shrinkage
+    :param cov_matrix: precomputed Ledoit-Wolf covariance of price_history, i.e. from covariance.CovarianceEngine
+    :param frequency: trading days per year
+    """
+    from pypfopt import risk_models, EfficientFrontier
+    if cov_matrix is None:
+        cov_matrix = risk_models.CovarianceShrinkage(price_history, frequency=frequency).ledoit_wolf()
     optimizer = EfficientFrontier(None, cov_matrix)
     # compute efficient frontier
     optimizer.min_volatility()
@@ -54,9 +87,18 @@ def compute_ledoitw_weights(shares_outstanding: pd.Series,
 
 
 def compute_expcov_weights(shares_outstanding: pd.Series,
-                           price_history: pd.DataFrame) -> SharesWeights:
-    """Weights giving minimal volatility using exponential covariance matrix"""
-    cov_matrix = risk_models.exp_cov(price_history, span=179)
+                           price_history: pd.DataFrame,
+                           cov_matrix: Optional[pd.DataFrame] = None,
+                           span: float = 179,
+                           frequency: int = 252) -> SharesWeights:
+    """Weights giving minimal volatility using exponential covariance matrix
+    :param cov_matrix: precomputed exponential covariance of price_history, i.e. from covariance.CovarianceEngine
+    :param span: of the exponential weights, in trading days
+    :param frequency: trading days per year
+    """
+    from pypfopt import risk_models, EfficientFrontier
+    if cov_matrix is None:
+        cov_matrix = risk_models.exp_cov(price_history, span=span, frequency=frequency)
     optimizer = EfficientFrontier(None, cov_matrix)
     # compute efficient frontier
     optimizer.min_volatility()
@@ -67,6 +109,7 @@ def compute_expcov_weights(shares_outstanding: pd.Series,
 def compute_hrp_weights(shares_outstanding: pd.Series,
                         price_history: pd.DataFrame) -> SharesWeights:
     """Hierarchical risk parity to minimize volatility"""
+    from pypfopt import expected_returns, HRPOpt
     returns = expected_returns.returns_from_prices(price_history)
     optimizer = HRPOpt(returns)
     optimizer.optimize()
@@ -74,6 +117,69 @@ def compute_hrp_weights(shares_outstanding: pd.Series,
     return portfolio_weights
 
 
+def compute_native_hrp_weights(shares_outstanding: pd.Series,
+                               price_history: pd.DataFrame,
+                               cov_matrix: Optional[pd.DataFrame] = None) -> SharesWeights:
+    """Hierarchical risk parity as compute_hrp_weights, computed with numpy instead of pypfopt.HRPOpt
+    :param cov_matrix: precomputed sample covariance of price_history returns, i.e. from covariance.CovarianceEngine
+    """
+    return hrp.NativeHRP()(shares_outstanding, price_history, cov_matrix)
+
+
+def compute_equal_weights_batched(shares_outstanding: np.ndarray,
+                                  prices: np.ndarray,
+                                  windows: list[slice],
+                                  universes: np.ndarray) -> np.ndarray:
+    """compute_equal_weights of all periods, see batched_calculator"""
+    n = universes.sum(axis=1, keepdims=True)
+    return np.divide(np.ones(universes.shape), n, out=np.zeros(universes.shape), where=universes & (n > 0))
+
+
+def _last_known_rows(prices: np.ndarray) -> np.ndarray:
+    """:return: dates x tickers position of the last row with a known price not after each row, -1 if none"""
+    return np.maximum.accumulate(np.where(np.isnan(prices), -1, np.arange(len(prices))[:, None]), axis=0)
+
+
+def compute_mcap_weights_batched(shares_outstanding: np.ndarray,
+                                 prices: np.ndarray,
+                                 windows: list[slice],
+                                 universes: np.ndarray) -> np.ndarray:
+    """compute_mcap_weights of all periods, see batched_calculator"""
+    starts = np.array([window.start for window in windows], dtype=np.int64)
+    stops = np.array([window.stop for window in windows], dtype=np.int64)
+    last_rows = _last_known_rows(prices)[np.maximum(stops - 1, 0)]
+    # forward filled price at the end of the window, prices before the window are not used
+    known = universes & (last_rows >= starts[:, None]) & (stops > starts)[:, None]
+    latest_prices = np.where(known, prices[np.maximum(last_rows, 0), np.arange(prices.shape[1])], np.nan)
+    mcap = latest_prices * shares_outstanding
+    total_mcap = np.nansum(mcap, axis=1, keepdims=True)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        weights = mcap / total_mcap
+    weights[~(weights > 0)] = 0.0
+    return weights
+
+
+# batched versions of the calculators, a backtest computes weights of all its periods in one call
+BATCHED_CALCULATORS: dict[PortfolioWeightsCalculator, BatchedWeightsCalculator] = {
+    compute_equal_weights: compute_equal_weights_batched,
+    compute_mcap_weights: compute_mcap_weights_batched
+}
+
+
+def batched_calculator(compute_weights: PortfolioWeightsCalculator) -> Optional[BatchedWeightsCalculator]:
+    """
+    Batched calculator gets the whole history at once and returns weights of every period:
+    shares_outstanding of every ticker (NaN if unknown), or periods x tickers point-in-time counts,
+    dates x tickers prices (NaN if unknown),
+    windows = rows of the price window of every period, universes = periods x tickers, True for liquid tickers.
+    Returned periods x tickers weights are 0 outside of the universe, a period row gives the same weights
+    as compute_weights(shares_outstanding, price window of its universe).
+    Calculator objects can declare theirs in a `batched` attribute
+    :return: batched version of compute_weights, None if there is none
+    """
+    return BATCHED_CALCULATORS.get(compute_weights, getattr(compute_weights, 'batched', None))
+
+
 CALCULATORS: dict[str, PortfolioWeightsCalculator] = {
     'max_sharpe': compute_sharpie_weights,
     'HRP': compute_hrp_weights,
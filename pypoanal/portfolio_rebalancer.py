@@ -3,7 +3,6 @@ import numpy as np
 from pypoanal.assets import shares_value, Portfolio, SharesWeights, SharesNumber
 from typing import Callable
 import pandas as pd
-from loguru import logger
 
 
 def _clean_weights(portfolio_weights: SharesWeights, eps=0.0001) -> SharesWeights:
@@ -82,6 +81,51 @@ class AllocationException(Exception):
     pass
 
 
+def rebalance_arrays(cash: np.float64,
+                     old_shares: np.ndarray,
+                     weights: np.ndarray,
+                     prices: np.ndarray,
+                     fees_percent=0.04) -> tuple[np.ndarray, np.float64, np.float64]:
+    """
+    Rebalancing kernel on arrays aligned to the same tickers, same results as reallocate_portfolio
+    :param old_shares: shares before rebalance, 0 for tickers not in the portfolio
+    :param weights: new portfolio weights, NaN or 0 for tickers not in the new portfolio
+    :param prices: latest prices, NaN for unknown prices
+    :return: (new shares, leftover cash, fees)
+    """
+    old_value = cash + np.nansum(prices * old_shares)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        shares = np.round(weights * old_value / prices)
+    # as _clean_weights, NaNs are dropped
+    shares[~(shares > 0.0001)] = 0.0
+    fees = np.nansum(np.abs(old_shares - shares) * prices) * fees_percent / 100.0
+    leftover = old_value - np.nansum(prices * shares) - fees
+    if leftover < 0:
+        # as _reduce_portfolio_until_leftover_positive: sell cheapest shares first
+        positions = np.flatnonzero(shares > 0)
+        for position in positions[np.argsort(prices[positions], kind='quicksort')]:
+            if leftover >= 0:
+                break
+            price = prices[position]
+            num_tickers = min(np.ceil(-leftover / price), shares[position])
+            shares[position] -= num_tickers
+            portfolio_value_change = num_tickers * price
+            leftover += portfolio_value_change
+            # additional fees, worst case estimate
+            leftover -= portfolio_value_change * fees_percent / 100.0
+        fees = np.nansum(np.abs(old_shares - shares) * prices) * fees_percent / 100.0
+        leftover = old_value - np.nansum(prices * shares) - fees
+    if fees < 0 or leftover < 0:
+        from loguru import logger
+        logger.error('fees are negative')
+        logger.debug(f'fees: {fees} leftover: {leftover}')
+        logger.debug(f'Old portolio: {old_shares.tolist()}')
+        logger.debug(f'New portolio: {weights.tolist()}')
+        logger.debug(f'Prices: {prices.tolist()}')
+        raise AllocationException('Smth gone wrong')
+    return shares, leftover, fees
+
+
 def reallocate_portfolio(old_portfolio: Portfolio,
                          new_portfolio_weights: SharesWeights,
                          latest_prices: pd.Series,
@@ -92,31 +136,16 @@ def reallocate_portfolio(old_portfolio: Portfolio,
     :param latest_prices: shares prices
     :return (allocated equity, fees)
     """
-    portfolio_value = old_portfolio.value(latest_prices)
-    # portfolio_estimate: PortfolioShares = np.ceil(new_portfolio_weights * total_value / latest_prices)
-    portfolio_estimate: SharesNumber = np.round(new_portfolio_weights * portfolio_value / latest_prices)
-    portfolio_estimate = _clean_weights(portfolio_estimate)
-    leftover_fn = lambda portfolio: _compute_leftover_after_rebalance(old_portfolio,
-                                                                      portfolio,
-                                                                      latest_prices,
-                                                                      fees_percent)
-    reduced_portfolio = _reduce_portfolio_until_leftover_positive(portfolio_estimate,
-                                                                  latest_prices,
-                                                                  leftover_fn,
-                                                                  fees_percent)
-    leftover = leftover_fn(reduced_portfolio)
-    fees = _compute_fees_for_rebalance(old_portfolio.shares,
-                                       reduced_portfolio,
-                                       latest_prices,
-                                       fees_percent)
-    if fees < 0 or leftover < 0:
-        logger.error('fees are negative')
-        logger.debug(f'fees: {fees} leftover: {leftover}')
-        logger.debug(f'Old portolio: {old_portfolio.shares.to_list()}')
-        logger.debug(f'New portolio: {new_portfolio_weights.to_list()}')
-        logger.debug(f'Prices: {latest_prices.to_list()}')
-        raise AllocationException('Smth gone wrong')
-    return Portfolio(cash=leftover, shares=_clean_weights(reduced_portfolio)), fees
+    # tickers in the order of pandas alignment of weights and prices,
+    # old shares of tickers without price do not add value
+    tickers = new_portfolio_weights.index.union(latest_prices.index)
+    shares, leftover, fees = rebalance_arrays(old_portfolio.cash,
+                                              old_portfolio.shares.reindex(tickers, fill_value=0.0)
+                                              .to_numpy(dtype=np.float64),
+                                              new_portfolio_weights.reindex(tickers).to_numpy(dtype=np.float64),
+                                              latest_prices.reindex(tickers).to_numpy(dtype=np.float64),
+                                              fees_percent)
+    return Portfolio(cash=leftover, shares=pd.Series(shares, index=tickers)[shares > 0.0001]), fees
 
 
 def allocate_discrete(portfolio_weights: SharesWeights,
@@ -0,0 +1,118 @@
+import datetime
+import json
+import os
+from typing import Iterable, Optional
+
+import numpy as np
+import pandas as pd
+
+STORE_DIR = 'priceVolStore'
+_DATES_FILE = 'dates.npy'
+_TICKERS_FILE = 'tickers.txt'
+_PRICES_FILE = 'adj_close.npy'
+_VOLUMES_FILE = 'volume.npy'
+# directory of the csv files the store was converted from, ticker -> modification time of its csv file
+_SOURCES_FILE = 'sources.json'
+
+
+def store_exists(store_dir: str = STORE_DIR) -> bool:
+    """True if all files of the columnar store are present in store_dir"""
+    return all(os.path.exists(os.path.join(store_dir, filename))
+               for filename in (_DATES_FILE, _TICKERS_FILE, _PRICES_FILE, _VOLUMES_FILE))
+
+
+def write_store(prices_history: pd.DataFrame,
+                volume_history: pd.DataFrame,
+                store_dir: str = STORE_DIR,
+                source_mtimes: Optional[dict[str, int]] = None,
+                source_dir: Optional[str] = None) -> None:
+    """
+    Saves aligned price and volume tables as two dates x tickers float64 matrices
+    :param prices_history: table indexed with dates, column = tickers, i.e. 'GOOG', 'AMZN',...
+    :param volume_history: table with the same index and columns as prices_history
+    :param source_mtimes: ticker -> st_mtime_ns of the file the ticker was read from, to detect a stale store
+    :param source_dir: directory of these files
+    """
+    volume_history = volume_history.reindex(index=prices_history.index, columns=prices_history.columns)
+    os.makedirs(store_dir, exist_ok=True)
+    dates = pd.DatetimeIndex(prices_history.index).values.astype('datetime64[ns]')
+    np.save(os.path.join(store_dir, _DATES_FILE), dates)
+    np.save(os.path.join(store_dir, _PRICES_FILE), prices_history.to_numpy(dtype=np.float64))
+    np.save(os.path.join(store_dir, _VOLUMES_FILE), volume_history.to_numpy(dtype=np.float64))
+    with open(os.path.join(store_dir, _TICKERS_FILE), 'w') as tickers_file:
+        tickers_file.write('\n'.join(prices_history.columns))
+    with open(os.path.join(store_dir, _SOURCES_FILE), 'w') as sources_file:
+        json.dump({'data_dir': source_dir, 'mtimes': source_mtimes or dict()}, sources_file)
+
+
+class PriceVolumeStore:
+    """
+    Memory-mapped dates x tickers matrices of 'Adj Close' and 'Volume'.
+    Opening does not read the matrices, slicing reads only the requested rows and columns.
+    """
+
+    def __init__(self, store_dir: str = STORE_DIR):
+        self.store_dir = store_dir
+        self.dates = pd.DatetimeIndex(np.load(os.path.join(store_dir, _DATES_FILE)), name='Date')
+        with open(os.path.join(store_dir, _TICKERS_FILE)) as tickers_file:
+            tickers_text = tickers_file.read()
+        self.tickers = pd.Index(tickers_text.split('\n') if tickers_text else [], dtype=object)
+        self.prices = np.load(os.path.join(store_dir, _PRICES_FILE), mmap_mode='r')
+        self.volumes = np.load(os.path.join(store_dir, _VOLUMES_FILE), mmap_mode='r')
+        sources_path = os.path.join(store_dir, _SOURCES_FILE)
+        # csv files the store was converted from, see dataloader.convert_csv_dir_to_store
+        self.source_dir: Optional[str] = None
+        self.source_mtimes: dict[str, int] = dict()
+        if os.path.exists(sources_path):
+            with open(sources_path) as sources_file:
+                sources = json.load(sources_file)
+            self.source_dir = sources['data_dir']
+            self.source_mtimes = sources['mtimes']
+
+    def __contains__(self, ticker: str) -> bool:
+        return ticker in self.tickers
+
+    def _rows(self, start_date: Optional[datetime.date], end_date: Optional[datetime.date]) -> slice:
+        """same rows as DataFrame.loc[start_date:end_date]"""
+        return self.dates.slice_indexer(start_date, end_date)
+
+    def _columns(self, tickers: Optional[Iterable[str]]) -> tuple[np.ndarray, pd.Index]:
+        if tickers is None:
+            return np.arange(len(self.tickers)), self.tickers
+        tickers = pd.Index(tickers)
+        positions = self.tickers.get_indexer(tickers)
+        if (positions < 0).any():
+            raise KeyError(f'tickers are not in the store: {tickers[positions < 0].tolist()}')
+        return positions, tickers
+
+    def _slice(self, matrix: np.ndarray,
+               tickers: Optional[Iterable[str]],
+               start_date: Optional[datetime.date],
+               end_date: Optional[datetime.date]) -> pd.DataFrame:
+        rows = self._rows(start_date, end_date)
+        positions, tickers = self._columns(tickers)
+        values = np.asarray(matrix[rows][:, positions], dtype=np.float64)
+        return pd.DataFrame(values, index=self.dates[rows], columns=tickers)
+
+    def price_history(self, tickers: Optional[Iterable[str]] = None,
+                      start_date: Optional[datetime.date] = None,
+                      end_date: Optional[datetime.date] = None) -> pd.DataFrame:
+        """
+        :return: prices table indexed with dates, column = tickers, i.e. 'GOOG', 'AMZN',...
+        """
+        return self._slice(self.prices, tickers, start_date, end_date)
+
+    def volume_history(self, tickers: Optional[Iterable[str]] = None,
+                       start_date: Optional[datetime.date] = None,
+                       end_date: Optional[datetime.date] = None) -> pd.DataFrame:
+        """
+        :return: volumes table indexed with dates, column = tickers, i.e. 'GOOG', 'AMZN',...
+        """
+        return self._slice(self.volumes, tickers, start_date, end_date)
+
+    def price_and_volume_histories(self, tickers: Iterable[str]) -> tuple[pd.DataFrame, pd.DataFrame]:
+        """Same output as dataloader.load_price_and_volume_histories: rows where all tickers are NaN are dropped"""
+        prices_history = self.price_history(tickers)
+        volume_history = self.volume_history(tickers)
+        has_data = prices_history.notna().any(axis=1) | volume_history.notna().any(axis=1)
+        return prices_history[has_data], volume_history[has_data]
@@ -0,0 +1,105 @@
+import json
+import time
+from contextlib import contextmanager, nullcontext
+from typing import ContextManager, Iterator, Optional
+
+import pandas as pd
+
+# stages of a backtest period
+LIQUIDITY = 'liquidity'
+SLICING = 'slicing'
+COVARIANCE = 'covariance'
+WEIGHTS = 'weights'
+REBALANCE = 'rebalance'
+
+_NULL_STAGE = nullcontext()
+
+
+class NullProfiler:
+    """Profiler interface, records nothing. Default of the backtest functions, costs one call per stage"""
+    enabled = False
+
+    def stage(self, stage: str, period: Optional[int] = None, calculator: Optional[str] = None) -> ContextManager:
+        """context measuring one stage of a period"""
+        return _NULL_STAGE
+
+    def record_failure(self, period: Optional[int], calculator: Optional[str], error: BaseException) -> None:
+        """weights calculator raised error, the portfolio was kept, period is None for a batched call"""
+
+    def record_iterations(self, period: int, calculator: Optional[str], iterations: Optional[int]) -> None:
+        """solver iterations of the last weights stage"""
+
+
+NULL_PROFILER = NullProfiler()
+
+
+class BacktestProfiler(NullProfiler):
+    """
+    Wall time of every stage of every period and calculator, solver iterations and calculation errors.
+    Pass the same profiler to BacktestPlan and to the backtest functions, then export with to_dataframe or to_json
+    """
+    enabled = True
+
+    def __init__(self):
+        self.records: list[dict] = []
+        self._origin = time.perf_counter()
+
+    @contextmanager
+    def stage(self, stage: str, period: Optional[int] = None, calculator: Optional[str] = None) -> Iterator[None]:
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.records.append({'calculator': calculator, 'period': period, 'stage': stage,
+                                 'start': start - self._origin, 'seconds': time.perf_counter() - start})
+
+    def _last_weights_record(self, period: Optional[int], calculator: Optional[str]) -> dict:
+        for record in reversed(self.records):
+            if record['stage'] == WEIGHTS and record['period'] == period and record['calculator'] == calculator:
+                return record
+        record = {'calculator': calculator, 'period': period, 'stage': WEIGHTS,
+                  'start': time.perf_counter() - self._origin, 'seconds': 0.0}
+        self.records.append(record)
+        return record
+
+    def record_failure(self, period: Optional[int], calculator: Optional[str], error: BaseException) -> None:
+        self._last_weights_record(period, calculator)['error'] = f'{type(error).__name__}: {error}'
+
+    def record_iterations(self, period: int, calculator: Optional[str], iterations: Optional[int]) -> None:
+        if iterations is not None:
+            self._last_weights_record(period, calculator)['iterations'] = iterations
+
+    def to_dataframe(self) -> pd.DataFrame:
+        """
+        :return: one row per measured stage, columns = calculator, period, stage, start, seconds, iterations, error.
+        start is in seconds since the profiler was created, calculator is None for stages shared by calculators
+        """
+        columns = ['calculator', 'period', 'stage', 'start', 'seconds', 'iterations', 'error']
+        return pd.DataFrame(self.records, columns=columns)
+
+    def summary(self) -> pd.DataFrame:
+        """:return: total seconds and number of calls per calculator and stage"""
+        records = self.to_dataframe()
+        records['calculator'] = records['calculator'].fillna('')
+        return records.groupby(['calculator', 'stage'])['seconds'].agg(['sum', 'count'])
+
+    def to_json(self, path: str) -> None:
+        """saves the stages in the trace event format of chrome://tracing and https://ui.perfetto.dev"""
+        # one trace thread per calculator, stages shared by calculators are on the 'plan' thread
+        thread_ids = {name: thread_id for thread_id, name in
+                      enumerate(dict.fromkeys(record['calculator'] or 'plan' for record in self.records))}
+        events = [{'name': 'thread_name', 'ph': 'M', 'pid': 0, 'tid': thread_id, 'args': {'name': name}}
+                  for name, thread_id in thread_ids.items()]
+        for record in self.records:
+            args = {key: record[key] for key in ('period', 'iterations', 'error') if record.get(key) is not None}
+            events.append({'name': record['stage'], 'cat': 'backtest', 'ph': 'X',
+                           'ts': record['start'] * 1e6, 'dur': record['seconds'] * 1e6,
+                           'pid': 0, 'tid': thread_ids[record['calculator'] or 'plan'], 'args': args})
+        with open(path, 'w') as trace_file:
+            json.dump({'traceEvents': events}, trace_file)
+
+
+def solver_iterations(compute_weights) -> Optional[int]:
+    """iterations of the last solve of calculators keeping a solver session, i.e. optimizer_session calculators"""
+    session = getattr(compute_weights, 'session', None)
+    return getattr(session, 'iterations', None)
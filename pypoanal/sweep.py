@@ -0,0 +1,259 @@
+import collections
+import datetime
+import itertools
+from concurrent.futures import Executor
+from typing import Any, Callable, Iterable, Iterator, Optional
+
+import numpy as np
+import pandas as pd
+
+import pypoanal.portfolio_calculators as pcalc
+from pypoanal import backtester, parallel
+from pypoanal.assets import SharesHistory, SharesWeights, window_shares_outstanding
+from pypoanal.backtest_plan import BacktestPlan
+from pypoanal.liquidity import LiquidityIndex
+
+# (first row, row after the last, liquid tickers) of a price window
+WindowKey = tuple[int, int, tuple[str, ...]]
+
+
+def random_start_dates(first_date: datetime.date,
+                       last_date: datetime.date,
+                       n_dates: int,
+                       seed: Optional[int] = None) -> list[datetime.date]:
+    """n_dates uniformly distributed random dates in [first_date, last_date], sorted"""
+    rng = np.random.default_rng(seed)
+    days = rng.integers(0, (last_date - first_date).days + 1, size=n_dates)
+    return [first_date + datetime.timedelta(days=int(day)) for day in np.sort(days)]
+
+
+def _window_key(rows: slice, liquid_tickers: list[str]) -> WindowKey:
+    return rows.start, rows.stop, tuple(liquid_tickers)
+
+
+def _compute_unique_windows_weights(calculators: dict[str, pcalc.PortfolioWeightsCalculator],
+                                    shares_history: SharesHistory,
+                                    windows: list[WindowKey],
+                                    max_workers: Optional[int],
+                                    progress_bar: bool) -> dict[str, dict[WindowKey, Optional[SharesWeights]]]:
+    """:return: {'MCAP': {window: weights, None if the calculator failed}}"""
+    if max_workers is not None:
+        weights_per_calc = parallel.compute_windows_weights_in_processes(
+            calculators, shares_history, [(slice(start, stop), list(tickers)) for start, stop, tickers in windows],
+            max_workers)
+        return {calc_name: dict(zip(windows, weights)) for calc_name, weights in weights_per_calc.items()}
+    import tqdm
+    price_history = shares_history.price_history
+    windows_weights = {calc_name: dict() for calc_name in calculators}
+    for start, stop, tickers in tqdm.tqdm(windows, disable=not progress_bar):
+        prices_sample = price_history.iloc[start:stop].loc[:, list(tickers)]
+        shares_outstanding = window_shares_outstanding(shares_history.shares_outstanding,
+                                                       shares_history.shares_outstanding_history,
+                                                       prices_sample.index)
+        for calc_name, compute_weights in calculators.items():
+            try:
+                weights = compute_weights(shares_outstanding, prices_sample)
+            except pcalc.CALCULATION_ERRORS:
+                weights = None
+            windows_weights[calc_name][(start, stop, tickers)] = weights
+    return windows_weights
+
+
+def sweep_start_dates(calculators: dict[str, pcalc.PortfolioWeightsCalculator],
+                      shares_history: SharesHistory,
+                      start_dates: list[datetime.date],
+                      backtest_end_date: datetime.date,
+                      rebalance_period: datetime.timedelta,
+                      initial_cash: np.float64,
+                      fees_percent=np.float64(0.04),
+                      max_workers: Optional[int] = None,
+                      progress_bar: bool = True) -> pd.DataFrame:
+    """
+    Monte-Carlo over backtest start dates: periodic rebalance is restarted at each start date.
+    Optimization problems with the same price window and liquid tickers are solved once for all start dates
+    :param start_dates: i.e. random_start_dates(datetime.date(2006, 8, 8), datetime.date(2014, 8, 8), 400)
+    :param max_workers: if set, unique problems are solved in a pool of max_workers processes
+    :return: tidy table with columns 'start_date', 'calculator', 'date', 'value', 'fees',
+    one row per rebalance date of each run
+    """
+    plans = _start_dates_plans(shares_history, start_dates, backtest_end_date, rebalance_period)
+    # deduplicate optimization problems across runs
+    windows = list(dict.fromkeys(_window_key(period.rows, period.liquid_tickers)
+                                 for plan in plans
+                                 for period in plan))
+    windows_weights = _compute_unique_windows_weights(calculators, shares_history, windows, max_workers, progress_bar)
+    results = []
+    for start_date, plan in zip(start_dates, plans):
+        for calc_name, compute_weights in calculators.items():
+            precomputed_weights = [windows_weights[calc_name][_window_key(period.rows, period.liquid_tickers)]
+                                   for period in plan]
+            results.append(_run_with_weights(compute_weights, plan, precomputed_weights, initial_cash, fees_percent)
+                           .assign(start_date=start_date, calculator=calc_name))
+    return pd.concat(results, ignore_index=True)[['start_date', 'calculator', 'date', 'value', 'fees']]
+
+
+def _start_dates_plans(shares_history: SharesHistory,
+                       start_dates: list[datetime.date],
+                       backtest_end_date: datetime.date,
+                       rebalance_period: datetime.timedelta) -> list[BacktestPlan]:
+    """plans of periodic rebalances restarted at each start date, sharing liquidity and forward filled prices"""
+    liquidity_index = LiquidityIndex(shares_history.volume_history)
+    forward_filled_price_history = shares_history.price_history.fillna(method='ffill')
+    return [BacktestPlan(shares_history,
+                         backtester.compute_rebalance_dates(start_date, backtest_end_date, rebalance_period),
+                         liquidity_index,
+                         forward_filled_price_history)
+            for start_date in start_dates]
+
+
+def _run_with_weights(compute_weights: pcalc.PortfolioWeightsCalculator,
+                      plan: BacktestPlan,
+                      precomputed_weights: list[Optional[SharesWeights]],
+                      initial_cash: np.float64,
+                      fees_percent: np.float64) -> pd.DataFrame:
+    """:return: 'date', 'value', 'fees' of every rebalance date of the plan"""
+    portfolios, fees_history = backtester.reallocate_portfolio_periodically(compute_weights,
+                                                                            plan.rebalance_dates,
+                                                                            initial_cash,
+                                                                            fees_percent,
+                                                                            plan.shares_history,
+                                                                            progress_bar=False,
+                                                                            plan=plan,
+                                                                            precomputed_weights=precomputed_weights)
+    return pd.DataFrame({'date': plan.rebalance_dates,
+                         'value': portfolios.values(plan.prices_at_rebalance_dates),
+                         'fees': fees_history})
+
+
+def parameter_grid(grid: dict[str, list[Any]]) -> list[dict[str, Any]]:
+    """{'span': [60, 179], 'frequency': [252]} -> [{'span': 60, 'frequency': 252}, {'span': 179, 'frequency': 252}]"""
+    return [dict(zip(grid, values)) for values in itertools.product(*grid.values())]
+
+
+def parameters_label(params: dict[str, Any]) -> str:
+    """{'span': 60, 'frequency': 252} -> 'frequency=252, span=60', '' for default parameters"""
+    return ', '.join(f'{name}={value}' for name, value in sorted(params.items()))
+
+
+# (calculator name, parameters) -> weights, None if the calculator failed
+_WindowWeights = dict[tuple[str, str], Optional[SharesWeights]]
+
+
+def _solve_window_problems(task: tuple[pd.Series, pd.DataFrame, list[tuple]]) -> _WindowWeights:
+    """
+    solves problems of one price window, covariances are computed beforehand
+    :param task: shares outstanding, price window, [(calc_name, compute_weights, params, cov_matrix or None), ...]
+    """
+    shares_outstanding, prices_sample, problems = task
+    weights = dict()
+    for calc_name, compute_weights, params, cov_matrix in problems:
+        kwargs = dict(params) if cov_matrix is None else dict(params, cov_matrix=cov_matrix)
+        try:
+            weights[(calc_name, parameters_label(params))] = compute_weights(shares_outstanding, prices_sample,
+                                                                             **kwargs)
+        except pcalc.CALCULATION_ERRORS:
+            weights[(calc_name, parameters_label(params))] = None
+    return weights
+
+
+def _map_bounded(executor: Executor, function: Callable, tasks: Iterable, max_pending: int) -> Iterator:
+    """
+    as executor.map, but tasks are taken from the iterable as results are consumed,
+    so that at most max_pending tasks and their inputs are held at once
+    """
+    pending = collections.deque()
+    for task in tasks:
+        if len(pending) == max_pending:
+            yield pending.popleft().result()
+        pending.append(executor.submit(function, task))
+    while pending:
+        yield pending.popleft().result()
+
+
+def sweep_hyperparameters(calculators: dict[str, pcalc.PortfolioWeightsCalculator],
+                          grids: dict[str, dict[str, list[Any]]],
+                          shares_history: SharesHistory,
+                          start_dates: list[datetime.date],
+                          backtest_end_date: datetime.date,
+                          rebalance_period: datetime.timedelta,
+                          initial_cash: np.float64,
+                          fees_percent=np.float64(0.04),
+                          max_workers: Optional[int] = None,
+                          progress_bar: bool = True) -> pd.DataFrame:
+    """
+    sweep_start_dates over a grid of hyperparameters of every calculator.
+    Price windows are deduplicated across start dates, the covariance of a window is estimated once
+    for all grid points and calculators sharing the estimator, span and frequency, see covariance.CovarianceEngine.
+    Covariances are rolled from window to window in this process, optimization problems are solved per window
+    :param grids: calculator name -> {keyword argument: values}, i.e.
+    {'max_sharpe': {'risk_free_rate': [0.0, 0.02, 0.04]}, 'exp_cov': {'span': [60, 179, 360]}},
+    calculators without a grid run with their default parameters
+    :param max_workers: if set, windows are solved in a pool of max_workers processes,
+    calculators must be module-level functions. Covariances and price windows are prepared while the pool solves,
+    for at most 2 * max_workers windows ahead
+    :return: tidy table with columns 'start_date', 'calculator', 'params', 'date', 'value', 'fees',
+    one row per rebalance date of each run, params = parameters_label of the grid point, see results_cube
+    """
+    from pypoanal.covariance import CovarianceEngine, covariance_kind
+    plans = _start_dates_plans(shares_history, start_dates, backtest_end_date, rebalance_period)
+    grid_points = {calc_name: parameter_grid(grids.get(calc_name, {})) for calc_name in calculators}
+    # deduplicate windows across runs, in window order so that covariance estimators roll forward
+    windows = dict()
+    for plan in plans:
+        for period in plan:
+            windows.setdefault(_window_key(period.rows, period.liquid_tickers), period)
+    windows = dict(sorted(windows.items(), key=lambda key_period: key_period[0][:2]))
+    engine = None
+    if any(covariance_kind(compute_weights) is not None for compute_weights in calculators.values()):
+        universe = list(dict.fromkeys(ticker for period in windows.values() for ticker in period.liquid_tickers))
+        engine = CovarianceEngine(plans[0], tickers=universe)
+
+    def tasks():
+        for period in windows.values():
+            problems = []
+            for calc_name, compute_weights in calculators.items():
+                for params in grid_points[calc_name]:
+                    cov_matrix = (engine.cov_matrix_for(compute_weights, period, params.get('span'),
+                                                        params.get('frequency')) if engine is not None else None)
+                    problems.append((calc_name, compute_weights, params, cov_matrix))
+            # read, not cached in the period: windows are kept until all of them are solved
+            yield period.shares_outstanding, period.read_prices_sample(), problems
+
+    import tqdm
+    if max_workers is None:
+        windows_weights = list(map(_solve_window_problems, tqdm.tqdm(tasks(), total=len(windows),
+                                                                      disable=not progress_bar)))
+    else:
+        from concurrent.futures import ProcessPoolExecutor
+        with ProcessPoolExecutor(max_workers=max_workers) as executor:
+            windows_weights = list(_map_bounded(executor, _solve_window_problems, tasks(), 2 * max_workers))
+    windows_weights = dict(zip(windows, windows_weights))
+    results = []
+    for start_date, plan in zip(start_dates, plans):
+        for calc_name, compute_weights in calculators.items():
+            for params in grid_points[calc_name]:
+                label = parameters_label(params)
+                precomputed_weights = [windows_weights[_window_key(period.rows, period.liquid_tickers)][
+                                           (calc_name, label)] for period in plan]
+                results.append(_run_with_weights(compute_weights, plan, precomputed_weights, initial_cash,
+                                                 fees_percent).assign(start_date=start_date, calculator=calc_name,
+                                                                      params=label))
+    return pd.concat(results, ignore_index=True)[['start_date', 'calculator', 'params', 'date', 'value', 'fees']]
+
+
+def results_cube(results: pd.DataFrame, baseline: Optional[str] = 'MCAP') -> pd.DataFrame:
+    """
+    :param results: of sweep_hyperparameters
+    :param baseline: calculator run with default parameters, final values are divided by its final values
+    of the same start date, raw final values if None. ValueError if the sweep has no such run
+    :return: final portfolio values, index = (calculator, params), columns = start dates
+    """
+    final_values = results.sort_values('date').groupby(['calculator', 'params', 'start_date'])['value'].last()
+    cube = final_values.unstack('start_date')
+    if baseline is not None:
+        if (baseline, '') not in cube.index:
+            raise ValueError(f'baseline {baseline!r} was not run with default parameters, '
+                             f'calculators of the sweep: {sorted(cube.index.unique("calculator"))}, '
+                             f'pass baseline=None for raw final values')
+        cube = cube / cube.loc[(baseline, '')]
+    return cube
@@ -0,0 +1,227 @@
+import functools
+import hashlib
+import os
+import types
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import Any, Optional
+
+import numpy as np
+import pandas as pd
+
+import pypoanal.portfolio_calculators as pcalc
+from pypoanal.assets import SharesWeights
+
+
+@dataclass
+class CacheStats:
+    hits: int = 0
+    disk_hits: int = 0
+    misses: int = 0
+    evictions: int = 0
+    # (first date, last date, number of tickers) of each recomputed window
+    recomputed: list[tuple[Any, Any, int]] = field(default_factory=list)
+
+
+def _code_fingerprint(code: types.CodeType) -> str:
+    """bytecode and constants, nested functions included, without memory addresses of code objects"""
+    constants = [_code_fingerprint(constant) if isinstance(constant, types.CodeType) else repr(constant)
+                 for constant in code.co_consts]
+    return code.co_code.hex() + repr(constants) + repr(code.co_names)
+
+
+def calculator_version(compute_weights: pcalc.PortfolioWeightsCalculator, version: Optional[str] = None) -> str:
+    """
+    Identifies the code of a calculator: module, qualified name and bytecode of the function,
+    or of __call__ of a calculator object, and a version given by the user.
+    Changes of functions called by the calculator are not detected, bump version for them
+    :param version: i.e. '2'
+    """
+    if isinstance(compute_weights, functools.partial):
+        return calculator_version(compute_weights.func, version) + repr((compute_weights.args,
+                                                                         sorted(compute_weights.keywords.items())))
+    function = compute_weights if isinstance(compute_weights, types.FunctionType) else type(compute_weights).__call__
+    code = getattr(function, '__code__', None)
+    return '\0'.join([getattr(function, '__module__', None) or '',
+                      getattr(function, '__qualname__', None) or type(compute_weights).__qualname__,
+                      _code_fingerprint(code) if code is not None else '',
+                      version or ''])
+
+
+def window_key(calc_name: str,
+               params: dict[str, Any],
+               shares_outstanding: pd.Series,
+               price_history: pd.DataFrame,
+               version: str = '') -> str:
+    """
+    Hash of everything a calculator depends on: its name, code version and parameters,
+    the price window (values, dates, tickers) and shares outstanding of the window tickers
+    :param version: see calculator_version
+    """
+    key_hash = hashlib.blake2b(digest_size=20)
+    key_hash.update(calc_name.encode())
+    key_hash.update(version.encode())
+    key_hash.update(repr(sorted(params.items())).encode())
+    key_hash.update('\0'.join(map(str, price_history.columns)).encode())
+    key_hash.update(np.ascontiguousarray(price_history.index.values).view(np.uint8)
+                    if price_history.index.dtype.kind == 'M' else
+                    '\0'.join(map(str, price_history.index)).encode())
+    key_hash.update(np.ascontiguousarray(price_history.to_numpy(dtype=np.float64)).view(np.uint8))
+    key_hash.update(np.ascontiguousarray(shares_outstanding.reindex(price_history.columns)
+                                         .to_numpy(dtype=np.float64)).view(np.uint8))
+    return key_hash.hexdigest()
+
+
+class WeightsCache:
+    """
+    LRU cache of calculated weights, limited by memory size, with optional persistence to cache_dir.
+    Files in cache_dir are evicted oldest-used first when they exceed max_disk_bytes.
+    cache_dir is listed once when the cache is created, then sizes of the files are kept in memory,
+    so a cache_dir shared by several processes can exceed max_disk_bytes
+    """
+
+    def __init__(self,
+                 max_bytes: int = 256 * 2 ** 20,
+                 cache_dir: Optional[str] = None,
+                 max_disk_bytes: int = 2 ** 30):
+        self.max_bytes = max_bytes
+        self.cache_dir = cache_dir
+        self.max_disk_bytes = max_disk_bytes
+        self._entries: OrderedDict[str, SharesWeights] = OrderedDict()
+        self._entries_bytes = 0
+        # statistics per calculator name
+        self.stats: dict[str, CacheStats] = dict()
+        # file path -> size of the files in cache_dir, oldest used first
+        self._disk_files: OrderedDict[str, int] = OrderedDict()
+        self._disk_bytes = 0
+        if cache_dir is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+            cached_files = [os.path.join(cache_dir, filename)
+                            for filename in os.listdir(cache_dir) if filename.endswith('.pkl')]
+            for path in sorted(cached_files, key=os.path.getmtime):
+                self._disk_files[path] = os.path.getsize(path)
+            self._disk_bytes = sum(self._disk_files.values())
+
+    def _disk_path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, key + '.pkl')
+
+    @staticmethod
+    def _size(weights: SharesWeights) -> int:
+        return int(weights.memory_usage(index=True, deep=True))
+
+    def _get(self, key: str) -> tuple[Optional[SharesWeights], str, int]:
+        """:return: weights or None, 'hit', 'disk_hit' or 'miss', number of memory entries evicted by a disk hit"""
+        if key in self._entries:
+            self._entries.move_to_end(key)
+            return self._entries[key], 'hit', 0
+        if self.cache_dir is not None and os.path.exists(self._disk_path(key)):
+            weights = pd.read_pickle(self._disk_path(key))
+            # mark as recently used for disk eviction
+            os.utime(self._disk_path(key))
+            if self._disk_path(key) in self._disk_files:
+                self._disk_files.move_to_end(self._disk_path(key))
+            return weights, 'disk_hit', self._put_in_memory(key, weights)
+        return None, 'miss', 0
+
+    def _put_in_memory(self, key: str, weights: SharesWeights) -> int:
+        """:return: number of evicted entries"""
+        self._entries[key] = weights
+        self._entries_bytes += self._size(weights)
+        evictions = 0
+        while self._entries_bytes > self.max_bytes and len(self._entries) > 1:
+            _, evicted_weights = self._entries.popitem(last=False)
+            self._entries_bytes -= self._size(evicted_weights)
+            evictions += 1
+        return evictions
+
+    def _put_on_disk(self, key: str, weights: SharesWeights) -> None:
+        path = self._disk_path(key)
+        weights.to_pickle(path)
+        self._disk_bytes += os.path.getsize(path) - self._disk_files.pop(path, 0)
+        self._disk_files[path] = os.path.getsize(path)
+        while self._disk_bytes > self.max_disk_bytes and self._disk_files:
+            evicted_path, size = self._disk_files.popitem(last=False)
+            self._disk_bytes -= size
+            try:
+                os.remove(evicted_path)
+            except FileNotFoundError:
+                # removed by another process sharing cache_dir
+                pass
+
+    def get_or_compute(self,
+                       calc_name: str,
+                       compute_weights: pcalc.PortfolioWeightsCalculator,
+                       shares_outstanding: pd.Series,
+                       price_history: pd.DataFrame,
+                       code_version: Optional[str] = None,
+                       **params) -> SharesWeights:
+        """:param code_version: calculator_version(compute_weights) if None"""
+        stats = self.stats.setdefault(calc_name, CacheStats())
+        if code_version is None:
+            code_version = calculator_version(compute_weights)
+        key = window_key(calc_name, params, shares_outstanding, price_history, code_version)
+        weights, outcome, evictions = self._get(key)
+        stats.evictions += evictions
+        if outcome == 'hit':
+            stats.hits += 1
+        elif outcome == 'disk_hit':
+            stats.disk_hits += 1
+        else:
+            stats.misses += 1
+            stats.recomputed.append((price_history.index[0] if len(price_history) else None,
+                                     price_history.index[-1] if len(price_history) else None,
+                                     len(price_history.columns)))
+            weights = compute_weights(shares_outstanding, price_history, **params)
+            stats.evictions += self._put_in_memory(key, weights)
+            if self.cache_dir is not None:
+                self._put_on_disk(key, weights)
+        return weights.copy()
+
+    def cached(self,
+               compute_weights: pcalc.PortfolioWeightsCalculator,
+               calc_name: Optional[str] = None,
+               version: Optional[str] = None,
+               **params) -> 'CachedCalculator':
+        """
+        :param calc_name: name in the cache key and statistics, function name by default
+        :param version: part of the cache key along with the code of compute_weights, see calculator_version
+        :param params: keyword parameters passed to compute_weights, part of the cache key
+        :return: calculator with the same signature as compute_weights
+        """
+        return CachedCalculator(self, compute_weights, calc_name or compute_weights.__name__, params,
+                                calculator_version(compute_weights, version))
+
+    def stats_table(self) -> pd.DataFrame:
+        """hits, disk hits, misses and evictions per calculator"""
+        return pd.DataFrame({calc_name: {'hits': stats.hits,
+                                         'disk_hits': stats.disk_hits,
+                                         'misses': stats.misses,
+                                         'evictions': stats.evictions}
+                             for calc_name, stats in self.stats.items()}).T
+
+    def clear(self) -> None:
+        """clears memory entries and statistics, files in cache_dir are kept"""
+        self._entries.clear()
+        self._entries_bytes = 0
+        self.stats.clear()
+
+
+@dataclass
+class CachedCalculator:
+    """PortfolioWeightsCalculator looking up weights in the cache before computing them"""
+    cache: WeightsCache
+    compute_weights: pcalc.PortfolioWeightsCalculator
+    calc_name: str
+    params: dict[str, Any]
+    # see calculator_version
+    code_version: str
+
+    def __call__(self, shares_outstanding: pd.Series, price_history: pd.DataFrame) -> SharesWeights:
+        return self.cache.get_or_compute(self.calc_name, self.compute_weights, shares_outstanding, price_history,
+                                         self.code_version, **self.params)
+
+
+def cached_calculators(calculators: dict[str, pcalc.PortfolioWeightsCalculator],
+                       cache: WeightsCache) -> dict[str, CachedCalculator]:
+    """i.e. cached_calculators(CALCULATORS, WeightsCache(cache_dir='weightsCache'))"""
+    return {calc_name: cache.cached(compute_weights, calc_name) for calc_name, compute_weights in calculators.items()}
@@ -0,0 +1,52 @@
+from typing import Union
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from pypoanal.assets import SharesHistory
+
+
+def synthetic_shares_history(n_tickers: int = 8,
+                             n_days: int = 900,
+                             seed: int = 0,
+                             volatility: Union[float, np.ndarray] = 0.02,
+                             missing_ratio: float = 0.0,
+                             unlisted_days: int = 0,
+                             volume_log_mean: float = 8.0) -> SharesHistory:
+    """
+    Random walk prices of tickers T0, T1, ... on business days from 2010-01-01
+    :param volatility: daily volatility of returns, or one per day
+    :param missing_ratio: share of prices randomly set to NaN
+    :param unlisted_days: T0 has no prices and volumes during the first unlisted_days
+    :param volume_log_mean: volumes are lognormal, days with volume below backtester.choose_liquid_tickers
+    min_volume are frequent for volume_log_mean=5.0 and rare for 8.0
+    """
+    rng = np.random.default_rng(seed)
+    dates = pd.bdate_range('2010-01-01', periods=n_days)
+    tickers = [f'T{n}' for n in range(n_tickers)]
+    returns = 0.0005 + rng.standard_normal(size=(n_days, n_tickers)) * np.reshape(volatility, (-1, 1))
+    prices = 10.0 * np.exp(np.cumsum(returns, axis=0))
+    if missing_ratio > 0:
+        prices[rng.random(prices.shape) < missing_ratio] = np.nan
+    prices[:unlisted_days, 0] = np.nan
+    volumes = rng.lognormal(volume_log_mean, 1.0, size=(n_days, n_tickers))
+    volumes[:unlisted_days, 0] = np.nan
+    return SharesHistory(pd.DataFrame(prices, index=dates, columns=tickers),
+                         pd.DataFrame(volumes, index=dates, columns=tickers),
+                         pd.Series(rng.integers(10 ** 5, 10 ** 7, n_tickers).astype(np.float64), index=tickers))
+
+
+@pytest.fixture
+def make_shares_history():
+    """factory of synthetic histories, for tests needing several of them, see synthetic_shares_history"""
+    return synthetic_shares_history
+
+
+@pytest.fixture
+def shares_history(request) -> SharesHistory:
+    """
+    synthetic_shares_history with default arguments, tests change them with
+    @pytest.mark.parametrize('shares_history', [{'n_tickers': 6}], indirect=True)
+    """
+    return synthetic_shares_history(**getattr(request, 'param', dict()))
@@ -0,0 +1,78 @@
+import numpy as np
+import pandas as pd
+import pytest
+import scipy.sparse as sp
+
+from pypoanal import assets
+
+
+def test_portfolio_has_no_shared_default_and_no_dict():
+    first, second = assets.Portfolio(), assets.Portfolio()
+    assert first.shares is not second.shares
+    assert first.value(pd.Series({'GOOG': 100.0})) == 0.0
+    with pytest.raises(AttributeError):
+        first.__dict__
+
+
+def _portfolios():
+    return [assets.Portfolio(100.0),
+            assets.Portfolio(10.0, pd.Series({'GOOG': 1.0, 'AMZN': 2.0})),
+            assets.Portfolio(5.0, pd.Series({'AAPL': 3.0}))]
+
+
+@pytest.mark.parametrize('sparse', [True, False])
+def test_portfolio_history_rows_are_portfolios(sparse):
+    portfolios = _portfolios()
+    history = assets.PortfolioHistory.from_portfolios(portfolios, pd.Index(['AAPL', 'AMZN', 'GOOG']), sparse=sparse)
+    assert sp.issparse(history.holdings) == sparse
+    assert len(history) == 3
+    assert history[-1] == portfolios[-1]
+    assert isinstance(history[1:], assets.PortfolioHistory) and list(history[1:]) == list(history)[1:]
+    with pytest.raises(IndexError):
+        history[3]
+    for portfolio, expected in zip(history, portfolios):
+        assert portfolio.cash == expected.cash
+        assert portfolio.shares.sort_index().equals(expected.shares.sort_index())
+
+
+def test_portfolio_history_values_match_portfolio_values():
+    portfolios = _portfolios()
+    history = assets.PortfolioHistory.from_portfolios(portfolios)
+    prices = [pd.Series({'GOOG': 100.0, 'AMZN': 10.0, 'AAPL': np.nan}),
+              pd.Series({'GOOG': 110.0, 'AMZN': 12.0, 'AAPL': np.nan}),
+              pd.Series({'GOOG': 120.0, 'AMZN': 11.0, 'AAPL': 7.0})]
+    prices_matrix = np.vstack([row.reindex(history.tickers).to_numpy() for row in prices])
+    np.testing.assert_array_equal(history.values(prices_matrix),
+                                  [portfolio.value(row) for portfolio, row in zip(portfolios, prices)])
+
+
+def _shares_outstanding_table(n_dates=40, n_tickers=6, seed=0):
+    rng = np.random.default_rng(seed)
+    table = pd.DataFrame(rng.integers(10 ** 5, 10 ** 7, size=(n_dates, n_tickers)).astype(np.float64),
+                         index=pd.bdate_range('2010-01-01', periods=n_dates, freq='7D'),
+                         columns=[f'T{n}' for n in range(n_tickers)])
+    # counts are reported on few dates, one ticker is never reported
+    return table.where(rng.random(table.shape) < 0.2).assign(T5=np.nan)
+
+
+def test_shares_outstanding_as_of_matches_forward_filled_table():
+    table = _shares_outstanding_table()
+    history = assets.SharesOutstandingHistory(table)
+    assert history.table.nnz == table.notna().sum().sum()
+    forward_filled = table.fillna(method='ffill')
+    for date in [pd.Timestamp('2009-12-01'), table.index[0], table.index[7] + pd.Timedelta(days=3), table.index[-1],
+                 pd.Timestamp('2030-01-01')]:
+        expected = forward_filled.loc[:date].iloc[-1] if date >= table.index[0] else pd.Series(np.nan, table.columns)
+        pd.testing.assert_series_equal(history.as_of(date), expected, check_names=False)
+    default = pd.Series({'T5': 1.0, 'T0': 2.0, 'X': 3.0})
+    as_of = history.as_of(table.index[-1], default)
+    assert as_of.index.tolist() == ['T5', 'T0', 'X']
+    assert as_of.tolist() == [1.0, forward_filled['T0'].iloc[-1], 3.0]
+
+
+def test_shares_outstanding_from_records():
+    records = pd.DataFrame({'date': ['2020-01-01', '2020-06-01', '2020-03-01'], 'ticker': ['A', 'A', 'B'],
+                            'sharesOutstanding': [10.0, 20.0, 5.0]})
+    history = assets.SharesOutstandingHistory.from_records(records)
+    assert history.as_of(pd.Timestamp('2020-05-01')).to_dict() == {'A': 10.0, 'B': 5.0}
+    assert history.as_of(pd.Timestamp('2020-06-01')).to_dict() == {'A': 20.0, 'B': 5.0}
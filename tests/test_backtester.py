@@ -1,6 +1,12 @@
 import datetime
 
-from pypoanal import backtester, portfolio_calculators
+import numpy as np
+import pandas as pd
+import pytest
+
+from pypoanal import assets, backtester, portfolio_calculators, pricestore, profiling
+from pypoanal.assets import SharesHistory
+from pypoanal.backtest_plan import BacktestPlan, StreamingBacktestPlan
 
 
 def test_backtest_MCAP():
@@ -31,3 +37,281 @@ def test_backtest_ECOV():
                                                                             rebalance_dates,
                                                                             progress_bar=True)
     assert len(values_df) > 0
+
+
+# T0 is listed later, liquid tickers change from period to period
+HISTORY = dict(n_days=600, unlisted_days=100, volume_log_mean=5.0)
+
+
+def test_backtest_plan_periods(make_shares_history):
+    shares_history = make_shares_history(**HISTORY)
+    rebalance_dates = backtester.compute_rebalance_dates(datetime.date(2010, 1, 1),
+                                                         datetime.date(2012, 3, 1),
+                                                         datetime.timedelta(days=90))
+    plan = BacktestPlan(shares_history, rebalance_dates)
+    assert len(plan) == len(rebalance_dates) - 1
+    forward_filled_prices = shares_history.price_history.fillna(method='ffill')
+    # price windows are not copied before they are used
+    assert not any('prices_sample' in vars(period) for period in plan)
+    for period, start_date, end_date in zip(plan, rebalance_dates[:-1], rebalance_dates[1:]):
+        assert period.liquid_tickers == backtester.choose_liquid_tickers(shares_history.volume_history,
+                                                                         start_date, end_date)
+        pd.testing.assert_frame_equal(period.prices_sample,
+                                      shares_history.price_history.loc[start_date:end_date, period.liquid_tickers])
+        pd.testing.assert_series_equal(period.prices_at_end, forward_filled_prices[:end_date].iloc[-1])
+    assert 'T0' not in plan.periods[0].liquid_tickers
+
+
+def test_compare_calculators_offline(make_shares_history):
+    shares_history = make_shares_history(**HISTORY)
+    rebalance_dates = backtester.compute_rebalance_dates(datetime.date(2010, 1, 1),
+                                                         datetime.date(2012, 3, 1),
+                                                         datetime.timedelta(days=90))
+    calculators = {'MCAP': portfolio_calculators.compute_mcap_weights,
+                   'equal': portfolio_calculators.compute_equal_weights}
+    values_df, fees_df, portfolios = backtester.compare_calculators_for_periodic_rebalance(
+        calculators, [], 10 ** 5, rebalance_dates, shares_history=shares_history, progress_bar=False)
+    for calc_name, compute_weights in calculators.items():
+        expected_portfolios, expected_fees = backtester.reallocate_portfolio_periodically(compute_weights,
+                                                                                          rebalance_dates,
+                                                                                          10 ** 5,
+                                                                                          np.float64(0.04),
+                                                                                          shares_history,
+                                                                                          progress_bar=False)
+        assert fees_df[calc_name].tolist() == expected_fees
+        assert [portfolio.cash for portfolio in portfolios[calc_name]] == \
+               [portfolio.cash for portfolio in expected_portfolios]
+    assert values_df.iloc[0].tolist() == [10 ** 5, 10 ** 5]
+
+
+def test_backtest_portfolios_are_sliced_as_lists(make_shares_history):
+    rebalance_dates = backtester.compute_rebalance_dates(datetime.date(2010, 1, 1),
+                                                         datetime.date(2012, 3, 1),
+                                                         datetime.timedelta(days=90))
+    history, _ = backtester.reallocate_portfolio_periodically(portfolio_calculators.compute_equal_weights,
+                                                              rebalance_dates, 10 ** 5, np.float64(0.04),
+                                                              make_shares_history(**HISTORY), progress_bar=False)
+    portfolios = list(history)
+    for rows in (slice(1, None), slice(-5, None), slice(None, 3), slice(None, None, 2), slice(None, None, -1)):
+        sliced = history[rows]
+        assert len(sliced) == len(portfolios[rows])
+        assert list(sliced) == portfolios[rows]
+    assert history[-len(history)] == portfolios[0]
+    for row in (len(history), -len(history) - 1):
+        with pytest.raises(IndexError):
+            history[row]
+
+
+def test_process_pool_matches_serial(make_shares_history):
+    shares_history = make_shares_history(**HISTORY)
+    rebalance_dates = backtester.compute_rebalance_dates(datetime.date(2010, 1, 1),
+                                                         datetime.date(2012, 3, 1),
+                                                         datetime.timedelta(days=180))
+    calculators = {'MCAP': portfolio_calculators.compute_mcap_weights,
+                   'ledoitw_cov': portfolio_calculators.compute_ledoitw_weights,
+                   'HRP': portfolio_calculators.compute_hrp_weights}
+    serial_values, serial_fees, _ = backtester.compare_calculators_for_periodic_rebalance(
+        calculators, [], 10 ** 5, rebalance_dates, shares_history=shares_history, progress_bar=False)
+    pool_values, pool_fees, _ = backtester.compare_calculators_for_periodic_rebalance(
+        calculators, [], 10 ** 5, rebalance_dates, shares_history=shares_history, progress_bar=False,
+        max_workers=2)
+    pd.testing.assert_frame_equal(serial_values, pool_values, check_exact=True)
+    pd.testing.assert_frame_equal(serial_fees, pool_fees, check_exact=True)
+
+
+def _backtest_portfolios(shares_history, rebalance_dates):
+    calculators = {'MCAP': portfolio_calculators.compute_mcap_weights,
+                   'equal': portfolio_calculators.compute_equal_weights}
+    return backtester.compare_calculators_for_periodic_rebalance(calculators, [], 10 ** 5, rebalance_dates,
+                                                                 shares_history=shares_history, progress_bar=False)
+
+
+def test_portfolios_values_history_at_forward_filled_prices(make_shares_history):
+    shares_history = make_shares_history(**HISTORY)
+    rebalance_dates = backtester.compute_rebalance_dates(datetime.date(2010, 1, 1),
+                                                         datetime.date(2012, 3, 1),
+                                                         datetime.timedelta(days=90))
+    values_df, _, portfolios = _backtest_portfolios(shares_history, rebalance_dates)
+    forward_filled_prices = shares_history.price_history.fillna(method='ffill')
+    for calc_name, portfolio_history in portfolios.items():
+        portfolio_dates = list(zip(rebalance_dates, portfolio_history))
+        values = backtester.portfolios_values_history(portfolio_dates, shares_history.price_history)
+        assert values == [portfolio.value(forward_filled_prices[:date].iloc[-1]) for date, portfolio in portfolio_dates]
+        assert values == values_df[calc_name].tolist()
+
+
+def test_daily_values_history(make_shares_history):
+    shares_history = make_shares_history(**HISTORY)
+    rebalance_dates = backtester.compute_rebalance_dates(datetime.date(2010, 1, 4),
+                                                         datetime.date(2012, 3, 1),
+                                                         datetime.timedelta(days=91))
+    values_df, _, portfolios = _backtest_portfolios(shares_history, rebalance_dates)
+    daily_values = backtester.daily_values_table(portfolios, rebalance_dates, shares_history.price_history)
+    forward_filled_prices = shares_history.price_history.fillna(method='ffill')
+    assert daily_values.index[0] == pd.Timestamp(rebalance_dates[0])
+    assert daily_values.index[-1] <= pd.Timestamp(rebalance_dates[-1])
+    rebalance_timestamps = pd.to_datetime(rebalance_dates)
+    for calc_name, portfolio_history in portfolios.items():
+        for date in daily_values.index[::7]:
+            # portfolio of the last rebalance not after the date
+            portfolio = portfolio_history[rebalance_timestamps.searchsorted(date, side='right') - 1]
+            assert daily_values.loc[date, calc_name] == pytest.approx(portfolio.value(forward_filled_prices.loc[date]),
+                                                                      rel=1e-12)
+        # rebalance dates on trading days have the same values as in values_df
+        trading_rebalance_dates = rebalance_timestamps[rebalance_timestamps.isin(daily_values.index)]
+        assert len(trading_rebalance_dates) > 1
+        np.testing.assert_allclose(daily_values.loc[trading_rebalance_dates, calc_name],
+                                   values_df.loc[trading_rebalance_dates.date, calc_name], rtol=1e-12)
+
+
+def _streaming_and_in_memory_plans(tmp_path, make_shares_history, rebalance_dates, tickers):
+    shares_history = make_shares_history(**HISTORY, n_tickers=10)
+    # a ticker listed later and rows without prices of the selected tickers
+    shares_history.price_history.iloc[:300, 9] = np.nan
+    shares_history.price_history.iloc[200:203, :-1] = np.nan
+    shares_history.volume_history[shares_history.price_history.isna()] = np.nan
+    pricestore.write_store(shares_history.price_history, shares_history.volume_history, str(tmp_path))
+    store = pricestore.PriceVolumeStore(str(tmp_path))
+    price_history, volume_history = store.price_and_volume_histories(tickers)
+    in_memory_history = SharesHistory(price_history, volume_history, shares_history.shares_outstanding)
+    streaming_plan = StreamingBacktestPlan(store, shares_history.shares_outstanding, rebalance_dates, tickers,
+                                           chunk_size=7)
+    return streaming_plan, BacktestPlan(in_memory_history, rebalance_dates), in_memory_history
+
+
+def test_streaming_plan_matches_in_memory_plan(tmp_path, make_shares_history):
+    rebalance_dates = backtester.compute_rebalance_dates(datetime.date(2009, 12, 1),
+                                                         datetime.date(2012, 3, 1),
+                                                         datetime.timedelta(days=90))
+    tickers = [f'T{n}' for n in (9, 0, 1, 2, 3, 5, 8)]
+    streaming_plan, plan, _ = _streaming_and_in_memory_plans(tmp_path, make_shares_history, rebalance_dates, tickers)
+    assert len(streaming_plan) == len(plan)
+    assert streaming_plan.tickers == plan.tickers
+    assert streaming_plan.price_columns.equals(plan.price_columns)
+    np.testing.assert_array_equal(streaming_plan.prices_at_rebalance_dates, plan.prices_at_rebalance_dates)
+    for streamed_period, period in zip(streaming_plan, plan):
+        assert streamed_period.rows == period.rows
+        assert streamed_period.liquid_tickers == period.liquid_tickers
+        pd.testing.assert_frame_equal(streamed_period.prices_sample, period.prices_sample)
+        pd.testing.assert_series_equal(streamed_period.prices_at_end, period.prices_at_end)
+
+
+def test_streaming_backtest_matches_in_memory_backtest(tmp_path, make_shares_history):
+    rebalance_dates = backtester.compute_rebalance_dates(datetime.date(2010, 1, 1),
+                                                         datetime.date(2012, 3, 1),
+                                                         datetime.timedelta(days=90))
+    tickers = [f'T{n}' for n in range(10)]
+    streaming_plan, plan, shares_history = _streaming_and_in_memory_plans(tmp_path, make_shares_history,
+                                                                          rebalance_dates, tickers)
+    for compute_weights in (portfolio_calculators.compute_mcap_weights, portfolio_calculators.compute_ledoitw_weights):
+        streamed_portfolios, streamed_fees = backtester.reallocate_portfolio_periodically(
+            compute_weights, rebalance_dates, 10 ** 5, np.float64(0.04), None, progress_bar=False,
+            plan=streaming_plan)
+        portfolios, fees = backtester.reallocate_portfolio_periodically(
+            compute_weights, rebalance_dates, 10 ** 5, np.float64(0.04), shares_history, progress_bar=False,
+            plan=plan)
+        assert streamed_fees == fees
+        np.testing.assert_array_equal(streamed_portfolios.cash, portfolios.cash)
+        np.testing.assert_array_equal(streamed_portfolios.dense_holdings(), portfolios.dense_holdings())
+
+
+@pytest.mark.parametrize('compute_weights', [portfolio_calculators.compute_mcap_weights,
+                                             portfolio_calculators.compute_equal_weights])
+def test_batched_weights_match_per_period_weights(compute_weights, make_shares_history):
+    shares_history = make_shares_history(**HISTORY, n_tickers=12)
+    prices = shares_history.price_history.to_numpy()
+    prices[np.random.default_rng(1).random(prices.shape) < 0.05] = np.nan
+    # a ticker without shares outstanding
+    shares_outstanding = shares_history.shares_outstanding.drop('T3')
+    shares_history = SharesHistory(shares_history.price_history, shares_history.volume_history, shares_outstanding)
+    rebalance_dates = backtester.compute_rebalance_dates(datetime.date(2010, 1, 1), datetime.date(2012, 3, 1),
+                                                         datetime.timedelta(days=60))
+    plan = BacktestPlan(shares_history, rebalance_dates)
+    weights = portfolio_calculators.batched_calculator(compute_weights)(*plan.batched_inputs())
+    assert weights.shape == (len(plan), len(plan.price_columns))
+    for period_weights, period in zip(weights, plan):
+        expected = compute_weights(shares_outstanding, period.prices_sample).reindex(plan.price_columns).fillna(0.0)
+        np.testing.assert_allclose(period_weights, expected.to_numpy(), rtol=1e-12, atol=0.0)
+
+
+def test_backtest_with_batched_calculators_matches_per_period_calls(make_shares_history):
+    shares_history = make_shares_history(**HISTORY)
+    rebalance_dates = backtester.compute_rebalance_dates(datetime.date(2010, 1, 1), datetime.date(2012, 3, 1),
+                                                         datetime.timedelta(days=60))
+    for compute_weights in (portfolio_calculators.compute_mcap_weights, portfolio_calculators.compute_equal_weights):
+        assert portfolio_calculators.batched_calculator(compute_weights) is not None
+        portfolios, fees = backtester.reallocate_portfolio_periodically(compute_weights, rebalance_dates, 10 ** 5,
+                                                                        0.04, shares_history, progress_bar=False)
+        # a wrapper has no batched version and is called once per period
+        expected_portfolios, expected_fees = backtester.reallocate_portfolio_periodically(
+            lambda shares_outstanding, price_history: compute_weights(shares_outstanding, price_history),
+            rebalance_dates, 10 ** 5, 0.04, shares_history, progress_bar=False)
+        assert fees == expected_fees
+        assert list(portfolios) == list(expected_portfolios)
+
+
+class _FailingBatchedEqualWeights:
+    """equal weights whose batched version fails, as a solver failing on the whole history"""
+
+    def __call__(self, shares_outstanding: pd.Series, price_history: pd.DataFrame) -> pd.Series:
+        return portfolio_calculators.compute_equal_weights(shares_outstanding, price_history)
+
+    def batched(self, *batched_inputs) -> np.ndarray:
+        raise ValueError('batched solver failed')
+
+
+def test_failed_batched_call_falls_back_to_per_period_calls(make_shares_history):
+    shares_history = make_shares_history(**HISTORY)
+    rebalance_dates = backtester.compute_rebalance_dates(datetime.date(2010, 1, 1), datetime.date(2012, 3, 1),
+                                                         datetime.timedelta(days=60))
+    profiler = profiling.BacktestProfiler()
+    portfolios, fees = backtester.reallocate_portfolio_periodically(_FailingBatchedEqualWeights(), rebalance_dates,
+                                                                    10 ** 5, 0.04, shares_history, progress_bar=False,
+                                                                    profiler=profiler, calculator_name='equal')
+    expected_portfolios, expected_fees = backtester.reallocate_portfolio_periodically(
+        portfolio_calculators.compute_equal_weights, rebalance_dates, 10 ** 5, 0.04, shares_history,
+        progress_bar=False)
+    assert fees == expected_fees
+    assert list(portfolios) == list(expected_portfolios)
+    records = profiler.to_dataframe()
+    failures = records[records['error'].notna()]
+    assert failures['period'].isna().all()
+    assert list(failures['error']) == ['ValueError: batched solver failed']
+    # then weights are computed period by period
+    assert records.loc[records['stage'] == profiling.WEIGHTS, 'period'].notna().sum() == len(portfolios) - 1
+
+
+def test_periods_get_point_in_time_shares_outstanding(make_shares_history):
+    shares_history = make_shares_history(**HISTORY, n_tickers=12)
+    rng = np.random.default_rng(2)
+    reports = pd.DataFrame(rng.integers(10 ** 5, 10 ** 7, size=(30, 10)).astype(np.float64),
+                           index=pd.date_range('2009-06-01', periods=30, freq='31D'),
+                           columns=shares_history.price_history.columns[:10])
+    reports = reports.where(rng.random(reports.shape) < 0.3)
+    shares_history.shares_outstanding_history = assets.SharesOutstandingHistory(reports)
+    rebalance_dates = backtester.compute_rebalance_dates(datetime.date(2010, 1, 1), datetime.date(2012, 3, 1),
+                                                         datetime.timedelta(days=60))
+    plan = BacktestPlan(shares_history, rebalance_dates)
+    forward_filled_reports = reports.fillna(method='ffill')
+    for period in plan:
+        last_day = period.prices_sample.index[-1]
+        expected = forward_filled_reports.loc[:last_day].iloc[-1].reindex(shares_history.shares_outstanding.index)
+        expected = expected.fillna(shares_history.shares_outstanding)
+        pd.testing.assert_series_equal(period.shares_outstanding, expected, check_names=False)
+    shares_outstanding, _, _, _ = plan.batched_inputs()
+    np.testing.assert_array_equal(shares_outstanding, np.vstack([period.shares_outstanding for period in plan]))
+    # batched and per-period MCAP weights use the counts of every period
+    portfolios, fees = backtester.reallocate_portfolio_periodically(portfolio_calculators.compute_mcap_weights,
+                                                                    rebalance_dates, 10 ** 5, 0.04, shares_history,
+                                                                    progress_bar=False, plan=plan)
+    expected_portfolios, expected_fees = backtester.reallocate_portfolio_periodically(
+        lambda shares_outstanding, price_history: portfolio_calculators.compute_mcap_weights(shares_outstanding,
+                                                                                           price_history),
+        rebalance_dates, 10 ** 5, 0.04, shares_history, progress_bar=False, plan=plan)
+    assert fees == expected_fees
+    assert list(portfolios) == list(expected_portfolios)
+    static_portfolios, _ = backtester.reallocate_portfolio_periodically(
+        portfolio_calculators.compute_mcap_weights, rebalance_dates, 10 ** 5, 0.04,
+        SharesHistory(shares_history.price_history, shares_history.volume_history,
+                      shares_history.shares_outstanding), progress_bar=False)
+    assert list(portfolios) != list(static_portfolios)
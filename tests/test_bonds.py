@@ -0,0 +1,115 @@
+import datetime
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from pypoanal import bonds
+
+BOARD_PATH = 'tests/data/moex_bonds.json'
+# time of the cashflow printed in moex_analyze_bonds.ipynb
+NOW = datetime.datetime(2021, 12, 21, 15, 6, 59, 156039)
+
+
+def _notebook_cashflow(bond: pd.Series, now: datetime.datetime) -> list[tuple[datetime.datetime, float, float]]:
+    """simple_bond_cashflow of moex_analyze_bonds.ipynb with a given now"""
+    tomorrow = now + datetime.timedelta(days=1)
+    price = bond['PRICEP']
+    times_a_year = bond['COUPONFREQUENCY']
+    couponp = bond['COUPONPERCENT'] / times_a_year
+    coupon_date = bond['COUPONDATE'].to_pydatetime()
+    aci = couponp * (1 - (coupon_date - now).days / (365 / times_a_year))
+    cashflow = [(tomorrow, -price * (1 + bonds.BROKER_COMMISSION), 0.0),
+                (tomorrow, -aci * (1 + bonds.BROKER_COMMISSION), 0.0)]
+    consol = pd.isna(bond['MATDATE'])
+    maturity = tomorrow + datetime.timedelta(days=365 * 100) if consol else bond['MATDATE'].to_pydatetime()
+    current, n_payments = coupon_date, 0
+    while (maturity - current).days > 0 and n_payments < 100 * times_a_year:
+        cashflow.append((current, couponp * (1 - bonds.BROKER_COMMISSION), couponp * bonds.TAX_RATE))
+        current += datetime.timedelta(days=365 / times_a_year)
+        n_payments += 1
+    if not consol:
+        tax = (100 - price) * bonds.TAX_RATE if 100 > price and (maturity - tomorrow).days < 3 * 365 else 0.0
+        cashflow.append((maturity, 100 * (1 - bonds.BROKER_COMMISSION), tax))
+    return cashflow
+
+
+def _notebook_npv(cashflow, eirp: float, now: datetime.datetime) -> float:
+    """npv_from_cashflow of moex_analyze_bonds.ipynb with a given now"""
+    now_date = datetime.datetime.combine(now.date(), datetime.time())
+    return sum((amount - tax) / (1 + eirp / 100) ** ((date - now_date).days / 365)
+               for date, amount, tax in cashflow if date >= now_date)
+
+
+@pytest.fixture
+def board():
+    return bonds.load_board(BOARD_PATH)
+
+
+def test_load_board(board, tmp_path):
+    assert board.loc['SU26209RMFS5', 'PRICEP'] == 99.882
+    assert board.loc['SU26209RMFS5', 'COUPONFREQUENCY'] == 2 and board.loc['SU24021RMFS6', 'COUPONFREQUENCY'] == 4
+    assert pd.isna(board.loc['RU000A0ZYJS2', 'MATDATE']) and pd.isna(board.loc['RU000A1008J4', 'COUPONDATE'])
+    assert pd.isna(board.loc['RU000A1008J4', 'COUPONFREQUENCY'])
+    csv_path = str(tmp_path / 'board.csv')
+    board.reset_index().to_csv(csv_path, index=False)
+    pd.testing.assert_frame_equal(bonds.load_board(csv_path), board)
+
+
+def test_rates():
+    assert bonds.eir_to_apr(10, 12) == pytest.approx(9.568968514684517)
+    np.testing.assert_allclose(bonds.per_period_rate_percent(np.array([10.0, 21.0]), 2), [4.88088482, 10.0])
+
+
+def test_cashflows_match_notebook(board):
+    cashflows = bonds.simple_bond_cashflows(board, NOW)
+    flows = cashflows.to_frame()
+    # SU26209RMFS5 cashflow printed in the notebook
+    np.testing.assert_allclose(flows.loc[flows['secid'] == 'SU26209RMFS5', ['amount', 'tax']].to_numpy(),
+                               [[-99.9219528, 0.0], [-3.2182730958904107, 0.0], [3.79848, 0.494],
+                                [99.96, 0.01534]])
+    assert not flows['secid'].isin(['SU52002RMFS1']).any()
+    for secid, bond in board.drop(['SU52002RMFS1', 'RU000A1008J4']).iterrows():
+        expected = _notebook_cashflow(bond, NOW)
+        bond_flows = flows[flows['secid'] == secid]
+        assert len(bond_flows) == len(expected)
+        np.testing.assert_allclose(bond_flows[['amount', 'tax']].to_numpy(),
+                                   [[amount, tax] for _, amount, tax in expected])
+        assert (bond_flows['date'].dt.floor('D') == [pd.Timestamp(date).floor('D') for date, _, _ in expected]).all()
+        assert bonds.npv(cashflows, 8.5)[board.index.get_loc(secid)] == pytest.approx(
+            _notebook_npv(expected, 8.5, NOW))
+
+
+def test_npv_of_zero_coupon_and_unpriced_bonds(board):
+    cashflows = bonds.simple_bond_cashflows(board, NOW)
+    values = pd.Series(bonds.npv(cashflows, np.full(len(board), 5.0), count_tax=False), index=board.index)
+    assert np.isnan(values['SU52002RMFS1'])
+    maturity_days = (board.loc['RU000A1008J4', 'MATDATE'] - pd.Timestamp(NOW.date())).days
+    assert values['RU000A1008J4'] == pytest.approx(-85.4 * 1.0004 / 1.05 ** (1 / 365)
+                                                   + 99.96 / 1.05 ** (maturity_days / 365))
+
+
+def test_accrued_coupon():
+    np.testing.assert_allclose(bonds.accrued_coupon(np.array([3.8, 2.0]), np.array([2, 4]), np.array([28, 0])),
+                               [3.8 * (1 - 28 / 182.5), 2.0])
+
+
+def test_effective_yield_zeroes_npv(board):
+    rng = np.random.default_rng(0)
+    n_bonds = 2000
+    maturities = pd.Timestamp(NOW.date()) + pd.to_timedelta(rng.integers(365, 30 * 365, n_bonds), unit='D')
+    synthetic = pd.DataFrame({'PRICEP': rng.uniform(70, 130, n_bonds),
+                              'COUPONPERCENT': rng.uniform(0, 15, n_bonds),
+                              'COUPONFREQUENCY': rng.choice([1, 2, 4, 12], n_bonds),
+                              'COUPONDATE': pd.Timestamp(NOW.date()) + pd.to_timedelta(rng.integers(1, 30, n_bonds),
+                                                                                       unit='D'),
+                              'MATDATE': maturities})
+    synthetic = pd.concat([board, synthetic.set_index(pd.Index([f'B{n}' for n in range(n_bonds)]))])
+    cashflows = bonds.simple_bond_cashflows(synthetic, NOW)
+    rates = bonds.effective_yield(cashflows)
+    assert np.isnan(rates[synthetic.index.get_loc('SU52002RMFS1')])
+    solved = ~np.isnan(rates)
+    assert solved.sum() == len(synthetic) - 1
+    np.testing.assert_allclose(bonds.npv(cashflows, rates)[solved], 0.0, atol=1e-8)
+    # npv decreases with the rate, bonds cheaper than their flows yield more
+    assert (bonds.npv(cashflows, rates + 1.0)[solved] < 0).all()
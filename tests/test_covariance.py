@@ -0,0 +1,133 @@
+import datetime
+
+import numpy as np
+import pandas as pd
+import pytest
+from pypfopt import risk_models
+
+from pypoanal import backtester, portfolio_calculators
+from pypoanal.backtest_plan import BacktestPlan
+from pypoanal.covariance import CovarianceEngine, RollingSampleCovariance
+
+
+def _plan(shares_history, rebalance_period=datetime.timedelta(days=91)):
+    rebalance_dates = backtester.compute_rebalance_dates(datetime.date(2010, 3, 1), datetime.date(2013, 6, 1),
+                                                         rebalance_period)
+    return BacktestPlan(shares_history, rebalance_dates)
+
+
+def test_rolling_covariance_matches_pypfopt(make_shares_history):
+    for missing_ratio in [0.0, 0.05]:
+        plan = _plan(make_shares_history(missing_ratio=missing_ratio))
+        engine = CovarianceEngine(plan)
+        for period in plan:
+            pd.testing.assert_frame_equal(
+                engine.covariance('ledoit_wolf', period),
+                risk_models.CovarianceShrinkage(period.prices_sample, frequency=252).ledoit_wolf(),
+                rtol=1e-9)
+            pd.testing.assert_frame_equal(engine.covariance('exp_cov', period),
+                                          risk_models.exp_cov(period.prices_sample, span=179),
+                                          rtol=1e-9)
+            pd.testing.assert_frame_equal(engine.covariance('sample', period),
+                                          period.returns.cov() * 252,
+                                          rtol=1e-9)
+
+
+def test_rolling_covariance_does_not_depend_on_window_order(make_shares_history):
+    plan = _plan(make_shares_history(missing_ratio=0.02), rebalance_period=datetime.timedelta(days=200))
+    rolling_engine = CovarianceEngine(plan)
+    rolled = [rolling_engine.covariance('exp_cov', period) for period in plan]
+    # a fresh engine per window computes the sums from scratch
+    for period, cov_matrix in zip(plan, rolled):
+        pd.testing.assert_frame_equal(cov_matrix, CovarianceEngine(plan).covariance('exp_cov', period), rtol=1e-9)
+
+
+def test_backtest_with_rolling_covariance(shares_history):
+    rebalance_dates = backtester.compute_rebalance_dates(datetime.date(2010, 3, 1), datetime.date(2013, 1, 1),
+                                                         datetime.timedelta(days=182))
+    calculators = {'ledoitw': portfolio_calculators.compute_ledoitw_weights,
+                   'exp_cov': portfolio_calculators.compute_expcov_weights,
+                   'HRP': portfolio_calculators.compute_native_hrp_weights}
+    compare_args = (calculators, [], 10 ** 5, rebalance_dates)
+    values_df, _, _ = backtester.compare_calculators_for_periodic_rebalance(*compare_args,
+                                                                            shares_history=shares_history,
+                                                                            progress_bar=False)
+    rolling_values_df, _, _ = backtester.compare_calculators_for_periodic_rebalance(*compare_args,
+                                                                                    shares_history=shares_history,
+                                                                                    progress_bar=False,
+                                                                                    rolling_covariance=True)
+    pd.testing.assert_frame_equal(values_df, rolling_values_df, rtol=1e-6)
+
+
+def test_rolling_covariance_of_other_spans_and_frequencies(make_shares_history):
+    plan = _plan(make_shares_history(missing_ratio=0.02))
+    engine = CovarianceEngine(plan)
+    for period in plan:
+        pd.testing.assert_frame_equal(engine.covariance('exp_cov', period, span=60, frequency=52),
+                                      risk_models.exp_cov(period.prices_sample, span=60, frequency=52), rtol=1e-9)
+        pd.testing.assert_frame_equal(engine.covariance('ledoit_wolf', period, frequency=12),
+                                      risk_models.CovarianceShrinkage(period.prices_sample,
+                                                                      frequency=12).ledoit_wolf(), rtol=1e-9)
+        pd.testing.assert_frame_equal(engine.covariance('exp_cov', period),
+                                      risk_models.exp_cov(period.prices_sample, span=179), rtol=1e-9)
+    # estimators are shared by frequencies, exponential ones are kept per span
+    assert set(engine._exp_cov_estimators) == {179, 60}
+
+
+def test_rolling_covariance_with_market_holidays(make_shares_history):
+    shares_history = make_shares_history(missing_ratio=0.02, unlisted_days=300)
+    # every price is unknown on holidays, some windows start on one
+    shares_history.price_history.iloc[::17] = np.nan
+    shares_history.price_history.iloc[400:405] = np.nan
+    plan = _plan(shares_history)
+    engine = CovarianceEngine(plan)
+    for period in plan:
+        pd.testing.assert_frame_equal(engine.covariance('exp_cov', period),
+                                      risk_models.exp_cov(period.prices_sample, span=179), rtol=1e-9)
+        pd.testing.assert_frame_equal(
+            engine.covariance('ledoit_wolf', period),
+            risk_models.CovarianceShrinkage(period.prices_sample, frequency=252).ledoit_wolf(), rtol=1e-9)
+
+
+def test_covariance_cache_is_bounded(make_shares_history):
+    plan = _plan(make_shares_history())
+    periods = list(plan)
+    n_liquid = len(periods[0].liquid_tickers)
+    # room for about two covariances
+    engine = CovarianceEngine(plan, max_cached_bytes=2 * n_liquid ** 2 * 8)
+    for period in periods:
+        for kind in ('ledoit_wolf', 'exp_cov', 'sample'):
+            engine.covariance(kind, period)
+    assert 1 <= len(engine._cache) <= 2
+    assert engine._cached_bytes == sum(cov_matrix.values.nbytes for cov_matrix in engine._cache.values())
+    assert engine._cached_bytes <= engine.max_cached_bytes or len(engine._cache) == 1
+    # the most recently used covariance is kept
+    assert engine.covariance('sample', periods[-1]) is engine.covariance('sample', periods[-1])
+
+
+def test_rolling_covariance_is_serial(shares_history):
+    rebalance_dates = backtester.compute_rebalance_dates(datetime.date(2010, 3, 1), datetime.date(2011, 1, 1),
+                                                         datetime.timedelta(days=182))
+    with pytest.raises(ValueError, match='max_workers'):
+        backtester.compare_calculators_for_periodic_rebalance(
+            {'ledoitw': portfolio_calculators.compute_ledoitw_weights}, [], 10 ** 5, rebalance_dates,
+            shares_history=shares_history, progress_bar=False, max_workers=2, rolling_covariance=True)
+
+
+def test_rolling_sums_are_recomputed_for_windows_sharing_few_rows(make_shares_history):
+    returns = make_shares_history(missing_ratio=0.02).price_history.pct_change().to_numpy()
+    estimator = RollingSampleCovariance(returns)
+    resets = []
+    reset = estimator._reset
+    estimator._reset = lambda: resets.append(len(estimator.columns)) or reset()
+    columns = np.array([0, 2, 3, 5])
+    # first window, a window sharing most of its rows, one sharing less than half of them, other tickers
+    for start, stop, window_columns, expected_resets in [(1, 100, columns, 1), (20, 120, columns, 1),
+                                                         (80, 180, columns, 2), (90, 190, columns[:-1], 3)]:
+        estimator.move_to(start, stop, window_columns)
+        assert len(resets) == expected_resets
+        # sums are kept for the tickers of the window only
+        assert estimator.sum_xx.shape == (len(window_columns), len(window_columns))
+        np.testing.assert_allclose(estimator.covariance(),
+                                   pd.DataFrame(returns[start:stop, window_columns]).cov().to_numpy() * 252,
+                                   rtol=1e-9)
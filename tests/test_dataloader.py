@@ -1,4 +1,6 @@
 import os
+
+import numpy as np
 import pandas as pd
 from pypoanal import dataloader
 
@@ -50,3 +52,16 @@ def test_download_info_2():
 def test_load_shares_outstanding():
     shares_ser = dataloader.load_shares_outstanding(['AAPL', 'GOOG', 'F'])
     assert len(shares_ser) == 3
+
+
+def test_load_csv_price_and_volume_histories_aligns_dates(tmp_path):
+    pd.DataFrame({'Adj Close': [1.0, 2.0], 'Volume': [10.0, 20.0]},
+                 index=pd.DatetimeIndex(['2010-01-05', '2010-01-07'], name='Date')).to_csv(tmp_path / 'AAA.csv')
+    pd.DataFrame({'Adj Close': [3.0, 4.0], 'Volume': [30.0, 40.0]},
+                 index=pd.DatetimeIndex(['2010-01-04', '2010-01-05'], name='Date')).to_csv(tmp_path / 'BBB.csv')
+    prices, volumes = dataloader.load_csv_price_and_volume_histories(['AAA', 'BBB'], str(tmp_path))
+    expected_dates = pd.DatetimeIndex(['2010-01-04', '2010-01-05', '2010-01-07'], name='Date')
+    pd.testing.assert_frame_equal(prices, pd.DataFrame({'AAA': [np.nan, 1.0, 2.0], 'BBB': [3.0, 4.0, np.nan]},
+                                                       index=expected_dates))
+    pd.testing.assert_frame_equal(volumes, pd.DataFrame({'AAA': [np.nan, 10.0, 20.0], 'BBB': [30.0, 40.0, np.nan]},
+                                                        index=expected_dates))
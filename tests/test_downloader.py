@@ -0,0 +1,162 @@
+import functools
+import http.server
+import json
+import threading
+
+import pandas as pd
+
+from pypoanal import downloader
+
+
+def _make_fixture_dir(fixture_dir, tickers):
+    fixture_dir.mkdir(exist_ok=True)
+    for ticker in tickers:
+        pd.DataFrame({'Adj Close': [1.0, 2.0], 'Volume': [10.0, 20.0]},
+                     index=pd.DatetimeIndex(['2010-01-04', '2010-01-05'], name='Date')).to_csv(
+            fixture_dir / (ticker + '.csv'))
+
+
+def test_download_from_fixture_dir_reports_failures(tmp_path):
+    _make_fixture_dir(tmp_path / 'fixtures', ['AAPL', 'GOOG'])
+    manifest_path = tmp_path / 'manifest.json'
+    failed = downloader.download_price_histories(['AAPL', 'GOOG', 'NOTATICKER'],
+                                                 downloader.directory_price_fetcher(str(tmp_path / 'fixtures')),
+                                                 str(tmp_path / 'data'),
+                                                 calls_per_second=None,
+                                                 retries=1,
+                                                 backoff_seconds=0.0,
+                                                 manifest_path=str(manifest_path))
+    assert failed == ['NOTATICKER']
+    assert (tmp_path / 'data' / 'AAPL.csv').exists()
+    manifest = json.loads(manifest_path.read_text())
+    assert manifest['processed'] == ['AAPL', 'GOOG']
+    assert list(manifest['failed']) == ['NOTATICKER']
+
+
+def test_download_resumes_from_checkpoint(tmp_path):
+    _make_fixture_dir(tmp_path / 'fixtures', ['AAPL', 'GOOG'])
+    checkpoint_path = tmp_path / 'checkpoint.txt'
+    checkpoint_path.write_text('AAPL\n')
+    fetched = []
+    fetch_from_dir = downloader.directory_price_fetcher(str(tmp_path / 'fixtures'))
+
+    def fetch(ticker):
+        fetched.append(ticker)
+        return fetch_from_dir(ticker)
+
+    downloader.download_price_histories(['AAPL', 'GOOG'], fetch, str(tmp_path / 'data'),
+                                        calls_per_second=None,
+                                        checkpoint_path=str(checkpoint_path))
+    assert fetched == ['GOOG']
+    assert checkpoint_path.read_text().split() == ['AAPL', 'GOOG']
+
+
+def test_retries_with_backoff():
+    attempts = []
+
+    def flaky_fetch_info(ticker):
+        attempts.append(ticker)
+        if len(attempts) < 3:
+            raise ConnectionError('timeout')
+        return {'quoteType': 'EQUITY', 'sharesOutstanding': 100.0}
+
+    info_df = downloader.download_infos(['AAPL'], flaky_fetch_info, ['quoteType', 'sharesOutstanding'],
+                                        calls_per_second=None, retries=2, backoff_seconds=0.0)
+    assert len(attempts) == 3
+    assert info_df.to_dict('records') == [{'ticker': 'AAPL', 'quoteType': 'EQUITY', 'sharesOutstanding': 100.0}]
+
+
+def test_permanent_errors_are_not_retried():
+    attempts = []
+
+    def fetch_info(ticker):
+        attempts.append(ticker)
+        if ticker == 'NOTATICKER':
+            # yahoo_fin get_quote_data for an unknown ticker
+            raise IndexError('list index out of range')
+        return {'quoteType': 'EQUITY'}
+
+    info_df = downloader.download_infos(['AAPL', 'NOTATICKER'], fetch_info, ['quoteType'],
+                                        calls_per_second=None, retries=3, backoff_seconds=0.0)
+    assert attempts.count('NOTATICKER') == 1
+    assert info_df['ticker'].tolist() == ['AAPL']
+
+
+def test_download_infos_resumes_with_saved_infos(tmp_path):
+    checkpoint_path = str(tmp_path / 'checkpoint.txt')
+    fetched = []
+
+    def fetch_info(ticker):
+        fetched.append(ticker)
+        if ticker == 'GOOG' and fetched.count('GOOG') == 1:
+            raise ValueError('interrupted')
+        return {'quoteType': 'EQUITY', 'sharesOutstanding': float(len(ticker))}
+
+    kwargs = dict(calls_per_second=None, retries=0, checkpoint_path=checkpoint_path)
+    first = downloader.download_infos(['AAPL', 'GOOG'], fetch_info, ['quoteType', 'sharesOutstanding'], **kwargs)
+    assert first['ticker'].tolist() == ['AAPL']
+    resumed = downloader.download_infos(['AAPL', 'GOOG'], fetch_info, ['quoteType', 'sharesOutstanding'], **kwargs)
+    assert fetched == ['AAPL', 'GOOG', 'GOOG']
+    assert resumed.to_dict('records') == [{'ticker': 'AAPL', 'quoteType': 'EQUITY', 'sharesOutstanding': 4.0},
+                                          {'ticker': 'GOOG', 'quoteType': 'EQUITY', 'sharesOutstanding': 4.0}]
+
+
+def test_download_from_local_server(tmp_path):
+    _make_fixture_dir(tmp_path / 'fixtures', ['AAPL'])
+    handler = functools.partial(http.server.SimpleHTTPRequestHandler, directory=str(tmp_path / 'fixtures'))
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        fetch = downloader.http_price_fetcher(f'http://127.0.0.1:{server.server_address[1]}')
+        failed = downloader.download_price_histories(['AAPL'], fetch, str(tmp_path / 'data'),
+                                                     calls_per_second=None)
+    finally:
+        server.shutdown()
+    assert failed == []
+    assert pd.read_csv(tmp_path / 'data' / 'AAPL.csv')['Adj Close'].tolist() == [1.0, 2.0]
+
+
+def _history(dates, prices):
+    return pd.DataFrame({'Adj Close': prices, 'Volume': [10.0] * len(prices)},
+                        index=pd.DatetimeIndex(dates, name='Date'))
+
+
+def test_refresh_appends_missing_tail(tmp_path):
+    _history(['2010-01-04', '2010-01-05'], [1.0, 2.0]).to_csv(tmp_path / 'AAPL.csv')
+    remote = _history(['2010-01-04', '2010-01-05', '2010-01-06', '2010-01-07'], [1.0, 2.0, 3.0, 4.0])
+    requested_start_dates = []
+
+    def fetch_since(ticker, start_date):
+        requested_start_dates.append(start_date)
+        return downloader.tail_fetcher_from(lambda _: remote)(ticker, start_date)
+
+    statuses = downloader.refresh_price_histories(['AAPL'], fetch_since, str(tmp_path),
+                                                  overlap_days=1, calls_per_second=None)
+    assert statuses == {'AAPL': 'appended'}
+    assert [str(start_date) for start_date in requested_start_dates] == ['2010-01-05']
+    stored = pd.read_csv(tmp_path / 'AAPL.csv', index_col='Date')
+    assert stored['Adj Close'].tolist() == [1.0, 2.0, 3.0, 4.0]
+
+
+def test_refresh_refetches_when_adjusted_history_changed(tmp_path):
+    _history(['2010-01-04', '2010-01-05'], [1.0, 2.0]).to_csv(tmp_path / 'AAPL.csv')
+    # dividend paid on 2010-01-06 adjusts all previous prices
+    remote = _history(['2010-01-04', '2010-01-05', '2010-01-06'], [0.9, 1.8, 3.0])
+    _history(['2010-01-04', '2010-01-05'], [1.0, 2.0]).to_csv(tmp_path / 'GOOG.csv')
+    statuses = downloader.refresh_price_histories(['AAPL', 'GOOG'],
+                                                  downloader.tail_fetcher_from(
+                                                      lambda ticker: remote if ticker == 'AAPL' else
+                                                      _history(['2010-01-04', '2010-01-05'], [1.0, 2.0])),
+                                                  str(tmp_path), calls_per_second=None)
+    assert statuses == {'AAPL': 'refetched', 'GOOG': 'up_to_date'}
+    stored = pd.read_csv(tmp_path / 'AAPL.csv', index_col='Date')
+    assert stored['Adj Close'].tolist() == [0.9, 1.8, 3.0]
+
+
+def test_refresh_refetches_empty_stored_history(tmp_path):
+    _history([], []).to_csv(tmp_path / 'AAPL.csv')
+    remote = _history(['2010-01-04', '2010-01-05'], [1.0, 2.0])
+    statuses = downloader.refresh_price_histories(['AAPL'], downloader.tail_fetcher_from(lambda _: remote),
+                                                  str(tmp_path), calls_per_second=None)
+    assert statuses == {'AAPL': 'refetched'}
+    assert pd.read_csv(tmp_path / 'AAPL.csv')['Adj Close'].tolist() == [1.0, 2.0]
@@ -0,0 +1,99 @@
+import datetime
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from pypoanal import backtester, event_backtester, portfolio_calculators
+from pypoanal.assets import PortfolioHistory
+
+
+# T0 is listed later, the second half of the history is more volatile
+HISTORY = dict(volatility=np.where(np.arange(900) < 450, 0.01, 0.04), unlisted_days=300)
+
+
+def _run(shares_history, triggers, compute_weights=portfolio_calculators.compute_equal_weights):
+    return event_backtester.run_event_backtest(compute_weights, shares_history, datetime.date(2010, 6, 1),
+                                               datetime.date(2013, 6, 1), 10 ** 5, triggers)
+
+
+def test_calendar_trigger_values_match_daily_values_history(make_shares_history):
+    shares_history = make_shares_history(**HISTORY)
+    result = _run(shares_history, [event_backtester.CalendarTrigger(datetime.timedelta(days=91))])
+    event_dates = result.events['date']
+    assert result.events['trigger'].tolist() == ['start'] + ['calendar'] * (len(event_dates) - 1)
+    assert ((event_dates.diff().dropna() >= pd.Timedelta(days=91)) &
+            (event_dates.diff().dropna() < pd.Timedelta(days=95))).all()
+    held_portfolios = PortfolioHistory(result.portfolios.tickers, result.portfolios.cash[1:],
+                                       result.portfolios.holdings[1:])
+    expected_values = backtester.daily_values_history(held_portfolios, list(event_dates.dt.date),
+                                                      shares_history.price_history, datetime.date(2013, 6, 1))
+    pd.testing.assert_series_equal(result.values, expected_values, rtol=1e-12)
+    assert result.values.index[0] == pd.Timestamp(2010, 6, 1)
+    # values after fees
+    assert result.values.iloc[0] == pytest.approx(10 ** 5 - result.events['fees'].iloc[0], rel=1e-3)
+
+
+def test_drift_trigger_fires_when_weights_leave_the_band(make_shares_history):
+    shares_history = make_shares_history(**HISTORY)
+    band = 0.03
+    result = _run(shares_history, [event_backtester.DriftTrigger(band)])
+    assert (result.events['trigger'].iloc[1:] == 'drift').all() and len(result.events) > 2
+    prices = shares_history.price_history.fillna(method='ffill')
+    for event_number in range(1, len(result.events) - 1):
+        portfolio = result.portfolios[event_number]
+        start, event_date = result.events['date'].iloc[event_number - 1], result.events['date'].iloc[event_number]
+        held_prices = prices.loc[start:event_date, portfolio.shares.index]
+        weights = (held_prices * portfolio.shares).div((held_prices * portfolio.shares).sum(axis=1) + portfolio.cash,
+                                                       axis=0)
+        drift = (weights - weights.iloc[0]).abs().max(axis=1)
+        # the first day outside of the band after the minimal holding period
+        assert drift.iloc[-1] > band
+        assert (drift.iloc[5:-1] <= band).all()
+
+
+def test_volatility_trigger_fires_on_regime_change(make_shares_history):
+    shares_history = make_shares_history(**HISTORY)
+    result = _run(shares_history, [event_backtester.VolatilityTrigger(window=42, ratio=2.0)])
+    assert result.events['trigger'].tolist()[:2] == ['start', 'volatility']
+    # volatility quadruples in the middle of the history
+    assert pd.Timestamp(shares_history.price_history.index[450]) <= result.events['date'].iloc[1]
+
+
+def test_volatility_triggers_share_the_values_of_blocks(make_shares_history, monkeypatch):
+    shares_history = make_shares_history(**HISTORY)
+    computed_ranges = []
+    compute_values = event_backtester.HoldingSegment.compute_values
+
+    def recording_compute_values(segment, start, stop):
+        computed_ranges.append((segment.rebalance_row, start, stop))
+        return compute_values(segment, start, stop)
+
+    monkeypatch.setattr(event_backtester.HoldingSegment, 'compute_values', recording_compute_values)
+    # same window, every block is valued once for both triggers
+    result = _run(shares_history, [event_backtester.VolatilityTrigger(window=42, ratio=2.0),
+                                   event_backtester.VolatilityTrigger(window=42, ratio=3.0)])
+    assert result.events['trigger'].tolist()[:2] == ['start', 'volatility']
+    reference_ranges = [(row, start, stop) for row, start, stop in computed_ranges if stop == row + 1]
+    block_ranges = [computed_range for computed_range in computed_ranges if computed_range not in reference_ranges]
+    assert len(block_ranges) == len(set(block_ranges)) > 0
+    # reference volatility is computed once per segment by each trigger
+    assert len(reference_ranges) == 2 * len(set(reference_ranges))
+
+
+def test_failed_weights_keep_the_portfolio(make_shares_history):
+    shares_history = make_shares_history(**HISTORY)
+    calls = []
+
+    def fails_after_first_call(shares_outstanding, price_history):
+        calls.append(1)
+        if len(calls) > 1:
+            raise ValueError('no solution')
+        return portfolio_calculators.compute_equal_weights(shares_outstanding, price_history)
+
+    result = _run(shares_history, [event_backtester.CalendarTrigger(datetime.timedelta(days=182))],
+                  fails_after_first_call)
+    assert result.events['error'].iloc[0] is None
+    assert (result.events['error'].iloc[1:] == 'ValueError: no solution').all()
+    assert (result.events['fees'].iloc[1:] == 0).all()
+    assert all(portfolio == result.portfolios[1] for portfolio in list(result.portfolios)[2:])
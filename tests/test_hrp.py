@@ -0,0 +1,44 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from pypoanal import hrp, portfolio_calculators
+
+
+def _price_history(n_tickers, missing_ratio=0.0, n_days=300, seed=0):
+    rng = np.random.default_rng(seed)
+    # a few common factors make the clusters
+    factors = rng.normal(size=(n_days, 4))
+    returns = factors @ rng.normal(size=(4, n_tickers)) * 0.01 + rng.normal(0.0, 0.02, size=(n_days, n_tickers))
+    prices = pd.DataFrame(10.0 * np.exp(np.cumsum(returns, axis=0)), columns=[f'T{n}' for n in range(n_tickers)])
+    prices[rng.random(prices.shape) < missing_ratio] = np.nan
+    return prices
+
+
+@pytest.mark.parametrize('n_tickers,missing_ratio', [(2, 0.0), (7, 0.0), (40, 0.05), (200, 0.0)])
+def test_native_hrp_matches_pypfopt(n_tickers, missing_ratio):
+    price_history = _price_history(n_tickers, missing_ratio)
+    pd.testing.assert_series_equal(portfolio_calculators.compute_native_hrp_weights(None, price_history),
+                                   portfolio_calculators.compute_hrp_weights(None, price_history),
+                                   atol=1e-5)
+
+
+def test_sample_covariance_matches_pandas():
+    returns = _price_history(12, missing_ratio=0.1).pct_change()
+    cov, corr = hrp.sample_covariance(returns.to_numpy())
+    np.testing.assert_allclose(cov, returns.cov().to_numpy(), rtol=1e-9)
+    np.testing.assert_allclose(corr, returns.corr().to_numpy(), rtol=1e-9)
+
+
+def test_linkage_is_reused_while_tickers_do_not_change():
+    price_history = _price_history(30)
+    calculator = hrp.NativeHRP(reuse_linkage=True)
+    first_weights = calculator(None, price_history.iloc[:150])
+    calculator(None, price_history.iloc[150:])
+    assert calculator.n_linkages == 1
+    calculator(None, price_history.iloc[:150, :20])
+    assert calculator.n_linkages == 2
+    # the same window gives the same weights with a reused linkage
+    calculator(None, price_history.iloc[:150])
+    pd.testing.assert_series_equal(calculator(None, price_history.iloc[:150]), first_weights)
+    assert calculator.n_linkages == 3
@@ -0,0 +1,41 @@
+import subprocess
+import sys
+import time
+
+import pytest
+
+HEAVY_MODULES = ['cvxpy', 'pypfopt', 'osqp', 'yfinance', 'yahoo_fin', 'tqdm', 'scipy.cluster', 'loguru']
+PACKAGE_MODULES = ['pypoanal.backtester', 'pypoanal.portfolio_calculators', 'pypoanal.portfolio_rebalancer',
+                   'pypoanal.dataloader', 'pypoanal.sweep', 'pypoanal.optimizer_session', 'pypoanal.parallel',
+                   'pypoanal.weights_cache', 'pypoanal.covariance', 'pypoanal.hrp', 'pypoanal.bonds']
+
+
+def _run_python(code: str) -> str:
+    """runs code in a fresh interpreter, where nothing is imported yet"""
+    return subprocess.run([sys.executable, '-c', code], capture_output=True, text=True, check=True).stdout
+
+
+@pytest.mark.parametrize('module', PACKAGE_MODULES)
+def test_heavy_dependencies_are_not_imported_with_the_package(module):
+    loaded = _run_python(f'import sys, {module}\n'
+                         f'print(" ".join(name for name in {HEAVY_MODULES!r} if name in sys.modules))')
+    assert loaded.split() == []
+
+
+def test_heavy_dependencies_are_imported_on_first_use():
+    loaded = _run_python('import sys\n'
+                         'import pandas as pd\n'
+                         'from pypoanal import portfolio_calculators\n'
+                         'prices = pd.DataFrame({"A": [1.0, 1.1, 1.2, 1.1], "B": [2.0, 2.1, 2.0, 2.2]})\n'
+                         'portfolio_calculators.compute_ledoitw_weights(None, prices)\n'
+                         'print(sys.modules["cvxpy"].SolverError in portfolio_calculators.CALCULATION_ERRORS)')
+    assert loaded.split() == ['True']
+
+
+def test_import_time_budget():
+    # pandas and numpy are needed by every module, the budget is for the package on top of them
+    seconds = float(_run_python('import time, numpy, pandas, scipy.sparse\n'
+                                'start = time.perf_counter()\n'
+                                'import pypoanal.backtester\n'
+                                'print(time.perf_counter() - start)'))
+    assert seconds < 0.5
@@ -0,0 +1,52 @@
+import datetime
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from pypoanal import backtester
+from pypoanal.liquidity import LiquidityIndex
+
+
+def _apply_liquid_tickers(volumes_history, start_date, end_date, min_volume, liquid_days_percent):
+    """per-column implementation used before LiquidityIndex"""
+    trading_days_in_period = len(volumes_history[start_date:end_date])
+    required_liquid_trading_days = trading_days_in_period * liquid_days_percent / 100.0
+    volumes_sample = volumes_history.loc[start_date:end_date, :]
+    liquid_trading_days = volumes_sample.apply(lambda x: len(x.loc[x > min_volume]), axis=0)
+    return liquid_trading_days[liquid_trading_days > required_liquid_trading_days].index.tolist()
+
+
+@pytest.fixture
+def volumes_history():
+    rng = np.random.default_rng(1)
+    volumes = rng.lognormal(4.0, 1.0, size=(500, 30))
+    volumes[rng.random(volumes.shape) < 0.05] = np.nan
+    return pd.DataFrame(volumes,
+                        index=pd.bdate_range('2010-01-01', periods=500),
+                        columns=[f'T{n}' for n in range(30)])
+
+
+@pytest.mark.parametrize('min_volume,liquid_days_percent', [(50, 90), (20, 90), (50, 50), (0, 100)])
+def test_liquidity_index_matches_apply(volumes_history, min_volume, liquid_days_percent):
+    liquidity_index = LiquidityIndex(volumes_history)
+    for start_date, end_date in [(datetime.date(2010, 1, 1), datetime.date(2010, 6, 1)),
+                                 (datetime.date(2010, 3, 6), datetime.date(2011, 3, 6)),
+                                 (datetime.date(2011, 5, 1), datetime.date(2013, 1, 1)),
+                                 (datetime.date(2009, 1, 1), datetime.date(2009, 6, 1))]:
+        assert liquidity_index.liquid_tickers(start_date, end_date, min_volume, liquid_days_percent) == \
+               _apply_liquid_tickers(volumes_history, start_date, end_date, min_volume, liquid_days_percent)
+
+
+def test_choose_liquid_tickers():
+    volumes_history = pd.DataFrame({'GOOG': [100.0, 100.0, 100.0], 'AMZN': [100.0, np.nan, 10.0]},
+                                   index=[datetime.date(2010, 1, 1),
+                                          datetime.date(2010, 1, 2),
+                                          datetime.date(2010, 1, 3)])
+    assert backtester.choose_liquid_tickers(volumes_history,
+                                            datetime.date(2010, 1, 1),
+                                            datetime.date(2010, 1, 3)) == ['GOOG']
+    assert backtester.choose_liquid_tickers(volumes_history,
+                                            datetime.date(2010, 1, 1),
+                                            datetime.date(2010, 1, 3),
+                                            liquid_days_percent=30) == ['GOOG', 'AMZN']
@@ -0,0 +1,75 @@
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from pypoanal import dataloader, metadata
+
+
+def _write_info(tmp_path, n_tickers=200, seed=0):
+    rng = np.random.default_rng(seed)
+    tickers = [f'T{n}' for n in range(n_tickers)]
+    info = pd.DataFrame({'ticker': tickers + ['T0'],
+                         'quoteType': rng.choice(['EQUITY', 'ETF'], n_tickers + 1, p=[0.8, 0.2]),
+                         'marketCap': rng.lognormal(20.0, 2.0, n_tickers + 1),
+                         'sharesOutstanding': rng.integers(10 ** 5, 10 ** 8, n_tickers + 1).astype(np.float64),
+                         'exchange': rng.choice(['NYQ', 'NMS', 'NGM'], n_tickers + 1, p=[0.5, 0.3, 0.2])})
+    info.loc[5, 'sharesOutstanding'] = np.nan
+    info.loc[7, 'marketCap'] = np.nan
+    info_path = tmp_path / 'tickers_info.csv'
+    info.to_csv(info_path)
+    listings = {'snp500': tmp_path / 'snp500-listed.csv', 'nasdaq': tmp_path / 'nasdaq-listed.csv'}
+    pd.DataFrame({'ticker': tickers[:50]}).to_csv(listings['snp500'])
+    pd.DataFrame({'ticker': tickers[40:120]}).to_csv(listings['nasdaq'])
+    return metadata.TickerMetadataStore(str(info_path), {name: str(path) for name, path in listings.items()})
+
+
+def test_table_is_cached_until_a_file_changes(tmp_path):
+    store = _write_info(tmp_path)
+    table = store.table
+    assert store.table is table and store.n_loads == 1
+    # duplicates and tickers with unknown shares outstanding are dropped, as in load_all_saved_tickers_info
+    assert table.index.is_unique and 'T5' not in table.index and len(table) == 199
+    assert table['snp500'].sum() == 49 and table['nasdaq'].sum() == 80
+    listing_path = store.listings_paths['snp500']
+    pd.DataFrame({'ticker': ['T1']}).to_csv(listing_path)
+    os.utime(listing_path, ns=(os.stat(listing_path).st_atime_ns, os.stat(listing_path).st_mtime_ns + 10 ** 9))
+    assert store.table['snp500'].sum() == 1 and store.n_loads == 2
+
+
+def test_query_filters(tmp_path):
+    store = _write_info(tmp_path)
+    table = store.table
+    selected = store.query(quote_types=['EQUITY'], exchanges=['NYQ', 'NMS'], min_market_cap=10 ** 8,
+                           listings=['snp500', 'nasdaq'])
+    expected = table[(table['quoteType'] == 'EQUITY') & table['exchange'].isin(['NYQ', 'NMS']) &
+                     (table['marketCap'] >= 10 ** 8) & (table['snp500'] | table['nasdaq'])]
+    pd.testing.assert_frame_equal(selected, expected)
+    assert 'T7' not in store.query(max_market_cap=np.inf).index
+    assert len(store.query()) == len(table)
+
+
+@pytest.mark.parametrize('by, bins', [('exchange', None), ('marketCap', 4)])
+def test_stratified_sample_keeps_group_proportions(tmp_path, by, bins):
+    store = _write_info(tmp_path)
+    candidates = store.query(quote_types=['EQUITY'])
+    sample = store.sample(40, by=by, bins=bins, seed=1, quote_types=['EQUITY'])
+    assert len(sample) == len(set(sample)) == 40
+    assert set(sample) <= set(candidates.index)
+    groups = candidates[by] if bins is None else pd.qcut(candidates[by], bins)
+    expected_sizes = groups.value_counts(dropna=False) * 40 / len(candidates)
+    sample_sizes = groups[sample].value_counts(dropna=False).reindex(expected_sizes.index, fill_value=0)
+    assert (np.abs(sample_sizes - expected_sizes) < 1).all()
+    assert sample == store.sample(40, by=by, bins=bins, seed=1, quote_types=['EQUITY'])
+    assert store.sample(10 ** 4) == store.table.index.tolist()
+
+
+def test_dataloader_reads_tickers_info_once(tmp_path, monkeypatch):
+    store = _write_info(tmp_path)
+    monkeypatch.setattr(dataloader, 'SHARES_INFO_FILEPATH', store.tickers_info_path)
+    info = dataloader.load_all_saved_tickers_info()
+    assert 'snp500' not in info.columns
+    shares_outstanding = dataloader.load_shares_outstanding({'T1', 'T2'})
+    assert shares_outstanding.to_dict() == info.loc[['T1', 'T2'], 'sharesOutstanding'].to_dict()
+    assert metadata.metadata_store(store.tickers_info_path).n_loads == 1
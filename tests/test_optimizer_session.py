@@ -0,0 +1,65 @@
+import datetime
+import pickle
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from pypoanal import backtester, portfolio_calculators
+from pypoanal.backtest_plan import BacktestPlan
+from pypoanal.optimizer_session import MaxSharpeSession, warm_started_calculators
+
+
+COLD_CALCULATORS = {'max_sharpe': portfolio_calculators.compute_sharpie_weights,
+                    'exp_cov': portfolio_calculators.compute_expcov_weights,
+                    'ledoitw_cov': portfolio_calculators.compute_ledoitw_weights}
+
+
+def _assert_same_weights(warm_calculator, cold_calculator, shares_outstanding, price_history):
+    """weights are equal up to solver tolerance, or both calculators fail"""
+    try:
+        expected_weights = cold_calculator(shares_outstanding, price_history)
+    except portfolio_calculators.CALCULATION_ERRORS:
+        with pytest.raises(portfolio_calculators.CALCULATION_ERRORS):
+            warm_calculator(shares_outstanding, price_history)
+        return
+    pd.testing.assert_series_equal(warm_calculator(shares_outstanding, price_history), expected_weights, atol=1e-3)
+
+
+def test_warm_started_calculators_match_pypfopt(shares_history):
+    rebalance_dates = backtester.compute_rebalance_dates(datetime.date(2010, 3, 1), datetime.date(2013, 6, 1),
+                                                         datetime.timedelta(days=182))
+    plan = BacktestPlan(shares_history, rebalance_dates)
+    calculators = warm_started_calculators(plan.tickers)
+    for calc_name, compute_weights in COLD_CALCULATORS.items():
+        for period in plan:
+            _assert_same_weights(calculators[calc_name], compute_weights,
+                                 shares_history.shares_outstanding, period.prices_sample)
+        assert calculators[calc_name].session.n_builds == 1
+
+
+def test_session_masks_tickers_and_grows_universe(shares_history):
+    prices = shares_history.price_history.iloc[:250]
+    calculators = warm_started_calculators()
+    windows_tickers = [['T0', 'T1', 'T2', 'T3'], ['T1', 'T2'], ['T2', 'T3', 'T4', 'T5', 'T6']]
+    for tickers in windows_tickers:
+        for calc_name, compute_weights in COLD_CALCULATORS.items():
+            _assert_same_weights(calculators[calc_name], compute_weights,
+                                 shares_history.shares_outstanding, prices[tickers])
+    # the third window added new tickers
+    assert calculators['exp_cov'].session.n_builds == 2
+    assert calculators['exp_cov'].session.tickers.tolist() == ['T0', 'T1', 'T2', 'T3', 'T4', 'T5', 'T6']
+
+
+def test_session_is_rebuilt_after_pickling(shares_history):
+    prices = shares_history.price_history.iloc[:250]
+    calculator = warm_started_calculators()['ledoitw_cov']
+    weights = calculator(shares_history.shares_outstanding, prices)
+    unpickled = pickle.loads(pickle.dumps(calculator))
+    pd.testing.assert_series_equal(unpickled(shares_history.shares_outstanding, prices), weights, atol=1e-4)
+
+
+def test_max_sharpe_requires_return_above_risk_free_rate():
+    cov_matrix = pd.DataFrame(np.eye(2), index=['A', 'B'], columns=['A', 'B'])
+    with pytest.raises(ValueError):
+        MaxSharpeSession().max_sharpe(pd.Series([0.01, 0.0], index=['A', 'B']), cov_matrix, risk_free_rate=0.02)
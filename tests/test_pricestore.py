@@ -0,0 +1,106 @@
+import os
+import warnings
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from pypoanal import dataloader, downloader, pricestore
+
+
+def _save_price_vol_csv(data_dir, ticker, dates, prices, volumes):
+    pd.DataFrame({'Adj Close': prices, 'Volume': volumes},
+                 index=pd.DatetimeIndex(dates, name='Date')).to_csv(data_dir / (ticker + '.csv'))
+
+
+def _make_csv_dir(data_dir):
+    _save_price_vol_csv(data_dir, 'GOOG', ['2010-01-04', '2010-01-05', '2010-01-06'],
+                        [100.0, 101.0, np.nan], [1000.0, 2000.0, 3000.0])
+    _save_price_vol_csv(data_dir, 'AMZN', ['2010-01-05', '2010-01-07'],
+                        [50.0, 51.0], [10.0, 20.0])
+
+
+def test_store_matches_csv(tmp_path):
+    _make_csv_dir(tmp_path)
+    store_dir = str(tmp_path / 'store')
+    converted = dataloader.convert_csv_dir_to_store(str(tmp_path), store_dir)
+    assert converted == ['AMZN', 'GOOG']
+    csv_prices, csv_volumes = dataloader.load_csv_price_and_volume_histories(['GOOG', 'AMZN'], str(tmp_path))
+    store_prices, store_volumes = pricestore.PriceVolumeStore(store_dir).price_and_volume_histories(['GOOG', 'AMZN'])
+    pd.testing.assert_frame_equal(store_prices, csv_prices, check_freq=False)
+    pd.testing.assert_frame_equal(store_volumes, csv_volumes, check_freq=False)
+
+
+def test_store_slice_by_ticker_and_date(tmp_path):
+    _make_csv_dir(tmp_path)
+    store_dir = str(tmp_path / 'store')
+    dataloader.convert_csv_dir_to_store(str(tmp_path), store_dir)
+    store = pricestore.PriceVolumeStore(store_dir)
+    volumes = store.volume_history(['GOOG'], start_date='2010-01-05', end_date='2010-01-06')
+    assert volumes['GOOG'].tolist() == [2000.0, 3000.0]
+    assert 'MSFT' not in store
+
+
+def test_load_falls_back_to_csv_for_missing_tickers(tmp_path):
+    _make_csv_dir(tmp_path)
+    store_dir = str(tmp_path / 'store')
+    dataloader.convert_csv_dir_to_store(str(tmp_path), store_dir, tickers=['GOOG'])
+    # csv files are read from the directory the store was converted from
+    prices, _ = dataloader.load_price_and_volume_histories({'GOOG', 'AMZN'}, store_dir=store_dir)
+    assert set(prices.columns) == {'GOOG', 'AMZN'}
+    assert len(prices) == 4
+
+
+def test_load_falls_back_to_csv_when_store_is_stale(tmp_path):
+    _make_csv_dir(tmp_path)
+    store_dir = str(tmp_path / 'store')
+    dataloader.convert_csv_dir_to_store(str(tmp_path), store_dir)
+    prices, _ = dataloader.load_price_and_volume_histories({'GOOG', 'AMZN'}, store_dir=store_dir)
+    assert len(prices) == 4
+    _save_price_vol_csv(tmp_path, 'AMZN', ['2010-01-05', '2010-01-07', '2010-01-08'],
+                        [50.0, 51.0, 52.0], [10.0, 20.0, 30.0])
+    csv_path = tmp_path / 'AMZN.csv'
+    os.utime(csv_path, ns=(os.stat(csv_path).st_atime_ns, os.stat(csv_path).st_mtime_ns + 10 ** 9))
+    with pytest.warns(UserWarning, match='AMZN'):
+        prices, _ = dataloader.load_price_and_volume_histories({'GOOG', 'AMZN'}, store_dir=store_dir)
+    assert prices.loc['2010-01-08', 'AMZN'] == 52.0
+
+
+def test_store_staleness_is_checked_against_its_csv_dir(tmp_path, monkeypatch):
+    csv_dir = tmp_path / 'csv'
+    csv_dir.mkdir()
+    _make_csv_dir(csv_dir)
+    store_dir = str(tmp_path / 'store')
+    dataloader.convert_csv_dir_to_store(str(csv_dir), store_dir)
+    # newer csv files of the same tickers in the default directory do not make the store stale
+    other_dir = tmp_path / 'other'
+    other_dir.mkdir()
+    _save_price_vol_csv(other_dir, 'AMZN', ['2010-01-05'], [50.0], [10.0])
+    monkeypatch.setattr(dataloader, 'DATA_DIR', str(other_dir))
+    store = pricestore.PriceVolumeStore(store_dir)
+    assert store.source_dir == str(csv_dir)
+    assert dataloader.stale_store_tickers(store, ['GOOG', 'AMZN']) == []
+    with warnings.catch_warnings():
+        warnings.simplefilter('error')
+        prices, _ = dataloader.load_price_and_volume_histories({'GOOG', 'AMZN'}, store_dir=store_dir)
+    assert len(prices) == 4
+    # a store written without sources is never stale
+    pricestore.write_store(prices, prices, str(tmp_path / 'plain_store'))
+    plain_store = pricestore.PriceVolumeStore(str(tmp_path / 'plain_store'))
+    assert plain_store.source_dir is None
+    assert dataloader.stale_store_tickers(plain_store, ['GOOG', 'AMZN']) == []
+
+
+def test_refresh_rebuilds_store(tmp_path, monkeypatch):
+    _make_csv_dir(tmp_path)
+    store_dir = str(tmp_path / 'store')
+    dataloader.convert_csv_dir_to_store(str(tmp_path), store_dir)
+    monkeypatch.setattr(dataloader, 'DATA_DIR', str(tmp_path))
+    remote = pd.DataFrame({'Adj Close': [50.0, 51.0, 52.0], 'Volume': [10.0, 20.0, 30.0]},
+                          index=pd.DatetimeIndex(['2010-01-05', '2010-01-07', '2010-01-08'], name='Date'))
+    statuses = dataloader.refresh_price_history(['AMZN'], downloader.tail_fetcher_from(lambda _: remote),
+                                                store_dir=store_dir, calls_per_second=None, progress_bar=False)
+    assert statuses == {'AMZN': 'appended'}
+    store = pricestore.PriceVolumeStore(store_dir)
+    assert dataloader.stale_store_tickers(store, ['GOOG', 'AMZN'], str(tmp_path)) == []
+    assert store.price_history(['AMZN'])['AMZN'].iloc[-1] == 52.0
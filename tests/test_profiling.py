@@ -0,0 +1,61 @@
+import datetime
+import json
+
+import pandas as pd
+import pytest
+
+from pypoanal import backtester, portfolio_calculators, profiling
+from pypoanal.optimizer_session import WarmStartedMinVolatility
+
+
+def _fails_on_second_call():
+    calls = []
+
+    def compute_weights(shares_outstanding, price_history):
+        calls.append(len(calls))
+        if len(calls) == 2:
+            raise ValueError('no solution')
+        return portfolio_calculators.compute_equal_weights(shares_outstanding, price_history)
+    return compute_weights
+
+
+@pytest.mark.parametrize('shares_history', [dict(n_tickers=6, n_days=600)], indirect=True)
+def test_profiler_records_stages_iterations_and_failures(tmp_path, shares_history):
+    rebalance_dates = backtester.compute_rebalance_dates(datetime.date(2010, 3, 1), datetime.date(2012, 3, 1),
+                                                         datetime.timedelta(days=120))
+    calculators = {'MCAP': portfolio_calculators.compute_mcap_weights,
+                   'min_vol': WarmStartedMinVolatility('ledoit_wolf'),
+                   'failing': _fails_on_second_call()}
+    profiler = profiling.BacktestProfiler()
+    values_df, fees_df, _ = backtester.compare_calculators_for_periodic_rebalance(
+        calculators, [], 10 ** 5, rebalance_dates, shares_history=shares_history, progress_bar=False,
+        rolling_covariance=True, profiler=profiler)
+    n_periods = len(rebalance_dates) - 1
+    records = profiler.to_dataframe()
+    # stages shared by calculators are summarized under ''
+    stage_counts = profiler.summary()['count']
+    assert stage_counts[('', profiling.LIQUIDITY)] == stage_counts[('', profiling.SLICING)] == n_periods
+    assert stage_counts[('MCAP', profiling.REBALANCE)] == n_periods
+    # batched calculators compute weights of all periods at once
+    assert stage_counts[('MCAP', profiling.WEIGHTS)] == 1
+    assert stage_counts[('min_vol', profiling.COVARIANCE)] == n_periods
+    assert (records['seconds'] >= 0).all()
+    # iterations are known only for solver sessions
+    weights_records = records[records['stage'] == profiling.WEIGHTS].set_index(['calculator', 'period'])
+    assert weights_records.loc['min_vol', 'iterations'].notna().all()
+    assert weights_records.loc['MCAP', 'iterations'].isna().all()
+    assert weights_records['error'].dropna().tolist() == ['ValueError: no solution']
+    assert stage_counts[('failing', profiling.REBALANCE)] == n_periods - 1
+    # profiling does not change the results
+    expected_values_df, expected_fees_df, _ = backtester.compare_calculators_for_periodic_rebalance(
+        {'MCAP': portfolio_calculators.compute_mcap_weights}, [], 10 ** 5, rebalance_dates,
+        shares_history=shares_history, progress_bar=False)
+    pd.testing.assert_series_equal(values_df['MCAP'], expected_values_df['MCAP'])
+    pd.testing.assert_series_equal(fees_df['MCAP'], expected_fees_df['MCAP'])
+
+    trace_path = tmp_path / 'trace.json'
+    profiler.to_json(str(trace_path))
+    with open(trace_path) as trace_file:
+        events = json.load(trace_file)['traceEvents']
+    assert len([event for event in events if event['ph'] == 'X']) == len(records)
+    assert {event['args']['name'] for event in events if event['ph'] == 'M'} == {'plan', 'MCAP', 'min_vol', 'failing'}
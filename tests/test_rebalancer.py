@@ -2,6 +2,7 @@ import numpy as np
 import pandas as pd
 
 from pypoanal import assets
+from benchmarks import bench_rebalancer
 from pypoanal import portfolio_rebalancer
 
 
@@ -198,3 +199,53 @@ def test_allocate_discrete_2():
     assert portfolio.shares.to_dict() == {'GOOG': 1.0, 'AMZN': 8.0}
     assert fees == 1.8
     assert portfolio.cash == 10.0 - 1.8
+
+
+# (old portfolio, new weights, latest prices, fees percent) of the reallocation tests above
+REALLOCATION_CASES = [
+    (assets.Portfolio(4000.0, pd.Series(dtype=np.float64)), pd.Series({'GOOG': 0.5, 'AMZN': 0.5}),
+     pd.Series({'GOOG': 2000.0, 'AMZN': 2000.0}), 0.0),
+    (assets.Portfolio(5000.0, pd.Series(dtype=np.float64)), pd.Series({'GOOG': 0.5, 'AMZN': 0.5}),
+     pd.Series({'GOOG': 2000.0, 'AMZN': 2000.0}), 1.0),
+    (assets.Portfolio(100.0, pd.Series({'GOOG': 1.0, 'AMZN': 1.0})), pd.Series({'GOOG': 0.4, 'AMZN': 0.6}),
+     pd.Series({'GOOG': 1000.0, 'AMZN': 2000.0}), 1),
+    (assets.Portfolio(100.0, pd.Series({'GOOG': 1.0, 'AMZN': 2.0})), pd.Series({'GOOG': 2 / 3, 'AMZN': 1 / 3}),
+     pd.Series({'GOOG': 1000.0, 'AMZN': 1000.0}), 1),
+    (assets.Portfolio(1000.0, pd.Series(dtype=np.float64)), pd.Series({'GOOG': 0.5, 'AMZN': 0.5}),
+     pd.Series({'GOOG': 100.0, 'AMZN': 100.0}), 0.0),
+    (assets.Portfolio(205.0, pd.Series(dtype=np.float64)), pd.Series({'GOOG': 0.5, 'AMZN': 0.5}),
+     pd.Series({'GOOG': 100.0, 'AMZN': 100.0}), 1.0),
+    (assets.Portfolio(190.0, pd.Series(dtype=np.float64)), pd.Series({'GOOG': 0.49, 'AMZN': 0.51}),
+     pd.Series({'GOOG': 100.0, 'AMZN': 10.0}), 1.0),
+    # old shares without price, weights of a ticker without price, prices of tickers without weights
+    (assets.Portfolio(50.0, pd.Series({'GOOG': 1.0, 'OLD': 3.0})), pd.Series({'AMZN': 0.7, 'NEW': 0.3}),
+     pd.Series({'GOOG': 100.0, 'AMZN': 10.0, 'AAPL': np.nan, 'MSFT': 20.0}), 0.5),
+]
+
+
+def _random_reallocation_case(n_tickers, seed):
+    rng = np.random.default_rng(seed)
+    tickers = [f'T{n}' for n in rng.permutation(n_tickers)]
+    prices = pd.Series(rng.lognormal(3.0, 1.0, n_tickers), index=tickers)
+    prices[rng.random(n_tickers) < 0.05] = np.nan
+    old_shares = pd.Series(rng.integers(0, 100, n_tickers).astype(np.float64), index=tickers)
+    old_shares = old_shares[old_shares > 20]
+    weights = pd.Series(rng.random(n_tickers), index=tickers).sample(frac=0.5, random_state=seed)
+    # almost no cash, fees force selling some shares
+    return assets.Portfolio(1.0, old_shares), weights / weights.sum(), prices, 1.0
+
+
+def _assert_same_reallocation(old_portfolio, weights, prices, fees_percent):
+    new_portfolio, fees = portfolio_rebalancer.reallocate_portfolio(old_portfolio, weights, prices, fees_percent)
+    expected_portfolio, expected_fees = bench_rebalancer.reallocate_portfolio_pandas(old_portfolio, weights, prices,
+                                                                                     fees_percent)
+    pd.testing.assert_series_equal(new_portfolio.shares, expected_portfolio.shares)
+    assert new_portfolio.cash == expected_portfolio.cash
+    assert fees == expected_fees
+
+
+def test_reallocate_portfolio_matches_pandas_implementation():
+    for old_portfolio, weights, prices, fees_percent in REALLOCATION_CASES:
+        _assert_same_reallocation(old_portfolio, weights, prices, fees_percent)
+    for seed in range(20):
+        _assert_same_reallocation(*_random_reallocation_case(200, seed))
@@ -0,0 +1,122 @@
+import datetime
+import functools
+from concurrent.futures import ThreadPoolExecutor
+
+import pandas as pd
+import pytest
+
+from pypoanal import backtester, portfolio_calculators, sweep
+
+
+HISTORY = dict(n_tickers=6, n_days=800)
+
+
+def test_random_start_dates():
+    start_dates = sweep.random_start_dates(datetime.date(2006, 8, 8), datetime.date(2014, 8, 8), 100, seed=1)
+    assert len(start_dates) == 100
+    assert start_dates == sorted(start_dates)
+    assert datetime.date(2006, 8, 8) <= start_dates[0] and start_dates[-1] <= datetime.date(2014, 8, 8)
+
+
+def test_sweep_matches_separate_backtests_and_deduplicates(make_shares_history):
+    shares_history = make_shares_history(**HISTORY)
+    calls = []
+
+    def counting_equal_weights(shares_outstanding, price_history):
+        calls.append(price_history.index[0])
+        return portfolio_calculators.compute_equal_weights(shares_outstanding, price_history)
+
+    calculators = {'MCAP': portfolio_calculators.compute_mcap_weights, 'equal': counting_equal_weights}
+    # Saturday and Sunday start dates give the same price windows
+    start_dates = [datetime.date(2010, 2, 6), datetime.date(2010, 2, 7), datetime.date(2010, 3, 15)]
+    end_date = datetime.date(2012, 12, 1)
+    rebalance_period = datetime.timedelta(days=182)
+    results = sweep.sweep_start_dates(calculators, shares_history, start_dates, end_date, rebalance_period,
+                                      10 ** 5, progress_bar=False)
+    sweep_calls = len(calls)
+    assert set(results.columns) == {'start_date', 'calculator', 'date', 'value', 'fees'}
+    n_periods = 0
+    for start_date in start_dates:
+        rebalance_dates = backtester.compute_rebalance_dates(start_date, end_date, rebalance_period)
+        n_periods += len(rebalance_dates) - 1
+        values_df, fees_df, _ = backtester.compare_calculators_for_periodic_rebalance(
+            calculators, [], 10 ** 5, rebalance_dates, shares_history=shares_history, progress_bar=False)
+        run_results = results[results['start_date'] == start_date]
+        for calc_name in calculators:
+            calc_results = run_results[run_results['calculator'] == calc_name]
+            assert calc_results['value'].tolist() == values_df[calc_name].tolist()
+            assert calc_results['fees'].tolist() == fees_df[calc_name].tolist()
+    # Saturday and Sunday runs share all their windows
+    assert sweep_calls < n_periods
+
+
+def test_sweep_in_processes_matches_serial(make_shares_history):
+    shares_history = make_shares_history(**HISTORY)
+    calculators = {'MCAP': portfolio_calculators.compute_mcap_weights,
+                   'HRP': portfolio_calculators.compute_hrp_weights}
+    start_dates = sweep.random_start_dates(datetime.date(2010, 1, 1), datetime.date(2010, 6, 1), 4, seed=0)
+    sweep_args = (calculators, shares_history, start_dates, datetime.date(2012, 12, 1),
+                  datetime.timedelta(days=182), 10 ** 5)
+    pd.testing.assert_frame_equal(sweep.sweep_start_dates(*sweep_args, progress_bar=False),
+                                  sweep.sweep_start_dates(*sweep_args, max_workers=2, progress_bar=False),
+                                  check_exact=True)
+
+
+def test_parameter_grid():
+    assert sweep.parameter_grid({'span': [60, 179], 'frequency': [252]}) == [{'span': 60, 'frequency': 252},
+                                                                              {'span': 179, 'frequency': 252}]
+    assert sweep.parameter_grid({}) == [{}]
+    assert sweep.parameters_label({'span': 60, 'frequency': 252}) == 'frequency=252, span=60'
+
+
+def test_hyperparameter_sweep_matches_start_dates_sweeps(make_shares_history):
+    shares_history = make_shares_history(**HISTORY)
+    calculators = {'MCAP': portfolio_calculators.compute_mcap_weights,
+                   'exp_cov': portfolio_calculators.compute_expcov_weights,
+                   'max_sharpe': portfolio_calculators.compute_sharpie_weights}
+    grids = {'exp_cov': {'span': [60, 179]}, 'max_sharpe': {'risk_free_rate': [0.0, 0.02]}}
+    start_dates = [datetime.date(2010, 2, 6), datetime.date(2010, 3, 15)]
+    sweep_args = (shares_history, start_dates, datetime.date(2012, 12, 1), datetime.timedelta(days=182), 10 ** 5)
+    results = sweep.sweep_hyperparameters(calculators, grids, *sweep_args, progress_bar=False)
+    assert set(results.groupby(['calculator', 'params']).groups) == {
+        ('MCAP', ''), ('exp_cov', 'span=60'), ('exp_cov', 'span=179'),
+        ('max_sharpe', 'risk_free_rate=0.0'), ('max_sharpe', 'risk_free_rate=0.02')}
+    # every grid point gives the backtest of the calculator with fixed parameters
+    for calc_name, params in [('exp_cov', {'span': 60}), ('max_sharpe', {'risk_free_rate': 0.0})]:
+        compute_weights = functools.partial(calculators[calc_name], **params)
+        expected = sweep.sweep_start_dates({calc_name: compute_weights}, *sweep_args, progress_bar=False)
+        actual = results[(results['calculator'] == calc_name) &
+                         (results['params'] == sweep.parameters_label(params))].reset_index(drop=True)
+        pd.testing.assert_frame_equal(actual.drop(columns='params'), expected, rtol=1e-6)
+    cube = sweep.results_cube(results)
+    assert cube.shape == (5, 2) and (cube.loc[('MCAP', '')] == 1.0).all()
+    final_values = results.groupby(['calculator', 'params', 'start_date'])['value'].last()
+    assert cube.loc[('exp_cov', 'span=60'), start_dates[1]] == (final_values[('exp_cov', 'span=60', start_dates[1])] /
+                                                                final_values[('MCAP', '', start_dates[1])])
+    pd.testing.assert_frame_equal(sweep.sweep_hyperparameters(calculators, grids, *sweep_args, max_workers=2,
+                                                              progress_bar=False), results, check_exact=True)
+
+
+def test_results_cube_needs_its_baseline():
+    results = pd.DataFrame({'start_date': [datetime.date(2010, 1, 1)] * 2, 'calculator': ['equal', 'HRP'],
+                            'params': ['', ''], 'date': [datetime.date(2011, 1, 1)] * 2, 'value': [2.0, 3.0],
+                            'fees': [0.0, 0.0]})
+    with pytest.raises(ValueError, match="'MCAP'.*'HRP', 'equal'"):
+        sweep.results_cube(results)
+    assert sweep.results_cube(results, baseline='equal').loc[('HRP', '')].tolist() == [1.5]
+    assert sweep.results_cube(results, baseline=None).loc[('HRP', '')].tolist() == [3.0]
+
+
+def test_map_bounded_takes_tasks_as_results_are_consumed():
+    taken = []
+
+    def tasks():
+        for task in range(20):
+            taken.append(task)
+            yield task
+
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        results = sweep._map_bounded(executor, lambda task: task ** 2, tasks(), max_pending=3)
+        assert next(results) == 0
+        assert len(taken) == 4
+        assert list(results) == [task ** 2 for task in range(1, 20)]
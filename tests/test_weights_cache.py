@@ -0,0 +1,132 @@
+import datetime
+import os
+import subprocess
+import sys
+
+import numpy as np
+import pandas as pd
+
+from pypoanal import portfolio_calculators
+from pypoanal.weights_cache import WeightsCache, cached_calculators, calculator_version
+
+
+def _price_history(shift=0.0):
+    return pd.DataFrame({'GOOG': [100.0, 101.0 + shift], 'AMZN': [200.0, np.nan]},
+                        index=[datetime.date(2010, 1, 1), datetime.date(2010, 1, 2)])
+
+
+SHARES_OUTSTANDING = pd.Series({'GOOG': 100.0, 'AMZN': 100.0})
+
+
+def test_cache_hits_and_misses():
+    cache = WeightsCache()
+    mcap = cache.cached(portfolio_calculators.compute_mcap_weights, 'MCAP')
+    first = mcap(SHARES_OUTSTANDING, _price_history())
+    second = mcap(SHARES_OUTSTANDING, _price_history())
+    mcap(SHARES_OUTSTANDING, _price_history(shift=1.0))
+    pd.testing.assert_series_equal(first, second)
+    assert cache.stats['MCAP'].hits == 1
+    assert cache.stats['MCAP'].misses == 2
+    assert len(cache.stats['MCAP'].recomputed) == 2
+    assert cache.stats_table().loc['MCAP', 'hits'] == 1
+
+
+def test_cache_key_includes_calculator_and_shares():
+    cache = WeightsCache()
+    calculators = cached_calculators({'MCAP': portfolio_calculators.compute_mcap_weights,
+                                      'equal': portfolio_calculators.compute_equal_weights}, cache)
+    mcap_weights = calculators['MCAP'](SHARES_OUTSTANDING, _price_history())
+    equal_weights = calculators['equal'](SHARES_OUTSTANDING, _price_history())
+    assert mcap_weights.to_dict() != equal_weights.to_dict()
+    calculators['MCAP'](SHARES_OUTSTANDING * 2, _price_history())
+    assert cache.stats['MCAP'].misses == 2
+
+
+def test_lru_eviction():
+    cache = WeightsCache(max_bytes=1)
+    mcap = cache.cached(portfolio_calculators.compute_mcap_weights, 'MCAP')
+    mcap(SHARES_OUTSTANDING, _price_history())
+    mcap(SHARES_OUTSTANDING, _price_history(shift=1.0))
+    mcap(SHARES_OUTSTANDING, _price_history())
+    assert cache.stats['MCAP'].misses == 3
+    assert cache.stats['MCAP'].evictions == 2
+
+
+def test_disk_persistence(tmp_path):
+    cache_dir = str(tmp_path / 'cache')
+    first_cache = WeightsCache(cache_dir=cache_dir)
+    first_weights = first_cache.cached(portfolio_calculators.compute_mcap_weights, 'MCAP')(SHARES_OUTSTANDING,
+                                                                                           _price_history())
+    second_cache = WeightsCache(cache_dir=cache_dir)
+    second_weights = second_cache.cached(portfolio_calculators.compute_mcap_weights, 'MCAP')(SHARES_OUTSTANDING,
+                                                                                             _price_history())
+    pd.testing.assert_series_equal(first_weights, second_weights)
+    assert second_cache.stats['MCAP'].disk_hits == 1
+    assert second_cache.stats['MCAP'].misses == 0
+
+
+def test_disk_hits_count_memory_evictions(tmp_path):
+    cache_dir = str(tmp_path / 'cache')
+    shifts = [0.0, 1.0, 2.0]
+    first_mcap = WeightsCache(cache_dir=cache_dir).cached(portfolio_calculators.compute_mcap_weights, 'MCAP')
+    for shift in shifts:
+        first_mcap(SHARES_OUTSTANDING, _price_history(shift))
+    # memory holds one entry, every disk hit after the first one evicts the previous entry
+    cache = WeightsCache(max_bytes=1, cache_dir=cache_dir)
+    mcap = cache.cached(portfolio_calculators.compute_mcap_weights, 'MCAP')
+    for shift in shifts:
+        mcap(SHARES_OUTSTANDING, _price_history(shift))
+    assert cache.stats['MCAP'].disk_hits == 3
+    assert cache.stats['MCAP'].misses == 0
+    assert cache.stats['MCAP'].evictions == 2
+    assert cache.stats_table().loc['MCAP', 'evictions'] == 2
+
+
+def test_disk_eviction(tmp_path):
+    cache = WeightsCache(cache_dir=str(tmp_path), max_disk_bytes=1)
+    mcap = cache.cached(portfolio_calculators.compute_mcap_weights, 'MCAP')
+    mcap(SHARES_OUTSTANDING, _price_history())
+    mcap(SHARES_OUTSTANDING, _price_history(shift=1.0))
+    assert len(list(tmp_path.glob('*.pkl'))) == 0
+
+
+def test_disk_entries_of_changed_calculators_are_not_served(tmp_path):
+    cache_dir = str(tmp_path / 'cache')
+
+    def compute_weights(shares_outstanding, price_history):
+        return portfolio_calculators.compute_mcap_weights(shares_outstanding, price_history)
+    first_version = calculator_version(compute_weights)
+    WeightsCache(cache_dir=cache_dir).cached(compute_weights, 'MCAP')(SHARES_OUTSTANDING, _price_history())
+
+    def compute_weights(shares_outstanding, price_history):
+        return portfolio_calculators.compute_equal_weights(shares_outstanding, price_history)
+    assert calculator_version(compute_weights) != first_version
+    assert calculator_version(compute_weights, '2') != calculator_version(compute_weights)
+    cache = WeightsCache(cache_dir=cache_dir)
+    weights = cache.cached(compute_weights, 'MCAP')(SHARES_OUTSTANDING, _price_history())
+    assert cache.stats['MCAP'].misses == 1
+    assert weights.to_dict() == {'GOOG': 0.5, 'AMZN': 0.5}
+
+
+def test_calculator_version_is_the_same_in_other_processes():
+    code = ('from pypoanal import portfolio_calculators, weights_cache\n'
+            'print(weights_cache.calculator_version(portfolio_calculators.compute_hrp_weights))')
+    other_process_version = subprocess.run([sys.executable, '-c', code], capture_output=True, text=True,
+                                           check=True).stdout.strip()
+    assert other_process_version == calculator_version(portfolio_calculators.compute_hrp_weights)
+
+
+def test_disk_size_is_tracked_without_listing_the_directory(tmp_path, monkeypatch):
+    cache = WeightsCache(cache_dir=str(tmp_path), max_disk_bytes=10 ** 6)
+    mcap = cache.cached(portfolio_calculators.compute_mcap_weights, 'MCAP')
+    mcap(SHARES_OUTSTANDING, _price_history())
+    file_size = sum(path.stat().st_size for path in tmp_path.glob('*.pkl'))
+    cache.max_disk_bytes = file_size
+
+    def listdir(path):
+        raise AssertionError('cache_dir is listed on a miss')
+    monkeypatch.setattr(os, 'listdir', listdir)
+    mcap(SHARES_OUTSTANDING, _price_history(shift=1.0))
+    # the older file is evicted
+    assert len(list(tmp_path.glob('*.pkl'))) == 1
+    assert cache._disk_bytes == file_size